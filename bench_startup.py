@@ -0,0 +1,77 @@
+# Benchmark de arranque de main.py: tiempo de imports y tiempo hasta el primer render (sesión nueva, sin datos).
+# Cada medición corre en un intérprete nuevo (arranque en frío). Los resultados se agregan a bench_startup.jsonl
+# para seguir su evolución entre commits.
+#   python bench_startup.py                 -> 5 repeticiones, agrega la mediana al historial
+#   python bench_startup.py -n 3 --no-guardar
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_startup.jsonl")
+
+# Se ejecuta en un proceso hijo: mide los imports de nivel superior de main.py y luego el primer render con AppTest.
+CHILD_SCRIPT = r"""
+import ast, json, sys, time
+app_path = sys.argv[1]
+tree = ast.parse(open(app_path, encoding='utf-8').read())
+import_nodes = [n for n in tree.body if isinstance(n, (ast.Import, ast.ImportFrom))
+                or (isinstance(n, ast.Try) and all(isinstance(b, (ast.Import, ast.ImportFrom)) for b in n.body))]
+t0 = time.perf_counter()
+exec(compile(ast.Module(import_nodes, []), app_path, 'exec'), {})
+imports_s = time.perf_counter() - t0
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(app_path, default_timeout=120)
+t1 = time.perf_counter(); at.run(); first_render_s = time.perf_counter() - t1
+t2 = time.perf_counter(); at.run(); rerun_s = time.perf_counter() - t2
+print(json.dumps({"imports_s": imports_s, "primer_render_s": first_render_s, "rerun_s": rerun_s,
+                  "errores": len(at.exception), "sdk_gemini_cargado": "google.generativeai" in sys.modules}))
+"""
+
+def run_once():
+    t0 = datetime.datetime.now()
+    proc = subprocess.run([sys.executable, "-c", CHILD_SCRIPT, APP_PATH], capture_output=True, text=True, timeout=600)
+    wall_s = (datetime.datetime.now() - t0).total_seconds()
+    result_line = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+    if proc.returncode != 0 or not result_line:
+        raise RuntimeError(f"Fallo la medición (código {proc.returncode}):\n{proc.stderr[-2000:]}")
+    result = json.loads(result_line[-1])
+    result["proceso_total_s"] = wall_s
+    return result
+
+def git_revision():
+    # Commit de main.py medido; "+cambios" si el archivo tiene modificaciones sin commitear.
+    cwd = os.path.dirname(APP_PATH)
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=cwd).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "main.py"], capture_output=True, text=True, cwd=cwd).stdout.strip()
+    except OSError: return None
+    return (revision + ("+cambios" if dirty else "")) or None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque de la app (imports y primer render).")
+    parser.add_argument("-n", "--repeticiones", type=int, default=5)
+    parser.add_argument("--no-guardar", action="store_true", help="No agregar el resultado a bench_startup.jsonl.")
+    args = parser.parse_args()
+
+    runs = []
+    for i in range(args.repeticiones):
+        runs.append(run_once())
+        print(f"[{i + 1}/{args.repeticiones}] imports {runs[-1]['imports_s']:.3f}s, primer render {runs[-1]['primer_render_s']:.3f}s, "
+              f"rerun {runs[-1]['rerun_s']:.3f}s, proceso {runs[-1]['proceso_total_s']:.3f}s")
+    record = {"fecha": datetime.datetime.now().isoformat(timespec='seconds'), "commit": git_revision(), "python": sys.version.split()[0],
+              "repeticiones": len(runs), "errores": max(r["errores"] for r in runs), "sdk_gemini_cargado": any(r["sdk_gemini_cargado"] for r in runs)}
+    for key in ["imports_s", "primer_render_s", "rerun_s", "proceso_total_s"]:
+        record[key] = round(statistics.median(r[key] for r in runs), 3)
+    print(json.dumps(record, ensure_ascii=False))
+    if record["errores"]: print("AVISO: el primer render terminó con excepciones; los tiempos no son comparables.")
+    if not args.no_guardar:
+        with open(HISTORY_PATH, "a", encoding="utf-8") as f: f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"Agregado a {HISTORY_PATH}.")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 # Import necessary libraries
 import streamlit as st
 import pandas as pd
-import google.generativeai as genai
+import numpy as np
+from google.api_core import exceptions as google_exceptions # ligero; el SDK de Gemini se importa en gemini_sdk()
 import os
 import time
 import json
@@ -9,6 +10,24 @@ from io import StringIO
 import datetime
 import re # Import regular expression library
 import traceback # Import traceback for detailed error logging
+import hashlib # Import hashlib for file/run fingerprints (checkpoints)
+import threading # Import threading for background analysis jobs
+import uuid
+import collections
+import copy
+import bisect
+import random
+import zlib
+import unicodedata
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, Future
+import pyarrow as pa
+import pyarrow.parquet as pq
+try:
+    import orjson # Decodificador JSON rápido (opcional; si falta se usa json estándar)
+except ImportError:
+    orjson = None
 
 # --- Streamlit Page Configuration ---
 st.set_page_config(page_title="Analizador de Servicios con Gemini (Pestañas)", layout="wide")
@@ -31,13 +50,21 @@ default_values = {
     'log_string': "Log de procesamiento aparecerá aquí...\n",
     'processing_complete': False,
     'events_df': None,
+    'events_path': None,
+    'spill_events': False,
+    'progressive_clients': False,
+    'follow_partial_job_id': None,
     'current_state_df': None,
     'df_loaded': None,
     'file_name': None,
+    'file_hash': None,
     'column_options': [],
     'min_date': None,
     'max_date': None,
     'api_key': os.environ.get("GEMINI_API_KEY", ""),
+    'api_keys_extra': os.environ.get("GEMINI_API_KEYS", ""),
+    'key_rpm_limit': None,
+    'key_tpm_limit': None,
     'imei_col': None,
     'desc_col': None,
     'date_col': None,
@@ -45,13 +72,49 @@ default_values = {
     'start_date': None,
     'end_date': None,
     'batch_size': 25,
+    'model_tiers': os.environ.get("GEMINI_MODEL_TIERS", "gemini-1.5-flash-8b, gemini-1.5-flash-latest"),
+    'resume_analysis': True,
+    'template_clustering': True,
+    'only_new_rows': True,
+    'filter_index': None,
+    'filter_index_key': None,
+    'uploaded_label_loaded': None,
+    'row_hashes': None,
+    'row_hashes_key': None,
+    'label_reuse_enabled': True,
+    'label_reuse_threshold': 0.8,
     'selected_clients_list': ["-- TODOS --"],
     'df_for_gemini_analysis': pd.DataFrame(),
-    'expand_all_details_fusion': False
+    'expand_all_details_fusion': False,
+    'job_ids': [],
+    'active_job_id': None,
+    'loaded_job_id': None,
+    'results_meta': {},
+    'auto_load_job_id': None,
+    'results_version': 0,
+    'partial_results_version': None,
+    'partial_results_loaded_at': 0.0,
+    'timeline_index': None,
+    'timeline_index_version': None,
+    'accessory_index': None,
+    'accessory_index_version': None,
+    'imei_report': None,
+    'imei_report_version': None,
+    'fleet_audit': None,
+    'fleet_audit_version': None,
+    'results_view_index': None,
+    'results_view_index_version': None,
+    'export_cache': {},
+    'export_cache_version': None,
+    'log_export_requested': False,
+    'log_export_bytes': None
 }
 for key, value in default_values.items():
     if key not in st.session_state:
         st.session_state[key] = value
+if not st.session_state.job_ids and st.query_params.get("trabajos"):
+    # Los trabajos de esta pestaña viajan en la URL: una recarga del navegador los vuelve a encontrar.
+    st.session_state.job_ids = [job_id for job_id in st.query_params["trabajos"].split(",") if job_id]
 
 
 # --- Component and Action Definitions (Important for Prompt and Mapping) ---
@@ -126,42 +189,471 @@ MAPEO_COMPONENTES = {
 }
 ACCIONES_ESTANDAR = ["Instalacion", "Desinstalacion", "Reemplazo", "Revision/Neutra", "Medicion Tanque"]
 
+# --- Poda del mapeo por lote: solo viajan los alias presentes en las descripciones + un núcleo fijo ---
+MAPEO_CORE_ALIASES = ["gps", "equipo", "unidad", "dispositivo", "paro", "paro motor", "corte de motor", "can bus", "easy can", "power hub", "sensor combustible", "barras de combustible"]
+MAPEO_ALIAS_PATTERNS = [(alias, re.compile(r'(?<![a-z0-9])' + re.escape(alias))) for alias in MAPEO_COMPONENTES]
+MAPEO_PROMPT_FULL_CHARS = len(json.dumps(MAPEO_COMPONENTES, indent=2))
+
+# --- Plantillas de descripción: los IDs se sustituyen por marcadores tipados y cada plantilla se envía una vez ---
+ID_TEMPLATE_RE = re.compile(
+    r'(?P<TDBLE>(?<![A-Za-z0-9<])TDBLE[_\-]?\d+(?![A-Za-z0-9]))'
+    r'|(?P<MAC>(?<![A-Za-z0-9])(?:(?:[0-9A-F]{2}[:\-]){5}[0-9A-F]{2}|(?=[0-9A-F]{0,11}[A-F])(?=[0-9A-F]{0,11}\d)[0-9A-F]{12})(?![A-Za-z0-9]))'
+    r'|(?P<IMEI>(?<![A-Za-z0-9])\d{15}(?![A-Za-z0-9]))'
+    r'|(?P<SERIE>(?<![A-Za-z0-9])[A-Z]{1,4}\d{6,}[A-Z0-9]*(?![A-Za-z0-9]))'
+    r'|(?P<NUM>(?<![A-Za-z0-9])\d{3,}(?![A-Za-z0-9]))', re.IGNORECASE)
+ID_PLACEHOLDER_RE = re.compile(r'<(TDBLE|MAC|IMEI|SERIE|NUM)_(\d+)>')
+
+# --- Esquema de salida estructurada (la API restringe la respuesta a esta forma y vocabulario) ---
+GEMINI_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "eventos_detectados": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "componente": {"type": "string", "format": "enum", "enum": COMPONENTES_ESTANDAR},
+                        "accion": {"type": "string", "format": "enum", "enum": ACCIONES_ESTANDAR},
+                        "accesorio_id": {"type": "string", "nullable": True},
+                    },
+                    "required": ["componente", "accion"],
+                },
+            },
+        },
+        "required": ["eventos_detectados"],
+    },
+}
+
+def gemini_sdk():
+    # Import diferido: google.generativeai arrastra todo el árbol protobuf/gRPC (~0.8s) y solo hace falta al analizar.
+    # Tras la primera llamada los módulos quedan en sys.modules y el import es inmediato.
+    import google.generativeai as genai
+    import google.ai.generativelanguage as glm
+    return genai, glm
+
+def gemini_schema_fields(schema):
+    # Esquema JSON (dict) -> campos de glm.Schema: 'type' y 'format' llevan guion bajo y el tipo va en mayúsculas.
+    fields = {}
+    for key, value in schema.items():
+        if key == "type": fields["type_"] = value.upper()
+        elif key == "format": fields["format_"] = value
+        elif key == "items": fields["items"] = gemini_schema_fields(value)
+        elif key == "properties": fields["properties"] = {name: gemini_schema_fields(prop) for name, prop in value.items()}
+        else: fields[key] = value
+    return fields
+
+class KeyBoundGeminiModel:
+    # Modelo ligado al cliente de una clave. Solo usa la API pública (GenerativeServiceClient); la respuesta se envuelve
+    # en GenerateContentResponse para conservar .text/.parts/.candidates como con genai.GenerativeModel.
+    def __init__(self, client, model_name):
+        self.client = client
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+
+    def generate_content(self, prompt, generation_config=None, request_options=None):
+        genai, glm = gemini_sdk()
+        request = glm.GenerateContentRequest(model=self.model_name, contents=[glm.Content(role="user", parts=[glm.Part(text=prompt)])],
+                                             generation_config=generation_config)
+        return genai.types.GenerateContentResponse.from_response(self.client.generate_content(request, **(request_options or {})))
+
+# --- Checkpoints (resultados por lote persistidos en disco, JSONL append-only) ---
+CHECKPOINT_DIR = os.environ.get("ANALISIS_CHECKPOINT_DIR", ".checkpoints")
+
+# --- Resultados guardados (Parquet columnar; se reabren sin volver a llamar a Gemini) ---
+RESULTS_DIR = os.environ.get("ANALISIS_RESULTS_DIR", ".resultados")
+RESULTS_FILES = {"events_df": "eventos.parquet", "current_state_df": "estado.parquet", "df_for_gemini_analysis": "filas_fuente.parquet"}
+RESULTS_META_KEY = b"analisis_meta"
+EXPORT_CACHE_MAX_BYTES = 32 * 1024 * 1024 # por sesión: descargas más grandes se serializan en cada render en vez de quedar en memoria
+
+# --- Volcado de eventos a disco (Parquet por lotes; memoria acotada en historiales muy grandes) ---
+EVENT_SPILL_DIR = os.environ.get("ANALISIS_SPILL_DIR", ".eventos_disco")
+EVENT_SPILL_CHUNK_ROWS = 200_000
+EVENT_SPILL_PREVIEW_ROWS = 5000
+
+# --- Almacén de filas (todas las exportaciones fusionadas por hash de contenido; solo filas nuevas van a la IA) ---
+ROW_STORE_DIR = os.environ.get("ANALISIS_ROW_STORE_DIR", ".almacen_filas")
+ROW_STORE_COLS = ["Row_Hash", "IMEI", "Fecha", "Cliente", "Descripcion", "Origen", "Visto_En", "Analizada_En"]
+
+# --- Conector Notion (sincronización incremental por last_edited_time hacia el almacén de filas) ---
+NOTION_API_URL = os.environ.get("NOTION_API_URL", "https://api.notion.com/v1")
+NOTION_API_VERSION = "2022-06-28"
+NOTION_DATABASE_ID_DEFAULT = os.environ.get("NOTION_DATABASE_ID", "4bc5d60d53494515a3b219ac9b718ac2")
+NOTION_PROPERTY_DEFAULTS = {"IMEI": "IMEI", "Fecha": "FECHA", "Cliente": "CLIENTES SATECH", "Descripcion": "DESCRIPTION"}
+NOTION_SYNC_STATE_FILE = "notion_sync.json"
+NOTION_FULL_RESYNC_HOURS = float(os.environ.get("NOTION_FULL_RESYNC_HOURS", "24")) # la consulta no devuelve páginas borradas: cada tanto se relee todo
+
+# --- Reutilización local de etiquetas (pares descripción → eventos ya validados, JSONL append-only) ---
+LABEL_STORE_PATH = os.environ.get("ANALISIS_LABEL_STORE", os.path.join(".etiquetas", "etiquetas.jsonl"))
+# Respuestas crudas del modelo + descripciones enviadas: permiten re-normalizar sin API cuando cambian las reglas. "" = no guardar.
+RAW_RESPONSE_STORE_PATH = os.environ.get("ANALISIS_RAW_RESPONSES", os.path.join(".respuestas_crudas", "respuestas.jsonl"))
+LABEL_MINHASH_PERMUTATIONS = 64
+LABEL_LSH_BANDS = 16 # 16 bandas x 4 filas: candidato con prob. >0.99 si Jaccard ≥ 0.8
+# Raíces de palabras que cambian el sentido de la acción ("instala" vs "desinstala" se parecen mucho en n-gramas):
+# solo se reutiliza una etiqueta si ambas descripciones tienen las mismas señales de acción.
+LABEL_ACTION_CUE_PREFIXES = [("des", "retir", "quit", "baja"), ("camb", "reempl", "sustitu"), ("inst", "isnt", "coloc", "pus", "agreg")]
+
+# --- Pool de API Keys (presupuesto por clave; ajustar a la cuota real de cada proyecto) ---
+GEMINI_KEY_RPM_DEFAULT = int(os.environ.get("GEMINI_KEY_RPM", "60"))
+GEMINI_KEY_TPM_DEFAULT = int(os.environ.get("GEMINI_KEY_TPM", "1000000"))
+GEMINI_MAX_IN_FLIGHT_PER_KEY = int(os.environ.get("GEMINI_MAX_IN_FLIGHT_PER_KEY", "1"))
+KEY_QUOTA_COOLDOWN_SECONDS = 60
+
+# --- Cascada de modelos (del más barato/rápido al más potente; solo lo dudoso escala) ---
+GEMINI_MODEL_TIERS_DEFAULT = default_values['model_tiers']
+GEMINI_MODEL_FALLBACK = "gemini-1.5-flash-latest"
+
+# --- Reintentos (backoff con jitter, cola de lotes aplazados y cortacircuitos) ---
+RETRY_BASE_DELAY_SECONDS = 2.0
+RETRY_MAX_DELAY_SECONDS = 60.0
+BATCH_MAX_DEFERRALS = 2 # veces que un lote con error de API vuelve al final de la cola antes del reintento en línea final
+CIRCUIT_WINDOW = 20
+CIRCUIT_MIN_CALLS = 6
+CIRCUIT_FAILURE_RATIO = 0.5
+CIRCUIT_COOLDOWN_SECONDS = 30.0
+CIRCUIT_MAX_COOLDOWN_SECONDS = 300.0
+
 
 # --- Functions ---
 # (update_log_display, get_gemini_client, build_gemini_prompt, normalize_component_name,
 #  extract_events_with_gemini, process_data, calculate_current_state remain the same as before)
+# Dentro de un trabajo en segundo plano no hay contexto de script de Streamlit: log, avisos y progreso
+# se redirigen al AnalysisJob del hilo actual en lugar de st.session_state / st.*.
+_job_context = threading.local()
+
+def get_current_job():
+    return getattr(_job_context, 'job', None)
+
 def update_log_display(new_entry, level="INFO"):
     timestamp = datetime.datetime.now().strftime('%H:%M:%S')
+    job = get_current_job()
+    if job is not None:
+        job.append_log(f"{timestamp} [{level}] {new_entry}\n")
+        return
     st.session_state.log_string += f"{timestamp} [{level}] {new_entry}\n"
 
-def get_gemini_client(api_key):
-    update_log_display("Attempting to configure Gemini client.", level="DEBUG")
-    if not api_key:
-        st.error("API Key no proporcionada.")
+def notify_user(message, level="warning"):
+    job = get_current_job()
+    if job is not None:
+        job.add_notice(message, level)
+        return
+    getattr(st, level)(message)
+
+def report_progress(progress, status_message):
+    job = get_current_job()
+    if job is not None:
+        job.update_progress(progress, status_message)
+
+def parse_api_keys(*sources):
+    api_keys = []
+    for source in sources:
+        for candidate in re.split(r'[\s,;]+', source or ""):
+            candidate = candidate.strip()
+            if candidate and candidate not in api_keys: api_keys.append(candidate)
+    return api_keys
+
+def mask_api_key(api_key):
+    return f"…{api_key[-4:]}" if api_key and len(api_key) > 4 else "…"
+
+def classify_gemini_key_error(error):
+    # 'permanent': clave inválida o sin permisos; 'quota': cuota/rate limit agotado (temporal); None: no es culpa de la clave.
+    if isinstance(error, (google_exceptions.PermissionDenied, google_exceptions.Unauthenticated)): return "permanent"
+    if isinstance(error, google_exceptions.InvalidArgument) and "api key" in str(error).lower(): return "permanent"
+    if isinstance(error, google_exceptions.ResourceExhausted): return "quota"
+    return None
+
+class NoGeminiKeyAvailable(RuntimeError):
+    pass
+
+class BatchDeferred(Exception):
+    # Lote con error reintentable de API: se reprograma al final de la cola en lugar de dormir el hilo.
+    def __init__(self, category, retry_after, error):
+        super().__init__(f"{category}: {error.__class__.__name__}: {error}")
+        self.category = category
+        self.retry_after = retry_after
+        self.error = error
+
+RETRYABLE_API_ERRORS = (google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                        google_exceptions.BadGateway, google_exceptions.GatewayTimeout, google_exceptions.Aborted, google_exceptions.Unknown,
+                        TimeoutError, ConnectionError)
+
+def retry_after_hint(error):
+    # Segundos sugeridos por el servidor (RetryInfo, cabecera Retry-After o "retry in Ns" en el mensaje); None si no hay pista.
+    for detail in getattr(error, 'details', None) or []:
+        retry_delay = getattr(detail, 'retry_delay', None)
+        if retry_delay is not None and hasattr(retry_delay, 'seconds'): return retry_delay.seconds + getattr(retry_delay, 'nanos', 0) / 1e9
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('Retry-After'): return float(headers['Retry-After'])
+    except (TypeError, ValueError, AttributeError): pass
+    match = re.search(r'retry (?:in|after) ([\d.]+)\s*s|retry_delay\s*\{\s*seconds:\s*(\d+)', str(error), re.IGNORECASE)
+    return float(match.group(1) or match.group(2)) if match else None
+
+def classify_retry_error(error):
+    # 'rate_limit' (429/cuota), 'transient' (timeouts, 5xx, red), 'parse' (respuesta inválida del modelo),
+    # 'key' (clave inválida: el pool la pone en cuarentena y se reintenta con otra), 'fatal' (sin claves).
+    if isinstance(error, NoGeminiKeyAvailable): return "fatal"
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)): return "rate_limit"
+    if classify_gemini_key_error(error) == "permanent": return "key"
+    if isinstance(error, RETRYABLE_API_ERRORS): return "transient"
+    if isinstance(error, (ValueError, TypeError)): return "parse"
+    return "transient"
+
+def retry_backoff_delay(category, attempt, retry_after=None, base=RETRY_BASE_DELAY_SECONDS, cap=RETRY_MAX_DELAY_SECONDS):
+    # Errores de parseo o de clave no son presión del servidor: reintento casi inmediato.
+    if category in ("parse", "key"): return random.uniform(0, 0.5)
+    # La pista del servidor manda (más un poco de jitter para no sincronizar lotes); si no hay, backoff exponencial con jitter.
+    if retry_after: return min(retry_after, CIRCUIT_MAX_COOLDOWN_SECONDS) + random.uniform(0, base)
+    return random.uniform(base / 2, min(cap, base * 2 ** (attempt + 1)))
+
+_retry_stats_lock = threading.Lock()
+def record_retry_event(retry_stats, event, amount=1):
+    if retry_stats is None: return
+    with _retry_stats_lock: retry_stats[event] += amount
+
+class CircuitBreaker:
+    # Cerrado: se despacha normal. Abierto (tasa de fallos de API alta en la ventana): nadie despacha hasta cumplir la pausa.
+    # Semiabierto: pasa una sola llamada de prueba; si va bien se cierra, si falla se reabre con el doble de pausa.
+    def __init__(self, window=CIRCUIT_WINDOW, min_calls=CIRCUIT_MIN_CALLS, failure_ratio=CIRCUIT_FAILURE_RATIO,
+                 cooldown=CIRCUIT_COOLDOWN_SECONDS, max_cooldown=CIRCUIT_MAX_COOLDOWN_SECONDS):
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = "cerrado"
+        self.open_until = 0.0
+        self.times_opened = 0
+        self._cooldown = cooldown
+        self._outcomes = collections.deque(maxlen=window)
+        self._probe_in_flight = False
+        self._cond = threading.Condition()
+
+    def wait_for_dispatch(self, should_abort=None):
+        # Bloquea mientras el circuito esté abierto. Devuelve (segundos esperados, es_llamada_de_prueba).
+        start = time.time()
+        with self._cond:
+            while True:
+                now = time.time()
+                if self.state == "cerrado" or (should_abort is not None and should_abort()): return now - start, False
+                if self.state == "abierto" and now >= self.open_until: self.state = "semiabierto"
+                if self.state == "semiabierto" and not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    return now - start, True
+                self._cond.wait(timeout=max(0.05, min((self.open_until - now) if self.state == "abierto" else 1.0, 1.0)))
+
+    def _open(self, retry_after=None):
+        self.state = "abierto"
+        self.open_until = time.time() + max(self._cooldown, retry_after or 0.0)
+        self.times_opened += 1
+
+    def record(self, failed, retry_after=None, probe=False):
+        # Registra el resultado de una llamada a la API; devuelve True si esta llamada abrió (o reabrió) el circuito.
+        with self._cond:
+            try:
+                if probe:
+                    self._probe_in_flight = False
+                    if failed:
+                        self._cooldown = min(self.max_cooldown, self._cooldown * 2)
+                        self._open(retry_after)
+                        return True
+                    self.state, self._cooldown = "cerrado", self.base_cooldown
+                    self._outcomes.clear()
+                    return False
+                self._outcomes.append(bool(failed))
+                if self.state == "cerrado" and failed and len(self._outcomes) >= self.min_calls and sum(self._outcomes) / len(self._outcomes) >= self.failure_ratio:
+                    self._open(retry_after)
+                    return True
+                return False
+            finally:
+                self._cond.notify_all()
+
+    def cancel_probe(self):
+        # La llamada de prueba no llegó a la API (p.ej. sin claves): otra puede probar.
+        with self._cond:
+            self._probe_in_flight = False
+            self._cond.notify_all()
+
+def run_deferred_batch(not_before, fn, *args, **kwargs):
+    # Espera (en el hilo de trabajo, no en el consumidor) hasta la hora de reintento del lote aplazado.
+    job = get_current_job()
+    while time.time() < not_before and not (job is not None and job.cancel_requested):
+        time.sleep(min(1.0, max(0.0, not_before - time.time())))
+    return fn(*args, **kwargs)
+
+class GeminiKeyPool:
+    # Pool de API Keys con presupuesto RPM/TPM por clave (ventana deslizante de 60 s) y cuarentena automática.
+    # Cada clave usa su propio cliente generativo, sin tocar el estado global de genai.configure().
+    def __init__(self, api_keys, rpm_limit, tpm_limit, max_in_flight_per_key=1):
+        self.rpm_limit = max(1, int(rpm_limit))
+        self.tpm_limit = max(1, int(tpm_limit))
+        self.max_in_flight_per_key = max(1, int(max_in_flight_per_key))
+        self._slots = [{"key": k, "label": mask_api_key(k), "clients": None, "validated": False,
+                        "requests": collections.deque(), "tokens": collections.deque(), "in_flight": 0,
+                        "quarantined_until": None, "quarantine_reason": "", "calls": 0, "errors": 0, "tokens_total": 0}
+                       for k in api_keys]
+        self._cond = threading.Condition()
+        self.circuit_breaker = CircuitBreaker() # compartido por todas las llamadas que usan este pool
+
+    @property
+    def size(self):
+        return len(self._slots)
+
+    def _prune(self, slot, now):
+        while slot["requests"] and now - slot["requests"][0] >= 60: slot["requests"].popleft()
+        while slot["tokens"] and now - slot["tokens"][0][0] >= 60: slot["tokens"].popleft()
+
+    def _is_quarantined(self, slot, now):
+        until = slot["quarantined_until"]
+        if until is None: return False
+        if until != float('inf') and until <= now:
+            slot["quarantined_until"], slot["quarantine_reason"] = None, ""
+            return False
+        return True
+
+    def usable_key_count(self):
+        with self._cond:
+            return sum(1 for s in self._slots if s["quarantined_until"] != float('inf'))
+
+    def get_clients(self, slot):
+        if slot["clients"] is None:
+            _, glm = gemini_sdk()
+            client_options = {"api_key": slot["key"]}  # Configuración independiente por clave (no global).
+            slot["clients"] = {"generative": glm.GenerativeServiceClient(client_options=client_options),
+                               "model": glm.ModelServiceClient(client_options=client_options)}
+        return slot["clients"]
+
+    def validate_keys(self):
+        _, glm = gemini_sdk()
+        results = []
+        for slot in self._slots:
+            if slot["validated"] or slot["quarantined_until"] == float('inf'): continue
+            try:
+                models = self.get_clients(slot)["model"].list_models(glm.ListModelsRequest(page_size=100))
+                if any('generateContent' in m.supported_generation_methods for m in models):
+                    slot["validated"] = True
+                    results.append((slot["label"], True, "OK"))
+                else:
+                    self.quarantine(slot, "Sin modelos con 'generateContent'.", permanent=True)
+                    results.append((slot["label"], False, slot["quarantine_reason"]))
+            except Exception as e:
+                self.quarantine(slot, f"{e.__class__.__name__}: {e}", permanent=classify_gemini_key_error(e) != "quota")
+                results.append((slot["label"], False, slot["quarantine_reason"]))
+        return results
+
+    def get_model(self, lease, model_name):
+        return KeyBoundGeminiModel(self.get_clients(lease["slot"])["generative"], model_name)
+
+    def acquire(self, estimated_tokens, timeout=600):
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                candidates = [s for s in self._slots if not self._is_quarantined(s, now)]
+                if not candidates and all(s["quarantined_until"] == float('inf') for s in self._slots):
+                    raise NoGeminiKeyAvailable("Todas las API Keys están en cuarentena permanente (inválidas o sin permisos).")
+                best_slot, best_score = None, -1.0
+                for slot in candidates:
+                    self._prune(slot, now)
+                    requests_left = self.rpm_limit - len(slot["requests"])
+                    tokens_left = self.tpm_limit - sum(n for _, n in slot["tokens"])
+                    if requests_left <= 0 or tokens_left < min(estimated_tokens, self.tpm_limit) or slot["in_flight"] >= self.max_in_flight_per_key:
+                        continue
+                    score = min(requests_left / self.rpm_limit, tokens_left / self.tpm_limit)
+                    if score > best_score: best_slot, best_score = slot, score
+                if best_slot is not None:
+                    token_entry = [now, estimated_tokens]
+                    best_slot["requests"].append(now)
+                    best_slot["tokens"].append(token_entry)
+                    best_slot["in_flight"] += 1
+                    best_slot["calls"] += 1
+                    return {"slot": best_slot, "token_entry": token_entry}
+                if now >= deadline:
+                    raise NoGeminiKeyAvailable(f"Ninguna API Key con presupuesto disponible tras {timeout}s de espera.")
+                self._cond.wait(timeout=min(1.0, max(0.05, deadline - now)))
+
+    def release(self, lease, actual_tokens=None, error=None):
+        slot = lease["slot"]
+        with self._cond:
+            slot["in_flight"] = max(0, slot["in_flight"] - 1)
+            if actual_tokens:
+                lease["token_entry"][1] = actual_tokens  # Sustituye la estimación por el consumo real.
+                slot["tokens_total"] += actual_tokens
+            error_class = classify_gemini_key_error(error) if error is not None else None
+            if error is not None: slot["errors"] += 1
+            if error_class == "permanent": self.quarantine(slot, f"{error.__class__.__name__}: {error}", permanent=True)
+            elif error_class == "quota": self.quarantine(slot, f"Cuota agotada: {error}", permanent=False, seconds=retry_after_hint(error) or KEY_QUOTA_COOLDOWN_SECONDS)
+            self._cond.notify_all()
+            return error_class
+
+    def quarantine(self, slot, reason, permanent=False, seconds=KEY_QUOTA_COOLDOWN_SECONDS):
+        with self._cond:
+            slot["quarantined_until"] = float('inf') if permanent else time.time() + seconds
+            slot["quarantine_reason"] = reason[:200]
+            self._cond.notify_all()
+
+    def status_rows(self):
+        now = time.time()
+        with self._cond:
+            rows = []
+            for slot in self._slots:
+                quarantined = self._is_quarantined(slot, now)
+                self._prune(slot, now)
+                rows.append({"API Key": slot["label"],
+                             "Estado": ("Cuarentena permanente" if slot["quarantined_until"] == float('inf') else "Cuarentena temporal") if quarantined else "Activa",
+                             "RPM usadas": len(slot["requests"]), "TPM usados": sum(n for _, n in slot["tokens"]),
+                             "Llamadas": slot["calls"], "Errores": slot["errors"], "Tokens totales": slot["tokens_total"],
+                             "Motivo": slot["quarantine_reason"]})
+            return rows
+
+@st.cache_resource
+def get_gemini_key_pool(api_keys, rpm_limit, tpm_limit, max_in_flight_per_key):
+    # Un pool por combinación de claves/límites, compartido por todas las sesiones del proceso
+    # para que el presupuesto de cada clave se cuente una sola vez.
+    return GeminiKeyPool(list(api_keys), rpm_limit, tpm_limit, max_in_flight_per_key)
+
+def get_gemini_client(api_keys, rpm_limit=None, tpm_limit=None):
+    update_log_display(f"Attempting to configure Gemini key pool ({len(api_keys)} key(s)).", level="DEBUG")
+    if not api_keys:
+        notify_user("API Key no proporcionada.", level="error")
         update_log_display("API Key not provided for Gemini client.", level="ERROR")
         return None
     try:
-        genai.configure(api_key=api_key)
-        models = genai.list_models()
-        if not any('generateContent' in m.supported_generation_methods for m in models):
-             st.error("La API Key es válida pero no tiene permisos para 'generateContent' o no hay modelos disponibles.")
-             update_log_display("API Key valid, but no models support 'generateContent' or no models available.", level="ERROR")
+        key_pool = get_gemini_key_pool(tuple(api_keys), rpm_limit or GEMINI_KEY_RPM_DEFAULT, tpm_limit or GEMINI_KEY_TPM_DEFAULT, GEMINI_MAX_IN_FLIGHT_PER_KEY)
+        for label, ok, detail in key_pool.validate_keys():
+            update_log_display(f"API Key {label}: {'válida' if ok else 'en cuarentena'} ({detail})", level="INFO" if ok else "WARNING")
+        if key_pool.usable_key_count() == 0:
+             notify_user("Ninguna API Key es válida o tiene permisos para 'generateContent'.", level="error")
+             update_log_display("No API key in the pool is valid or supports 'generateContent'.", level="ERROR")
              return None
-        update_log_display("Gemini client configured successfully.", level="INFO")
-        return genai
+        update_log_display(f"Gemini key pool configured successfully ({key_pool.usable_key_count()}/{key_pool.size} usable).", level="INFO")
+        return key_pool
     except Exception as e:
-        st.error(f"Error al configurar la API de Gemini. Verifica tu clave API: {e}")
+        notify_user(f"Error al configurar la API de Gemini. Verifica tus claves API: {e}", level="error")
         update_log_display(f"Error configuring Gemini API: {e}. Traceback: {traceback.format_exc()}", level="ERROR")
         return None
 
-def build_gemini_prompt(descriptions_list):
+def select_component_mapping(descriptions_list):
+    batch_text = "\n".join(descriptions_list).lower()
+    return {alias: MAPEO_COMPONENTES[alias] for alias, pattern in MAPEO_ALIAS_PATTERNS
+            if alias in MAPEO_CORE_ALIASES or pattern.search(batch_text)}
+
+def compact_component_mapping(component_mapping):
+    return json.dumps(component_mapping, ensure_ascii=False, separators=(',', ':'))
+
+def build_gemini_prompt(descriptions_list, component_mapping=None):
+    if component_mapping is None: component_mapping = select_component_mapping(descriptions_list)
     descriptions_list_string = "\n".join([f"- \"{desc}\"" for desc in descriptions_list])
+    placeholder_note = ""
+    if any(ID_PLACEHOLDER_RE.search(desc) for desc in descriptions_list):
+        placeholder_note = ("\nEn las descripciones, los identificadores se sustituyeron por marcadores tipados (<IMEI_1>, <MAC_1>, <TDBLE_1>, <SERIE_1>, <NUM_1>). "
+                            "Trátalos como el identificador que representan y cópialos TAL CUAL (con los signos < >) en `accesorio_id`; ej. \"SE PUSO POWER HUB #<NUM_1>\" -> accesorio_id \"<NUM_1>\".\n")
     prompt = f"""
 Eres un asistente experto en análisis de registros de servicio de flotas vehiculares. Dada la siguiente lista de {len(descriptions_list)} descripciones de servicio, analiza CADA descripción INDIVIDUALMENTE e identifica los componentes mencionados, la acción realizada sobre ellos, y CUALQUIER IDENTIFICADOR ÚNICO (IMEI, número de serie, MAC address como C2313007631, TDBLE_XXXX/XX:XX:XX:XX:XX:XX, o F7C74F3F64D2, Power Hub #868, PowerLite 111) asociado DIRECTAMENTE con ese componente específico en la descripción.
 
+{placeholder_note}
 Componentes a buscar y estandarizar a estos nombres: {', '.join(COMPONENTES_ESTANDAR)}.
 Usa el siguiente mapeo para estandarizar variantes:
-{json.dumps(MAPEO_COMPONENTES, indent=2)}
+{compact_component_mapping(component_mapping)}
 Si un componente no está en la lista o no es relevante (ej. 'tornillo', 'limpieza general', 'cable', 'tierra', 'corriente', 'tarjeta sd', 'memoria', 'sim', 'fusible', 'portafusible', 'sikaflex', 'pija'), ignóralo. Ignora también nombres de marcas (Teltonika, Suntech, Queclink, GTRACK, Ruptela, Concox, Topflytech, Sinotrack, Queclink) a menos que claramente se refieran al componente GPS principal. Si la marca incluye un modelo (ej. "Teltonika FMB920"), el modelo (FMB920) puede ser parte del accesorio_id si es un GPS.
 Un "relevador" solo es relevante si se menciona en un contexto de instalación/desinstalación/cambio explícito DEL RELEVADOR. No lo infieras para "paro de motor".
 
@@ -229,6 +721,48 @@ Devuelve únicamente la lista JSON con EXACTAMENTE {len(descriptions_list)} elem
 """
     return prompt
 
+def build_generation_config():
+    _, glm = gemini_sdk()
+    return glm.GenerationConfig(temperature=0.05, response_mime_type="application/json", response_schema=glm.Schema(gemini_schema_fields(GEMINI_RESPONSE_SCHEMA)))
+
+def fast_json_loads(text):
+    # orjson.JSONDecodeError hereda de json.JSONDecodeError: los llamadores capturan una sola excepción.
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+def repair_json_response_text(raw_response_text):
+    # Respaldo para respuestas fuera de esquema: quita bloques ``` y recorta al arreglo balanceado más externo.
+    cleaned_response_text = raw_response_text
+    match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', cleaned_response_text, re.IGNORECASE)
+    if match: cleaned_response_text = match.group(1).strip()
+
+    first_bracket = cleaned_response_text.find('[')
+    last_bracket = cleaned_response_text.rfind(']')
+    if first_bracket != -1 and last_bracket != -1 and last_bracket > first_bracket:
+         potential_json = cleaned_response_text[first_bracket : last_bracket + 1]
+         if potential_json.startswith('[') and potential_json.endswith(']') and \
+            potential_json.count('[') == potential_json.count(']') and \
+            potential_json.count('{') == potential_json.count('}'):
+              cleaned_response_text = potential_json
+    return cleaned_response_text
+
+def parse_model_tiers(spec):
+    # "modelo_barato, modelo_potente" -> tupla ordenada sin repetidos; vacío -> el modelo de siempre.
+    tiers = []
+    for name in re.split(r'[,\n>]+', spec or ""):
+        name = name.strip()
+        if name and name not in tiers: tiers.append(name)
+    return tuple(tiers) or (GEMINI_MODEL_FALLBACK,)
+
+_tier_stats_lock = threading.Lock()
+def record_tier_usage(tier_stats, model_name, **amounts):
+    if tier_stats is None: return
+    with _tier_stats_lock: tier_stats[model_name].update(amounts)
+
+_parse_stats_lock = threading.Lock()
+def record_parse_path(parse_stats, parse_path):
+    if parse_stats is None: return
+    with _parse_stats_lock: parse_stats[parse_path] += 1
+
 def normalize_component_name(name):
     if not isinstance(name, str): return "Desconocido"
     name_lower = ' '.join(name.lower().strip().split())
@@ -255,28 +789,72 @@ def normalize_component_name(name):
 
     return "Desconocido"
 
+ACCIONES_ESTANDAR_LOWER = {a.lower(): a for a in ACCIONES_ESTANDAR}
+
+def normalize_action_name(action):
+    # -> (acción estándar, reconocida). Sin palabra clave reconocida se asume 'Revision/Neutra'.
+    acc_lower = str(action).lower().strip()
+    if acc_lower in ACCIONES_ESTANDAR_LOWER: return ACCIONES_ESTANDAR_LOWER[acc_lower], True
+    if any(kw in acc_lower for kw in ['instalacion', 'instala', 'instalar', 'inst', 'agrega', 'colocacion', 'activacion', 'conectar', 'nuevo', 'puesta en marcha', 'se instalo', 'se puso', 'instalación nueva', 'se le instala', 'se asigna', 'se le aplica', 'con instalacion de', 'se coloca']): return "Instalacion", True
+    if any(kw in acc_lower for kw in ['desinstalacion', 'desinstala', 'desinstalar', 'retiro', 'quita', 'baja', 'eliminar', 'desconectar', 'se retiro', 'se quito', 'retiro de', 'desisntalacion', 'equipo perdido', 'se da de baja', 'se retira', 'no regresa', 'baja en plataforma', 'desistalacion', 'desinstalación']): return "Desinstalacion", True
+    if any(kw in acc_lower for kw in ['cambio', 'cambiar', 'reemplazo', 'reemplazar', 'sustitucion', 'sustituir', 'se hace cambio de', 'se cambia', 'cambiio']): return "Reemplazo", True
+    if any(kw in acc_lower for kw in ['medicion de tanque', 'medir tanque', 'calibracion tanque', 'aforar', 'aforo', 'verificacion de nivel', 'medicion inicial', 'registro de nivel', 'chequeo de nivel', 'se midio el tanque', 'medicion diesel', 'medicion gasolina', 'se tomaron niveles', 'medición de nivel']): return "Medicion Tanque", True
+    if any(kw in acc_lower for kw in ['revision', 'revisar', 'mantenimiento', 'diagnostico', 'chequeo', 'verificacion', 'configuracion', 'falla', 'problema', 'ajuste', 'soporte', 'prueba', 'limpieza', 'actualizacion', 'no funciona', 'reporta', 'visita tecnica', 'reset', 'se hizo un reset', 'se checa', 'se verifica', 'se conecta', 'se reconecta', 'energizada', 'reubicó', 'desconecta arnes', 'se aplica reset', 'se cambia conexion', 'se cambia tierra', 'se cambia corriente', 'reacomodan', 'calibracion', 'cotejo', 'se fija', 'se ajusta', 'revisan conexiones', 'se energiza', 'se restablece', 'se monitorea', 'se reubica', 'se corrige', 'se repara', 'se activa', 'se asigna este equipo', 'se recupera equipo']): return "Revision/Neutra", True
+    return "Revision/Neutra", False
+
+def normalize_result_item(item, log_prefix=None):
+    # Un elemento de la respuesta del modelo -> (resultado normalizado, dudoso, estructura válida).
+    # Dudoso = evento con formato inválido o componente 'Desconocido' (la cascada lo escala). Sin log_prefix no se registra nada.
+    if not (isinstance(item, dict) and "eventos_detectados" in item and isinstance(item["eventos_detectados"], list)):
+        if log_prefix: update_log_display(f"{log_prefix}] WARN: Formato resultado inválido: {str(item)[:100]}. Usando vacío.", level="WARNING")
+        return {"eventos_detectados": []}, True, False
+    normalized_events = []
+    is_doubtful = False
+    for event_idx, event in enumerate(item["eventos_detectados"]):
+        if isinstance(event, dict) and "componente" in event and "accion" in event:
+            comp = normalize_component_name(event.get("componente"))
+            acc_raw = event.get("accion")
+            accesorio_id_raw = event.get("accesorio_id")
+            accesorio_id_str = (", ".join(str(x).strip() for x in accesorio_id_raw if x is not None and str(x).strip())
+                                if isinstance(accesorio_id_raw, list)
+                                else (str(accesorio_id_raw).strip() if accesorio_id_raw is not None and str(accesorio_id_raw).strip() else None))
+            acc_norm, acc_known = normalize_action_name(acc_raw)
+            if not acc_known and log_prefix:
+                update_log_display(f"{log_prefix} Ev {event_idx+1}] WARN: Acción '{acc_raw}' no estándar. Default: 'Revision/Neutra'.", level="WARNING")
+
+            if comp != "Desconocido":
+                normalized_events.append({"componente": comp, "accion": acc_norm, "accesorio_id": accesorio_id_str})
+            else:
+                if log_prefix: update_log_display(f"{log_prefix} Ev {event_idx+1}] INFO: Comp. '{event.get('componente')}' desconocido. Ignorando.", level="INFO")
+                is_doubtful = True
+        else:
+            if log_prefix: update_log_display(f"{log_prefix} Ev {event_idx+1}] WARN: Formato evento inválido: {str(event)[:100]}. Ignorando.", level="WARNING")
+            is_doubtful = True
+    return {"eventos_detectados": normalized_events}, is_doubtful, True
+
 total_batches_global = 0
 
-def extract_events_with_gemini(genai_client, descriptions_batch, batch_index, retries=2, delay=5):
+def extract_events_with_gemini(key_pool, descriptions_batch, batch_index, retries=2, parse_stats=None, retry_stats=None, defer_retryable=False,
+                               model_name=GEMINI_MODEL_FALLBACK, tier_stats=None, escalate_positions=None, doubtful_positions_out=None):
+    # escalate_positions (lista): se rellena con las posiciones cuyo resultado es dudoso (estructura inválida, componente
+    # desconocido, lote forzado) para que la cascada las reenvíe al siguiente modelo; un lote de longitud incorrecta sube sin reintentar.
+    # doubtful_positions_out (lista): solo registra las posiciones dudosas (último nivel), sin cambiar reintentos ni avisos.
     global total_batches_global
     update_log_display(f"Entering extract_events_with_gemini for batch {batch_index + 1}", level="DEBUG")
+    _, glm = gemini_sdk()
 
-    if not genai_client:
+    if not key_pool:
         error_msg = f"[Lote {batch_index + 1}] CRITICAL: Cliente Gemini no inicializado."
         update_log_display(error_msg, level="CRITICAL")
         return [{"eventos_detectados": []} for _ in range(len(descriptions_batch))]
 
-    model_name = "gemini-1.5-flash-latest"
-    try:
-        model = genai_client.GenerativeModel(model_name)
-        update_log_display(f"[Lote {batch_index + 1}] Gemini model '{model_name}' initialized.", level="DEBUG")
-    except Exception as model_error:
-        error_msg = f"[Lote {batch_index + 1}] CRITICAL: Error al inicializar modelo Gemini '{model_name}': {model_error}. Traceback: {traceback.format_exc()}"
-        update_log_display(error_msg, level="CRITICAL")
-        return [{"eventos_detectados": []} for _ in range(len(descriptions_batch))]
-
-    prompt = build_gemini_prompt(descriptions_batch)
+    component_mapping = select_component_mapping(descriptions_batch)
+    prompt = build_gemini_prompt(descriptions_batch, component_mapping)
+    estimated_tokens = len(prompt) // 4 + 80 * len(descriptions_batch)
     update_log_display(f"\n===== Lote {batch_index + 1}/{total_batches_global} (Tamaño: {len(descriptions_batch)}) =====", level="INFO")
+    saved_mapping_chars = MAPEO_PROMPT_FULL_CHARS - len(compact_component_mapping(component_mapping))
+    update_log_display(f"[Lote {batch_index + 1}] Mapeo en prompt: {len(component_mapping)}/{len(MAPEO_COMPONENTES)} alias. "
+                       f"~{saved_mapping_chars // 4} tokens de entrada menos ({saved_mapping_chars / (len(prompt) + saved_mapping_chars):.0%} del prompt completo).", level="INFO")
 
     attempt = 0
     last_error = None
@@ -290,23 +868,49 @@ def extract_events_with_gemini(genai_client, descriptions_batch, batch_index, re
 
         try:
             spinner_msg = f"Lote {batch_index + 1}/{total_batches_global}: Llamando a Gemini (Intento {attempt + 1}/{retries + 1})..."
-            with st.spinner(spinner_msg):
-                if attempt > 0:
-                    sleep_time = delay * (2 ** attempt)
-                    update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Esperando {sleep_time}s antes de reintentar...", level="INFO")
-                    time.sleep(sleep_time)
-
-                api_call_start_time = time.time()
+            report_progress(None, spinner_msg)
+            if attempt > 0:
+                retry_category = classify_retry_error(last_error)
+                sleep_time = retry_backoff_delay(retry_category, attempt - 1, retry_after_hint(last_error))
+                record_retry_event(retry_stats, retry_category)
+                update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Esperando {sleep_time:.1f}s antes de reintentar ({retry_category})...", level="INFO")
+                time.sleep(sleep_time)
+
+            # Con el circuito abierto (API saturada) no se despacha; una sola llamada de prueba decide si se reanuda.
+            current_job = get_current_job()
+            circuit_wait, is_probe = key_pool.circuit_breaker.wait_for_dispatch(should_abort=lambda: current_job is not None and current_job.cancel_requested)
+            if circuit_wait >= 1:
+                record_retry_event(retry_stats, "espera_cortacircuitos_s", circuit_wait)
+                update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Despacho pausado {circuit_wait:.1f}s por el cortacircuitos{' (llamada de prueba)' if is_probe else ''}.", level="INFO")
+            try: lease = key_pool.acquire(estimated_tokens)
+            except NoGeminiKeyAvailable:
+                if is_probe: key_pool.circuit_breaker.cancel_probe()
+                raise
+            api_call_start_time = time.time()
+            try:
+                model = key_pool.get_model(lease, model_name)
                 response_obj = model.generate_content(
                     prompt,
-                    generation_config=genai.types.GenerationConfig(
-                        temperature=0.05,
-                        response_mime_type="application/json",
-                    ),
+                    generation_config=build_generation_config(),
                     request_options={'timeout': 300}
                  )
-                api_call_end_time = time.time()
-                update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Llamada a API completada en {api_call_end_time - api_call_start_time:.2f}s.", level="INFO")
+            except Exception as api_error:
+                error_class = key_pool.release(lease, error=api_error)
+                if error_class:
+                    update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] API Key {lease['slot']['label']} en cuarentena ({'permanente' if error_class == 'permanent' else 'temporal, cuota'}): {api_error}", level="WARNING")
+                api_error_category = classify_retry_error(api_error)
+                if key_pool.circuit_breaker.record(api_error_category in ("rate_limit", "transient"), retry_after_hint(api_error), probe=is_probe):
+                    record_retry_event(retry_stats, "aperturas_cortacircuitos")
+                    update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Cortacircuitos ABIERTO: tasa de errores de API alta; se pausa el despacho ~{max(0.0, key_pool.circuit_breaker.open_until - time.time()):.1f}s.", level="WARNING")
+                record_tier_usage(tier_stats, model_name, llamadas=1, errores=1, segundos=time.time() - api_call_start_time)
+                raise
+            key_pool.circuit_breaker.record(False, probe=is_probe)
+            usage_metadata = getattr(response_obj, 'usage_metadata', None)
+            key_pool.release(lease, actual_tokens=getattr(usage_metadata, 'total_token_count', None) or None)
+            api_call_end_time = time.time()
+            record_tier_usage(tier_stats, model_name, llamadas=1, segundos=api_call_end_time - api_call_start_time,
+                              tokens_entrada=getattr(usage_metadata, 'prompt_token_count', 0) or 0, tokens_salida=getattr(usage_metadata, 'candidates_token_count', 0) or 0)
+            update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Llamada a API completada en {api_call_end_time - api_call_start_time:.2f}s (API Key {lease['slot']['label']}).", level="INFO")
 
             if response_obj:
                 if hasattr(response_obj, 'prompt_feedback') and response_obj.prompt_feedback:
@@ -326,7 +930,7 @@ def extract_events_with_gemini(genai_client, descriptions_batch, batch_index, re
                     if hasattr(response_obj, 'parts') and response_obj.parts:
                         raw_response_text = response_obj.text.strip()
                     elif hasattr(response_obj, 'candidates') and response_obj.candidates and \
-                        response_obj.candidates[0].finish_reason not in [genai.types.Candidate.FinishReason.STOP, genai.types.Candidate.FinishReason.MAX_TOKENS]:
+                        response_obj.candidates[0].finish_reason not in [glm.Candidate.FinishReason.STOP, glm.Candidate.FinishReason.MAX_TOKENS]:
                         finish_reason_candidate = response_obj.candidates[0].finish_reason
                         update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Respuesta con finish_reason problemático: '{finish_reason_candidate.name if hasattr(finish_reason_candidate, 'name') else finish_reason_candidate}'. Podría estar bloqueada o incompleta.", level="WARNING")
                         raw_response_text = ""
@@ -359,11 +963,11 @@ def extract_events_with_gemini(genai_client, descriptions_batch, batch_index, re
                     block_reason_detail = getattr(response_obj.prompt_feedback, 'block_reason', "UNKNOWN")
                     update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Respuesta vacía. Prompt Feedback indica bloqueo: {block_reason_detail}. No se reintentará.", level="ERROR")
                 elif response_obj and hasattr(response_obj, 'candidates') and response_obj.candidates:
-                    candidate_finish_reason = getattr(response_obj.candidates[0], 'finish_reason', genai.types.Candidate.FinishReason.UNSPECIFIED)
+                    candidate_finish_reason = getattr(response_obj.candidates[0], 'finish_reason', glm.Candidate.FinishReason.UNSPECIFIED)
                     problematic_reasons = [
-                        genai.types.Candidate.FinishReason.SAFETY,
-                        genai.types.Candidate.FinishReason.RECITATION,
-                        genai.types.Candidate.FinishReason.OTHER
+                        glm.Candidate.FinishReason.SAFETY,
+                        glm.Candidate.FinishReason.RECITATION,
+                        glm.Candidate.FinishReason.OTHER
                     ]
                     if candidate_finish_reason in problematic_reasons:
                         is_blocked_response = True
@@ -382,33 +986,28 @@ def extract_events_with_gemini(genai_client, descriptions_batch, batch_index, re
                     continue
 
 
-            cleaned_response_text = raw_response_text
-            match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', cleaned_response_text, re.IGNORECASE)
-            if match: cleaned_response_text = match.group(1).strip()
-
-            first_bracket = cleaned_response_text.find('[')
-            last_bracket = cleaned_response_text.rfind(']')
-            if first_bracket != -1 and last_bracket != -1 and last_bracket > first_bracket:
-                 potential_json = cleaned_response_text[first_bracket : last_bracket + 1]
-                 if potential_json.startswith('[') and potential_json.endswith(']') and \
-                    potential_json.count('[') == potential_json.count(']') and \
-                    potential_json.count('{') == potential_json.count('}'):
-                      cleaned_response_text = potential_json
-
-            update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Respuesta Limpiada (intentada para parseo):\n---\n{cleaned_response_text[:500]}...\n---", level="DEBUG")
-
+            persist_raw_response(model_name, descriptions_batch, raw_response_text, batch_index)
             current_results = None
             try:
-                if not cleaned_response_text: raise json.JSONDecodeError("Cadena vacía para parsear JSON", "", 0)
-                current_results = json.loads(cleaned_response_text)
+                current_results = fast_json_loads(raw_response_text)
+                record_parse_path(parse_stats, "directo")
                 update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Parseo JSON exitoso.", level="INFO")
-            except json.JSONDecodeError as json_e:
-                last_error = json_e
-                context_around_error = cleaned_response_text[max(0, json_e.pos-20):min(len(cleaned_response_text), json_e.pos+20)]
-                last_error_details = f"Pos: {json_e.pos}, Line: {json_e.lineno}, Col: {json_e.colno}. Contexto: '...{context_around_error}...'. Texto (500c): {cleaned_response_text[:500]}..."
-                update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Error Parseo JSON: {json_e}. Det: {last_error_details}", level="ERROR")
-                attempt += 1
-                continue
+            except json.JSONDecodeError:
+                cleaned_response_text = repair_json_response_text(raw_response_text)
+                update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Respuesta no es JSON directo. Reparando (intentada para parseo):\n---\n{cleaned_response_text[:500]}...\n---", level="DEBUG")
+                try:
+                    if not cleaned_response_text: raise json.JSONDecodeError("Cadena vacía para parsear JSON", "", 0)
+                    current_results = json.loads(cleaned_response_text)
+                    record_parse_path(parse_stats, "reparado")
+                    update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Parseo JSON exitoso tras reparación.", level="WARNING")
+                except json.JSONDecodeError as json_e:
+                    record_parse_path(parse_stats, "fallido")
+                    last_error = json_e
+                    context_around_error = cleaned_response_text[max(0, json_e.pos-20):min(len(cleaned_response_text), json_e.pos+20)]
+                    last_error_details = f"Pos: {json_e.pos}, Line: {json_e.lineno}, Col: {json_e.colno}. Contexto: '...{context_around_error}...'. Texto (500c): {cleaned_response_text[:500]}..."
+                    update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Error Parseo JSON: {json_e}. Det: {last_error_details}", level="ERROR")
+                    attempt += 1
+                    continue
 
             if not isinstance(current_results, list):
                 last_error = TypeError(f"Respuesta JSON no es lista. Tipo: {type(current_results)}")
@@ -421,7 +1020,8 @@ def extract_events_with_gemini(genai_client, descriptions_batch, batch_index, re
                 last_error = ValueError(f"Longitud JSON incorrecta (Esperada: {len(descriptions_batch)}, Recibida: {len(current_results)}).")
                 last_error_details = f"Primeros elementos: {str(current_results[:5])}" if current_results else "Lista vacía."
                 update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Error: {last_error}", level="WARNING")
-                if attempt < retries:
+                # En la cascada no se insiste con el mismo modelo: el lote completo sube al siguiente nivel.
+                if attempt < retries and escalate_positions is None:
                     attempt += 1
                     continue
                 else:
@@ -433,56 +1033,34 @@ def extract_events_with_gemini(genai_client, descriptions_batch, batch_index, re
             update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Longitud OK. Validando estructura y normalizando...", level="INFO")
             temp_validated_results = []
             valid_structure_overall = True
+            doubtful_positions = []
             for i, item in enumerate(current_results):
-                if isinstance(item, dict) and "eventos_detectados" in item and isinstance(item["eventos_detectados"], list):
-                    normalized_events = []
-                    for event_idx, event in enumerate(item["eventos_detectados"]):
-                        if isinstance(event, dict) and "componente" in event and "accion" in event:
-                            comp = normalize_component_name(event.get("componente"))
-                            acc_raw = event.get("accion")
-                            accesorio_id_raw = event.get("accesorio_id")
-                            accesorio_id_str = (", ".join(str(x).strip() for x in accesorio_id_raw if x is not None and str(x).strip())
-                                                if isinstance(accesorio_id_raw, list)
-                                                else (str(accesorio_id_raw).strip() if accesorio_id_raw is not None and str(accesorio_id_raw).strip() else None))
-
-                            acc_norm = "Revision/Neutra"
-                            acc_lower = str(acc_raw).lower().strip()
-                            acciones_estandar_lower_map = {a.lower(): a for a in ACCIONES_ESTANDAR}
-
-                            if acc_lower in acciones_estandar_lower_map:
-                                acc_norm = acciones_estandar_lower_map[acc_lower]
-                            else:
-                                if any(kw in acc_lower for kw in ['instalacion', 'instala', 'instalar', 'inst', 'agrega', 'colocacion', 'activacion', 'conectar', 'nuevo', 'puesta en marcha', 'se instalo', 'se puso', 'instalación nueva', 'se le instala', 'se asigna', 'se le aplica', 'con instalacion de', 'se coloca']): acc_norm = "Instalacion"
-                                elif any(kw in acc_lower for kw in ['desinstalacion', 'desinstala', 'desinstalar', 'retiro', 'quita', 'baja', 'eliminar', 'desconectar', 'se retiro', 'se quito', 'retiro de', 'desisntalacion', 'equipo perdido', 'se da de baja', 'se retira', 'no regresa', 'baja en plataforma', 'desistalacion', 'desinstalación']): acc_norm = "Desinstalacion"
-                                elif any(kw in acc_lower for kw in ['cambio', 'cambiar', 'reemplazo', 'reemplazar', 'sustitucion', 'sustituir', 'se hace cambio de', 'se cambia', 'cambiio']): acc_norm = "Reemplazo"
-                                elif any(kw in acc_lower for kw in ['medicion de tanque', 'medir tanque', 'calibracion tanque', 'aforar', 'aforo', 'verificacion de nivel', 'medicion inicial', 'registro de nivel', 'chequeo de nivel', 'se midio el tanque', 'medicion diesel', 'medicion gasolina', 'se tomaron niveles', 'medición de nivel']): acc_norm = "Medicion Tanque"
-                                elif any(kw in acc_lower for kw in ['revision', 'revisar', 'mantenimiento', 'diagnostico', 'chequeo', 'verificacion', 'configuracion', 'falla', 'problema', 'ajuste', 'soporte', 'prueba', 'limpieza', 'actualizacion', 'no funciona', 'reporta', 'visita tecnica', 'reset', 'se hizo un reset', 'se checa', 'se verifica', 'se conecta', 'se reconecta', 'energizada', 'reubicó', 'desconecta arnes', 'se aplica reset', 'se cambia conexion', 'se cambia tierra', 'se cambia corriente', 'reacomodan', 'calibracion', 'cotejo', 'se fija', 'se ajusta', 'revisan conexiones', 'se energiza', 'se restablece', 'se monitorea', 'se reubica', 'se corrige', 'se repara', 'se activa', 'se asigna este equipo', 'se recupera equipo']): acc_norm = "Revision/Neutra"
-                                else:
-                                    update_log_display(f"[Lote {batch_index + 1} Desc {i+1} Ev {event_idx+1}] WARN: Acción '{acc_raw}' no estándar. Default: 'Revision/Neutra'.", level="WARNING")
-
-                            if comp != "Desconocido":
-                                normalized_events.append({"componente": comp, "accion": acc_norm, "accesorio_id": accesorio_id_str})
-                            else:
-                                update_log_display(f"[Lote {batch_index + 1} Desc {i+1} Ev {event_idx+1}] INFO: Comp. '{event.get('componente')}' desconocido. Ignorando.", level="INFO")
-                        else:
-                            update_log_display(f"[Lote {batch_index + 1} Desc {i+1} Ev {event_idx+1}] WARN: Formato evento inválido: {str(event)[:100]}. Ignorando.", level="WARNING")
-                    temp_validated_results.append({"eventos_detectados": normalized_events})
-                else:
-                    update_log_display(f"[Lote {batch_index + 1} Desc {i+1}] WARN: Formato resultado inválido: {str(item)[:100]}. Usando vacío.", level="WARNING")
-                    temp_validated_results.append({"eventos_detectados": []})
-                    valid_structure_overall = False
-
+                normalized_item, is_doubtful, valid_structure = normalize_result_item(item, log_prefix=f"[Lote {batch_index + 1} Desc {i+1}")
+                temp_validated_results.append(normalized_item)
+                if not valid_structure: valid_structure_overall = False
+                if is_doubtful: doubtful_positions.append(i)
+            if escalate_positions is not None: escalate_positions.extend(sorted(set(doubtful_positions)))
+            if doubtful_positions_out is not None: doubtful_positions_out.extend(sorted(set(doubtful_positions)))
             validated_results = temp_validated_results
             msg_level = "INFO" if valid_structure_overall else "WARNING"
             update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Éxito {'completo' if valid_structure_overall else 'parcial'}. Estructura y normalización OK.", level=msg_level)
             update_log_display(f"Exiting extract_events_with_gemini for batch {batch_index + 1} successfully after {attempt + 1} attempts.", level="DEBUG")
             return validated_results
 
+        except NoGeminiKeyAvailable as e:
+            last_error = e
+            last_error_details = str(e)
+            update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Sin API Keys disponibles: {e}", level="CRITICAL")
+            break
         except Exception as e:
             last_error = e
             last_error_details = traceback.format_exc()
-            update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Error Inesperado: {e.__class__.__name__}: {e}", level="ERROR")
+            error_category = classify_retry_error(e)
+            update_log_display(f"[Lote {batch_index + 1} Intento {attempt + 1}] Error {error_category}: {e.__class__.__name__}: {e}", level="ERROR")
             update_log_display(f"Traceback: {last_error_details}", level="DEBUG")
+            if defer_retryable and error_category in ("rate_limit", "transient"):
+                # No se duerme aquí: el lote vuelve al final de la cola y el resto del trabajo sigue.
+                raise BatchDeferred(error_category, retry_after_hint(e), e)
 
         attempt += 1
         if attempt <= retries:
@@ -491,11 +1069,12 @@ def extract_events_with_gemini(genai_client, descriptions_batch, batch_index, re
     if validated_results is None or len(validated_results) != len(descriptions_batch):
         final_error_msg = f"[Lote {batch_index + 1}] CRITICAL: Fallaron todos los intentos ({attempt}) o la longitud final es incorrecta."
         if last_error: final_error_msg += f" Último error: {last_error.__class__.__name__}: {last_error}."
-        update_log_display(final_error_msg, level="CRITICAL")
+        if escalate_positions is not None: final_error_msg += " Se escalará el lote al siguiente modelo."
+        update_log_display(final_error_msg, level="WARNING" if escalate_positions is not None else "CRITICAL")
         if last_error_details: update_log_display(f"Últimos detalles del error: {last_error_details}", level="DEBUG")
 
         num_received_display = len(validated_results) if validated_results and isinstance(validated_results, list) else 0
-        st.warning(f"Problema con el Lote {batch_index + 1} después de {attempt} intento(s). Se recibieron {num_received_display} de {len(descriptions_batch)} resultados. Se usarán los resultados recibidos y se rellenará el resto con placeholders vacíos. Último error: {last_error}.")
+        if escalate_positions is None: notify_user(f"Problema con el Lote {batch_index + 1} después de {attempt} intento(s). Se recibieron {num_received_display} de {len(descriptions_batch)} resultados. Se usarán los resultados recibidos y se rellenará el resto con placeholders vacíos. Último error: {last_error}.")
 
         forced_results = []
         num_received_for_forcing = len(validated_results) if validated_results and isinstance(validated_results, list) else 0
@@ -508,226 +1087,1899 @@ def extract_events_with_gemini(genai_client, descriptions_batch, batch_index, re
             else:
                 forced_results.append({"eventos_detectados": []})
         update_log_display(f"Exiting extract_events_with_gemini for batch {batch_index + 1} WITH FORCED RESULTS (parciales + placeholders).", level="WARNING")
+        if escalate_positions is not None: escalate_positions.extend(range(len(descriptions_batch)))
+        if doubtful_positions_out is not None: doubtful_positions_out.extend(range(len(descriptions_batch)))
         return forced_results
 
     update_log_display(f"Exiting extract_events_with_gemini for batch {batch_index + 1} successfully (results from loop).", level="DEBUG")
     return validated_results
 
-
-def process_data(df_filtered, api_key, imei_col, desc_col, date_col, client_col, batch_size=25):
+def extract_events_with_model_cascade(key_pool, descriptions_batch, batch_index, model_tiers=None, tier_stats=None, defer_retryable=False, **kwargs):
+    # Todo el lote va al primer modelo; solo las descripciones dudosas (o un lote fallido/de longitud incorrecta) suben de nivel.
+    # Devuelve (resultados, posiciones que siguen dudosas tras el último nivel); ambos se comparten con los seguidores del single-flight.
+    model_tiers = model_tiers or (GEMINI_MODEL_FALLBACK,)
+    results = [None] * len(descriptions_batch)
+    positions = list(range(len(descriptions_batch)))
+    final_doubtful = []
+    for tier_idx, model_name in enumerate(model_tiers):
+        is_last_tier = tier_idx == len(model_tiers) - 1
+        doubtful = []
+        # Solo el primer nivel puede aplazar el lote completo; una escalada ya pagó la llamada barata y reintenta en línea.
+        # El último nivel (o un modelo único) no escala: conserva reintentos y avisos normales y solo cuenta sus dudosas.
+        tier_results = extract_events_with_gemini(key_pool, [descriptions_batch[pos] for pos in positions], batch_index, model_name=model_name, tier_stats=tier_stats,
+                                                  escalate_positions=None if is_last_tier else doubtful, doubtful_positions_out=doubtful if is_last_tier else None,
+                                                  defer_retryable=defer_retryable and tier_idx == 0, **kwargs)
+        doubtful = set(doubtful)
+        for k, (pos, result) in enumerate(zip(positions, tier_results)):
+            # Una respuesta dudosa y vacía del nivel superior (p.ej. lote fallido) no pisa lo que sí dio el nivel anterior.
+            if results[pos] is None or k not in doubtful or result.get("eventos_detectados"): results[pos] = result
+        escalated = [] if is_last_tier else sorted(doubtful)
+        if is_last_tier: final_doubtful = sorted(positions[k] for k in doubtful)
+        record_tier_usage(tier_stats, model_name, descripciones=len(positions), escaladas=len(escalated), dudosas_final=0 if not is_last_tier else len(doubtful))
+        if not escalated: break
+        update_log_display(f"[Lote {batch_index + 1}] {len(escalated)}/{len(positions)} desc. escaladas de {model_name} a {model_tiers[tier_idx + 1]} "
+                           f"(validación, longitud o componente desconocido).", level="INFO")
+        positions = [positions[k] for k in escalated]
+    return results, final_doubtful
+
+
+def build_checkpoint_key(file_hash, filters, settings):
+    # Huella estable del archivo + filtros + ajustes que determinan el contenido de cada lote.
+    payload = json.dumps({"file_hash": file_hash, "filters": filters, "settings": settings}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:24]
+
+def get_checkpoint_path(checkpoint_key):
+    return os.path.join(CHECKPOINT_DIR, f"analisis_{checkpoint_key}.jsonl")
+
+def load_checkpoint(checkpoint_path):
+    completed_batches = {}
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return completed_batches
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line: continue
+            try:
+                record = json.loads(line)
+                completed_batches[int(record["batch_index"])] = record
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                # Una línea truncada (p.ej. corte a mitad de escritura) invalida solo ese lote.
+                update_log_display(f"Checkpoint '{checkpoint_path}' línea {line_number} ilegible ({e}). Se reprocesará ese lote.", level="WARNING")
+    return completed_batches
+
+def checkpoint_batch_digest(descriptions_batch):
+    # Contenido del lote: si la lista de trabajo cambió (p. ej. filas nuevas tras actualizar el almacén), el registro no se reutiliza.
+    return hashlib.sha256(json.dumps(list(descriptions_batch), ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+def append_checkpoint(checkpoint_path, batch_index, row_start, row_end, batch_results, descriptions_batch):
+    if not checkpoint_path: return
+    record = {"batch_index": batch_index, "row_start": row_start, "row_end": row_end, "batch_digest": checkpoint_batch_digest(descriptions_batch),
+              "saved_at": datetime.datetime.now().isoformat(timespec='seconds'), "results": batch_results}
+    try:
+        os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+        with open(checkpoint_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush(); os.fsync(f.fileno())
+    except OSError as e:
+        update_log_display(f"No se pudo escribir checkpoint del lote {batch_index + 1} en '{checkpoint_path}': {e}", level="WARNING")
+
+def checkpoint_record_matches(checkpoint_record, row_start, row_end, descriptions_batch):
+    return checkpoint_record is not None and checkpoint_record.get("row_start") == row_start and checkpoint_record.get("row_end") == row_end \
+        and len(checkpoint_record.get("results") or []) == row_end - row_start and checkpoint_record.get("batch_digest") == checkpoint_batch_digest(descriptions_batch)
+
+def templatize_description(description):
+    # "SE PUSO POWER HUB #868" -> ("SE PUSO POWER HUB #<NUM_1>", {"<NUM_1>": "868"}); el mismo ID repetido reutiliza su marcador.
+    id_values, placeholder_by_value, type_counts = {}, {}, collections.Counter()
+    def to_placeholder(match):
+        value = match.group(0)
+        if value.upper() not in placeholder_by_value:
+            type_counts[match.lastgroup] += 1
+            placeholder = f"<{match.lastgroup}_{type_counts[match.lastgroup]}>"
+            placeholder_by_value[value.upper()] = placeholder
+            id_values[placeholder] = value
+        return placeholder_by_value[value.upper()]
+    return ID_TEMPLATE_RE.sub(to_placeholder, description), id_values
+
+def restore_template_ids(template_result, id_values):
+    # Devuelve el resultado de la plantilla con los IDs reales de una fila; marcadores inventados por el modelo se descartan.
+    restored_events = []
+    for event in template_result.get("eventos_detectados") or []:
+        accesorio_id = event.get("accesorio_id")
+        if accesorio_id and ID_PLACEHOLDER_RE.search(accesorio_id):
+            accesorio_id = ID_PLACEHOLDER_RE.sub(lambda m: id_values.get(m.group(0), ""), accesorio_id)
+            accesorio_id = re.sub(r'(?:\s*,\s*){2,}', ', ', accesorio_id).strip(' ,/') or None
+        restored_events.append({**event, "accesorio_id": accesorio_id})
+    return {"eventos_detectados": restored_events}
+
+def label_text_key(description):
+    # Clave de similitud: plantilla sin IDs, minúsculas, sin acentos y con espacios colapsados.
+    template, _ = templatize_description(str(description))
+    text = unicodedata.normalize('NFKD', template.lower()).encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'\s+', ' ', re.sub(r'[^a-z0-9<>_]+', ' ', text)).strip()
+
+def label_action_cues(text_key):
+    # Máscara de bits con las familias de LABEL_ACTION_CUE_PREFIXES presentes (la primera que coincide por palabra).
+    cues = 0
+    for word in text_key.split():
+        for bit, prefixes in enumerate(LABEL_ACTION_CUE_PREFIXES):
+            if word.startswith(prefixes):
+                cues |= 1 << bit
+                break
+    return cues
+
+def to_placeholder_result(result, id_values):
+    # Inverso de restore_template_ids: los IDs reales de la descripción vuelven a su marcador antes de guardar la etiqueta.
+    if not id_values: return result
+    placeholder_by_value = {value: placeholder for placeholder, value in id_values.items()}
+    value_re = re.compile("|".join(re.escape(value) for value in sorted(placeholder_by_value, key=len, reverse=True)))
+    return {"eventos_detectados": [{**event, "accesorio_id": value_re.sub(lambda m: placeholder_by_value[m.group(0)], event["accesorio_id"]) if event.get("accesorio_id") else event.get("accesorio_id")}
+                                   for event in result.get("eventos_detectados") or []]}
+
+class LabelSimilarityIndex:
+    # MinHash (3-gramas de caracteres) + LSH por bandas: cada consulta solo compara contra los candidatos
+    # que comparten alguna banda, por lo que el costo no crece con el tamaño total del corpus.
+    MERSENNE_PRIME = (1 << 31) - 1
+
+    def __init__(self, store_path, num_perm=LABEL_MINHASH_PERMUTATIONS, bands=LABEL_LSH_BANDS):
+        self.store_path = store_path
+        self.num_perm, self.bands, self.rows_per_band = num_perm, bands, num_perm // bands
+        rng = np.random.default_rng(20240601) # semilla fija: firmas estables entre procesos
+        self.perm_a = rng.integers(1, self.MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.perm_b = rng.integers(0, self.MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        self.action_cues = np.zeros(1024, dtype=np.uint8)
+        self.results = []
+        self.exact_ids = {}
+        self.buckets = [collections.defaultdict(list) for _ in range(bands)]
+        self.lock = threading.Lock()
+        self.load_errors = 0
+        if store_path and os.path.exists(store_path):
+            with open(store_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self._insert(record["clave"], {"eventos_detectados": record["eventos_detectados"]})
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        self.load_errors += 1
+
+    @property
+    def size(self):
+        return len(self.results)
+
+    def signature(self, text_key):
+        padded = f" {text_key} "
+        shingles = {padded[i:i + 3] for i in range(max(1, len(padded) - 2))}
+        hashes = np.fromiter((zlib.crc32(sh.encode('utf-8')) for sh in shingles), dtype=np.uint64, count=len(shingles))
+        return ((self.perm_a[:, None] * hashes[None, :] + self.perm_b[:, None]) % self.MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows_per_band:(band + 1) * self.rows_per_band].tobytes() for band in range(self.bands)]
+
+    def _insert(self, text_key, result):
+        if text_key in self.exact_ids:
+            self.results[self.exact_ids[text_key]] = result
+            return False
+        entry_id = len(self.results)
+        if entry_id == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.zeros_like(self.signatures)])
+            self.action_cues = np.concatenate([self.action_cues, np.zeros_like(self.action_cues)])
+        signature = self.signature(text_key)
+        self.signatures[entry_id] = signature
+        self.action_cues[entry_id] = label_action_cues(text_key)
+        self.results.append(result)
+        self.exact_ids[text_key] = entry_id
+        for band, band_key in enumerate(self._band_keys(signature)): self.buckets[band][band_key].append(entry_id)
+        return True
+
+    def add(self, text_key, result):
+        with self.lock:
+            if not self._insert(text_key, result): return
+            if self.store_path:
+                os.makedirs(os.path.dirname(self.store_path) or ".", exist_ok=True)
+                with open(self.store_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({"clave": text_key, "eventos_detectados": result["eventos_detectados"]}, ensure_ascii=False) + "\n")
+
+    def query(self, text_key, threshold):
+        # -> (resultado, similitud estimada) del vecino más parecido con similitud ≥ threshold, o None.
+        with self.lock:
+            if text_key in self.exact_ids: return self.results[self.exact_ids[text_key]], 1.0
+            signature = self.signature(text_key)
+            candidates = set()
+            for band, band_key in enumerate(self._band_keys(signature)): candidates.update(self.buckets[band].get(band_key, ()))
+            if not candidates: return None
+            candidate_ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            candidate_ids = candidate_ids[self.action_cues[candidate_ids] == label_action_cues(text_key)]
+            if candidate_ids.size == 0: return None
+            similarities = (self.signatures[candidate_ids] == signature).mean(axis=1)
+            best = int(similarities.argmax())
+            if similarities[best] < threshold: return None
+            return self.results[int(candidate_ids[best])], float(similarities[best])
+
+@st.cache_resource
+def get_label_index(store_path):
+    # Un índice por proceso; se carga del JSONL una vez y crece con cada lote validado.
+    return LabelSimilarityIndex(store_path)
+
+class RawResponseStore:
+    # JSONL de solo-agregar con cada respuesta cruda del modelo y las descripciones del lote que la produjo.
+    # En memoria se indexa por descripción enviada -> {modelo: elemento crudo}; la respuesta más reciente de cada modelo gana.
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.items = {}
+        self.lock = threading.Lock()
+        self.records = 0
+        self.unaligned = 0 # respuestas que no se pueden alinear con sus descripciones (JSON inválido o longitud distinta)
+        self.load_errors = 0
+        if store_path and os.path.exists(store_path):
+            with open(store_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try: self._index(json.loads(line))
+                    except (json.JSONDecodeError, KeyError, TypeError): self.load_errors += 1
+
+    def _index(self, record):
+        self.records += 1
+        try: parsed = fast_json_loads(record["respuesta"])
+        except json.JSONDecodeError:
+            try: parsed = json.loads(repair_json_response_text(record["respuesta"]))
+            except json.JSONDecodeError: parsed = None
+        if not isinstance(parsed, list) or len(parsed) != len(record["descripciones"]):
+            self.unaligned += 1
+            return
+        for description, item in zip(record["descripciones"], parsed):
+            self.items.setdefault(description, {})[record["modelo"]] = item
+
+    def append(self, model_name, descriptions, raw_response_text):
+        record = {"fecha": datetime.datetime.now().isoformat(timespec='seconds'), "modelo": model_name,
+                  "descripciones": list(descriptions), "respuesta": raw_response_text}
+        with self.lock:
+            self._index(record)
+            if self.store_path:
+                os.makedirs(os.path.dirname(self.store_path) or ".", exist_ok=True)
+                with open(self.store_path, 'a', encoding='utf-8') as f: f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def lookup(self, description):
+        with self.lock: return dict(self.items.get(description, {}))
+
+    @property
+    def size(self):
+        return len(self.items)
+
+@st.cache_resource
+def get_raw_response_store(store_path):
+    return RawResponseStore(store_path)
+
+def persist_raw_response(model_name, descriptions_batch, raw_response_text, batch_index):
+    # Un fallo al guardar no debe tumbar el lote: la respuesta ya está en memoria.
+    try: get_raw_response_store(RAW_RESPONSE_STORE_PATH).append(model_name, descriptions_batch, raw_response_text)
+    except OSError as e: update_log_display(f"[Lote {batch_index + 1}] No se pudo guardar la respuesta cruda en '{RAW_RESPONSE_STORE_PATH}': {e}", level="WARNING")
+
+class SingleFlightGroup:
+    # Coalescencia de lotes idénticos en vuelo: la primera llamada con una clave la ejecuta (líder); las que llegan
+    # mientras sigue en curso (otras sesiones/trabajos con el mismo export) esperan y reciben su propia copia.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, follower_fallback=(), **kwargs):
+        # -> (resultado, compartido). Las excepciones del líder se propagan a todos los que esperaban, salvo las de
+        # follower_fallback: con esas el seguidor ejecuta la llamada por su cuenta (p.ej. un aplazamiento que él ya no puede hacer).
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader: future = self._in_flight[key] = Future()
+            else: self.shared += 1
+        if not is_leader:
+            try: return copy.deepcopy(future.result()), True
+            except follower_fallback:
+                with self._lock: self.shared -= 1
+                return fn(*args, **kwargs), False
+        try:
+            result = fn(*args, **kwargs)
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock: self._in_flight.pop(key, None)
+
+@st.cache_resource
+def get_batch_single_flight():
+    # Uno por proceso: compartido por todas las sesiones de Streamlit.
+    return SingleFlightGroup()
+
+def build_batch_flight_key(descriptions_batch, model_tiers):
+    # Huella del contenido del lote: mismo texto y misma cascada de modelos => misma respuesta esperada.
+    payload = json.dumps({"descripciones": list(descriptions_batch), "modelos": list(model_tiers or ())}, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def extract_events_with_label_reuse(key_pool, descriptions_batch, batch_index, label_index=None, reuse_threshold=None, parse_stats=None, retry_stats=None, defer_retryable=False,
+                                    model_tiers=None, tier_stats=None):
+    # Devuelve (resultados, n_reutilizados). Descripciones con una etiqueta similar guardada no se envían a Gemini.
+    batch_id_values = [templatize_description(desc)[1] for desc in descriptions_batch]
+    batch_text_keys = [label_text_key(desc) for desc in descriptions_batch]
+    results = [None] * len(descriptions_batch)
+    if label_index is not None and reuse_threshold is not None:
+        for pos, text_key in enumerate(batch_text_keys):
+            match = label_index.query(text_key, reuse_threshold)
+            if match is not None:
+                stored_result, similarity = match
+                results[pos] = restore_template_ids(stored_result, batch_id_values[pos])
+                update_log_display(f"[Lote {batch_index + 1} Desc {pos + 1}] Etiqueta reutilizada (similitud {similarity:.2f}). Desc: \"{descriptions_batch[pos][:40]}...\"", level="DEBUG")
+    pending_positions = [pos for pos, res in enumerate(results) if res is None]
+    reused_count = len(descriptions_batch) - len(pending_positions)
+    if pending_positions:
+        pending_descriptions = [descriptions_batch[pos] for pos in pending_positions]
+        (api_results, doubtful_positions), shared = get_batch_single_flight().do(build_batch_flight_key(pending_descriptions, model_tiers), extract_events_with_model_cascade,
+                                                           key_pool, pending_descriptions, batch_index, model_tiers=model_tiers, tier_stats=tier_stats,
+                                                           parse_stats=parse_stats, retry_stats=retry_stats, defer_retryable=defer_retryable,
+                                                           follower_fallback=() if defer_retryable else (BatchDeferred,))
+        if shared:
+            record_retry_event(retry_stats, "lotes_compartidos")
+            update_log_display(f"[Lote {batch_index + 1}] {len(pending_descriptions)} desc. idénticas a un lote en curso en otra sesión/trabajo: se comparte su llamada a Gemini.", level="INFO")
+        doubtful_positions = set(doubtful_positions)
+        for k, (pos, result) in enumerate(zip(pending_positions, api_results)):
+            results[pos] = result
+            # Solo se guardan resultados con eventos y no dudosos en el último nivel: ni placeholders de un lote fallido,
+            # ni componentes "Desconocido", ni respuestas de un nivel inferior que escaló sin que el superior las confirmara.
+            if label_index is not None and k not in doubtful_positions and result.get("eventos_detectados"):
+                label_index.add(batch_text_keys[pos], to_placeholder_result(result, batch_id_values[pos]))
+    else:
+        update_log_display(f"[Lote {batch_index + 1}] Todas las descripciones ({len(descriptions_batch)}) resueltas con etiquetas guardadas. Sin llamada a la API.", level="INFO")
+    return results, reused_count
+
+def replay_raw_responses(descriptions_batch, batch_index, raw_store, model_tiers=None, replay_stats=None):
+    # Re-normalización sin API: cada descripción toma su respuesta cruda guardada y pasa por las reglas actuales.
+    # Con varias respuestas (cascada) se sigue el mismo criterio: la primera no dudosa en el orden de la cascada.
+    results = []
+    for description in descriptions_batch:
+        stored = raw_store.lookup(description)
+        if not stored:
+            results.append({"eventos_detectados": [], "sin_respuesta": True})
+            record_parse_path(replay_stats, "sin_respuesta")
+            continue
+        ordered_models = [m for m in (model_tiers or ()) if m in stored] + [m for m in stored if m not in (model_tiers or ())]
+        chosen = None
+        for model_name in ordered_models:
+            result, is_doubtful, _ = normalize_result_item(stored[model_name])
+            if chosen is None or not is_doubtful or result["eventos_detectados"]: chosen = result
+            if not is_doubtful: break
+        results.append(chosen)
+        record_parse_path(replay_stats, "reproducidas")
+    update_log_display(f"[Lote {batch_index + 1}] Re-normalizadas {len(descriptions_batch)} desc. desde respuestas guardadas.", level="DEBUG")
+    return results, 0
+
+def run_in_job_context(job, fn, *args, **kwargs):
+    # Los hilos auxiliares (extracción paralela) heredan el trabajo del hilo que los lanzó para log/avisos.
+    _job_context.job = job
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _job_context.job = None
+
+# --- Materialización columnar de eventos ---
+EVENT_COLUMNS = ["IMEI", "Fecha", "Cliente", "Componente", "Accion", "Accesorio_ID", "Descripcion_Original"]
+
+def build_event_chunk(batch_results, batch_members, row_id_values):
+    # Aplana los resultados de un lote: conteo de eventos por fila, posiciones de fila repetidas y listas de componente/acción/ID.
+    row_blocks, components, actions, accessory_ids = [], [], [], []
+    for result_for_template, members in zip(batch_results, batch_members):
+        template_events = (result_for_template or {}).get("eventos_detectados") or []
+        if not template_events or not members: continue
+        plain_members = [row_pos for row_pos in members if not row_id_values[row_pos]]
+        if plain_members:
+            # Filas sin IDs que restituir comparten los eventos de la plantilla tal cual.
+            row_blocks.append(np.repeat(np.asarray(plain_members, dtype=np.int64), len(template_events)))
+            components.extend([event["componente"] for event in template_events] * len(plain_members))
+            actions.extend([event["accion"] for event in template_events] * len(plain_members))
+            accessory_ids.extend([event.get("accesorio_id") for event in template_events] * len(plain_members))
+        for row_pos in members:
+            if not row_id_values[row_pos]: continue
+            row_events = restore_template_ids(result_for_template, row_id_values[row_pos])["eventos_detectados"]
+            row_blocks.append(np.full(len(row_events), row_pos, dtype=np.int64))
+            components.extend(event["componente"] for event in row_events)
+            actions.extend(event["accion"] for event in row_events)
+            accessory_ids.extend(event.get("accesorio_id") for event in row_events)
+    return {"row_pos": np.concatenate(row_blocks) if row_blocks else np.empty(0, dtype=np.int64),
+            "Componente": components, "Accion": actions, "Accesorio_ID": accessory_ids}
+
+def build_fallback_event_chunk(row_positions, row_keys, fallback_events):
+    # Re-normalización: las filas sin respuesta cruda guardada conservan los eventos que ya tenían en el almacén de filas.
+    if not len(row_positions) or row_keys is None or fallback_events is None or fallback_events.empty: return None
+    rows = pd.DataFrame({"Row_Hash": np.asarray(row_keys, dtype=object)[row_positions], "row_pos": np.asarray(row_positions, dtype=np.int64)})
+    matched = rows.merge(fallback_events[["Row_Hash", "Componente", "Accion", "Accesorio_ID"]], on="Row_Hash", how="inner", sort=False)
+    return {"row_pos": matched["row_pos"].to_numpy(dtype=np.int64),
+            **{col: matched[col].astype(object).where(matched[col].notna(), None).tolist() for col in ("Componente", "Accion", "Accesorio_ID")}}
+
+def materialize_event_chunks(event_chunks, row_columns, row_keys=None, sort_rows=True, include_row_pos=False):
+    # Un solo DataFrame a partir de los búferes: las columnas de fila se toman por posición (sin un dict por evento).
+    row_pos = np.concatenate([chunk["row_pos"] for chunk in event_chunks]) if event_chunks else np.empty(0, dtype=np.int64)
+    order = np.argsort(row_pos, kind="stable") if sort_rows else np.arange(len(row_pos)) # orden original de filas, estable dentro de cada fila
+    row_pos = row_pos[order]
+    event_values = {col: np.asarray([value for chunk in event_chunks for value in chunk[col]], dtype=object)[order] if len(row_pos) else np.empty(0, dtype=object)
+                    for col in ("Componente", "Accion", "Accesorio_ID")}
+    events_df = pd.DataFrame({col: (row_columns[col][row_pos] if col in row_columns else event_values[col]) for col in EVENT_COLUMNS})
+    if "IMEI_Key" in row_columns: events_df["IMEI_Key"] = row_columns["IMEI_Key"][row_pos] # clave de equipo de la ingesta (no se recalcula al agrupar)
+    if row_keys is not None: events_df["Row_Hash"] = np.asarray(row_keys, dtype=object)[row_pos] if len(row_pos) else np.empty(0, dtype=object)
+    if include_row_pos: events_df["Fila_Pos"] = row_pos
+    return events_df
+
+EVENT_SPILL_SCHEMA = pa.schema([("IMEI", pa.string()), ("Fecha", pa.timestamp('ns')), ("Cliente", pa.string()), ("Componente", pa.string()),
+                                 ("Accion", pa.string()), ("Accesorio_ID", pa.string()), ("Descripcion_Original", pa.string()),
+                                 ("IMEI_Key", pa.uint64()), ("Row_Hash", pa.string()), ("Fila_Pos", pa.int64())])
+
+class EventSpillSink:
+    # Cada lote se escribe como un row group; en memoria solo vive el lote en curso.
+    def __init__(self, path, row_positions=None):
+        self.path = path
+        self.row_positions = None if row_positions is None else np.asarray(row_positions, dtype=np.int64) # posición local -> posición en las filas de origen
+        self.count = 0
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def append(self, events_chunk, remap_positions=True):
+        if events_chunk is None or events_chunk.empty: return
+        chunk = events_chunk.reindex(columns=EVENT_SPILL_SCHEMA.names)
+        chunk["IMEI_Key"] = frame_device_keys(events_chunk)
+        chunk["Fecha"] = pd.to_datetime(chunk["Fecha"], errors='coerce')
+        for col in ["IMEI", "Cliente", "Componente", "Accion", "Accesorio_ID", "Descripcion_Original", "Row_Hash"]:
+            chunk[col] = chunk[col].astype(object).where(chunk[col].notna(), None).map(lambda v: v if v is None else str(v))
+        if remap_positions and self.row_positions is not None and "Fila_Pos" in events_chunk.columns: chunk["Fila_Pos"] = self.row_positions[events_chunk["Fila_Pos"].to_numpy()]
+        table = pa.Table.from_pandas(chunk, schema=EVENT_SPILL_SCHEMA, preserve_index=False)
+        with self._lock:
+            if self._writer is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._writer = pq.ParquetWriter(self.path, EVENT_SPILL_SCHEMA)
+            self._writer.write_table(table)
+            self.count += len(chunk)
+
+    def close(self):
+        with self._lock:
+            if self._writer is None: pq.write_table(EVENT_SPILL_SCHEMA.empty_table(), self.path) # archivo válido aunque no haya eventos
+            else: self._writer.close()
+            self._writer = None
+
+def iter_event_chunks(events, columns=None, chunk_rows=EVENT_SPILL_CHUNK_ROWS):
+    # Mismo recorrido para un DataFrame en memoria (un solo fragmento) o un archivo de eventos volcado a disco.
+    if events is None: return
+    if isinstance(events, pd.DataFrame):
+        yield events if columns is None else events[[c for c in columns if c in events.columns]]
+        return
+    parquet_file = pq.ParquetFile(events, memory_map=True)
+    available = set(parquet_file.schema_arrow.names)
+    for record_batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=None if columns is None else [c for c in columns if c in available]):
+        yield record_batch.to_pandas()
+
+def read_spilled_events(path, imei=None, limit=None):
+    # Lee por fragmentos y conserva solo lo pedido (un IMEI o las primeras 'limit' filas).
+    parts, kept = [], 0
+    for chunk in iter_event_chunks(path):
+        if imei is not None: chunk = chunk[frame_device_keys(chunk) == imei_device_keys([imei])[0]]
+        if limit is not None: chunk = chunk.head(limit - kept)
+        if not chunk.empty: parts.append(chunk); kept += len(chunk)
+        if limit is not None and kept >= limit: break
+    events = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=EVENT_SPILL_SCHEMA.names)
+    if "Fila_Pos" in events.columns: events = events.sort_values(["Fila_Pos"], kind="mergesort").reset_index(drop=True)
+    for col in ["Cliente", "Accesorio_ID"]: events[col] = events[col].fillna('').astype(str) # igual que los eventos en memoria
+    return events.drop(columns=[c for c in ("Row_Hash", "Fila_Pos") if c in events.columns])
+
+def spilled_event_count(path):
+    return pq.ParquetFile(path).metadata.num_rows
+
+def order_templates_by_client(row_template_codes, row_clients):
+    # Modo progresivo: las descripciones únicas se programan cliente por cliente (primero el que menos necesita) y cada
+    # plantilla va con el primer cliente que la usa. -> (orden de plantillas, cliente por fila, nombres, pares plantilla-cliente)
+    client_codes, client_names = pd.factorize(pd.Series(row_clients, dtype=object).astype(str), sort=True)
+    pairs = np.unique(np.stack([np.asarray(row_template_codes, dtype=np.int64), client_codes.astype(np.int64)], axis=1), axis=0)
+    client_work = np.bincount(pairs[:, 1], minlength=len(client_names))
+    client_rank = np.empty(len(client_names), dtype=np.int64)
+    client_rank[np.lexsort((np.arange(len(client_names)), client_work))] = np.arange(len(client_names))
+    template_rank = np.full(int(pairs[:, 0].max()) + 1 if len(pairs) else 0, len(client_names), dtype=np.int64)
+    np.minimum.at(template_rank, pairs[:, 0], client_rank[pairs[:, 1]])
+    return np.argsort(template_rank, kind="stable"), client_codes, list(client_names), pairs
+
+def publish_client_progress(job, client_name, client_event_chunks, row_columns, reused_events, keep_events, clients_done, clients_total):
+    # Cliente con todas sus filas resueltas: sus eventos y su estado ya no cambian en este análisis.
+    events_client = materialize_event_chunks(client_event_chunks, row_columns)
+    if reused_events is not None and not reused_events.empty:
+        reused_client = reused_events[reused_events["Cliente"].astype(str) == client_name]
+        if not reused_client.empty:
+            events_client = pd.concat([events_client, reused_client[list(events_client.columns)]], ignore_index=True)
+            events_client['Fecha'] = pd.to_datetime(events_client['Fecha'], errors='coerce')
+    state_client = calculate_current_state(events_client) if not events_client.empty else pd.DataFrame()
+    if job is not None: job.publish_client_result(client_name, events_client if keep_events else None, state_client)
+    update_log_display(f"Cliente '{client_name}' finalizado ({clients_done}/{clients_total}): {len(events_client)} evento(s), {len(state_client)} equipo(s) en el estado parcial.", level="INFO")
+
+def process_data(df_filtered, api_keys, imei_col, desc_col, date_col, client_col, batch_size=25, checkpoint_path=None, resume=False,
+                 rpm_limit=None, tpm_limit=None, template_clustering=True, label_reuse_threshold=None, row_keys=None, event_sink=None, model_tiers=None,
+                 renormalize=False, progressive_clients=False, client_reused_events=None, fallback_events=None):
     global total_batches_global
     update_log_display(f"Entering process_data. Rows: {len(df_filtered)}, Batch size: {batch_size}", level="DEBUG")
 
-    genai_client = get_gemini_client(api_key)
-    st.session_state.processing_complete = False
-
-    if not genai_client:
+    # renormalize: sin API; cada descripción se resuelve con su respuesta cruda guardada y las reglas de normalización actuales.
+    key_pool = None if renormalize else get_gemini_client(api_keys, rpm_limit, tpm_limit)
+    raw_store = get_raw_response_store(RAW_RESPONSE_STORE_PATH) if renormalize else None
+    replay_stats = collections.Counter()
+    parse_stats = collections.Counter()
+    retry_stats = collections.Counter()
+    model_tiers = tuple(model_tiers or parse_model_tiers(GEMINI_MODEL_TIERS_DEFAULT))
+    tier_stats = collections.defaultdict(collections.Counter)
+    label_index = get_label_index(LABEL_STORE_PATH)
+    descriptions_reused = 0
+    if label_reuse_threshold is not None:
+        update_log_display(f"Reutilización de etiquetas: {label_index.size} descripciones validadas en '{LABEL_STORE_PATH}' (umbral {label_reuse_threshold:.2f}).", level="INFO")
+
+    if renormalize:
+        update_log_display(f"Re-normalización: {raw_store.size} descripciones con respuesta cruda en '{RAW_RESPONSE_STORE_PATH}' "
+                           f"({raw_store.records} respuestas, {raw_store.unaligned} no alineables). Sin llamadas a la API.", level="INFO")
+    elif not key_pool:
         error_msg = "CRITICAL: Cliente Gemini no inicializado. Verifique API Key. Procesamiento detenido."
-        update_log_display(error_msg, level="CRITICAL"); st.error(error_msg)
+        update_log_display(error_msg, level="CRITICAL"); notify_user(error_msg, level="error")
         return pd.DataFrame(columns=["IMEI", "Fecha", "Cliente", "Componente", "Accion", "Accesorio_ID", "Descripcion_Original"]), error_msg
 
     update_log_display(f"Cols: IMEI='{imei_col}', Cliente='{client_col}', Desc='{desc_col}', Fecha='{date_col}'", level="INFO")
     update_log_display(f"Batch Size: {batch_size}", level="INFO")
+    update_log_display(f"Cascada de modelos: {' → '.join(model_tiers)}" + (" (sin escalado)." if len(model_tiers) == 1 else "."), level="INFO")
 
-    all_extracted_events = []
     total_rows = len(df_filtered)
-    event_cols = ["IMEI", "Fecha", "Cliente", "Componente", "Accion", "Accesorio_ID", "Descripcion_Original"]
+    event_cols = EVENT_COLUMNS
 
     if total_rows == 0:
         no_data_msg = "No hay datos válidos para procesar con los filtros actuales."
-        update_log_display(no_data_msg, level="WARNING"); st.warning(no_data_msg)
-        st.session_state.processing_complete = True
+        update_log_display(no_data_msg, level="WARNING"); notify_user(no_data_msg)
         return pd.DataFrame(columns=event_cols), no_data_msg
 
+    # Unidad de trabajo = descripción única (o plantilla con IDs como marcadores); cada fila toma el resultado de la suya.
+    row_descriptions = df_filtered[desc_col].fillna('').astype(str).tolist()
+    row_id_values = [{} for _ in row_descriptions]
+    if template_clustering:
+        templated = [templatize_description(desc) for desc in row_descriptions]
+        row_descriptions = [template for template, _ in templated]
+        row_id_values = [id_values for _, id_values in templated]
+    row_template_codes, work_descriptions = pd.factorize(pd.Series(row_descriptions, dtype=object), sort=False)
+    work_descriptions = work_descriptions.tolist()
+    template_members = [[] for _ in work_descriptions]
+    for row_pos, template_code in enumerate(row_template_codes): template_members[template_code].append(row_pos)
+    total_work_items = len(work_descriptions)
+    update_log_display(f"Agrupación {'por plantilla (IDs → marcadores)' if template_clustering else 'por descripción exacta'}: {total_rows} filas → {total_work_items} descripciones únicas a enviar "
+                       f"({1 - total_work_items / total_rows:.0%} menos).", level="INFO")
+    # Columnas de fila una sola vez; los eventos guardan solo la posición de su fila y se materializan al final.
+    if "IMEI_Key" in df_filtered.columns and df_filtered["IMEI_Key"].dtype == np.uint64: row_imeis, row_device_keys = df_filtered[imei_col].to_numpy(dtype=object), df_filtered["IMEI_Key"].to_numpy()
+    else:
+        # Sin la clave de la ingesta (llamada directa): IMEI canónico y clave en una sola pasada.
+        imei_canonical = canonicalize_imeis(df_filtered[imei_col])
+        row_imeis, row_device_keys = imei_canonical["IMEI"].to_numpy(dtype=object), device_keys_from_canonical(imei_canonical)
+    row_columns = {"IMEI": row_imeis, "IMEI_Key": row_device_keys, "Fecha": df_filtered[date_col].to_numpy(),
+                   "Cliente": df_filtered[client_col].to_numpy(dtype=object), "Descripcion_Original": df_filtered[desc_col].to_numpy(dtype=object)}
+    event_chunks = [] # un búfer columnar por lote: posiciones de fila + componente/acción/ID aplanados
+    total_events = 0
+    completed_row_positions = [] # filas de lotes con resultado válido (no vacío forzado)
+
+    job = get_current_job()
+    client_pending = None
+    if progressive_clients and total_work_items:
+        # Reordena las plantillas por cliente; cada cliente se finaliza cuando se consumen todas sus plantillas.
+        template_order, row_client_codes, client_names, template_client_pairs = order_templates_by_client(row_template_codes, row_columns["Cliente"])
+        work_descriptions = [work_descriptions[t] for t in template_order]
+        template_members = [template_members[t] for t in template_order]
+        new_template_code = np.empty(len(template_order), dtype=np.int64); new_template_code[template_order] = np.arange(len(template_order))
+        template_client_pairs[:, 0] = new_template_code[template_client_pairs[:, 0]]
+        template_client_pairs = template_client_pairs[np.argsort(template_client_pairs[:, 0], kind="stable")]
+        template_clients = np.split(template_client_pairs[:, 1], np.flatnonzero(np.diff(template_client_pairs[:, 0])) + 1)
+        client_pending = np.bincount(template_client_pairs[:, 1], minlength=len(client_names))
+        client_event_chunks = collections.defaultdict(list)
+        clients_done = 0
+        reused_only_clients = []
+        if client_reused_events is not None and not client_reused_events.empty:
+            reused_only_clients = sorted(set(client_reused_events["Cliente"].astype(str)) - set(client_names))
+        clients_total = len(client_names) + len(reused_only_clients)
+        if job is not None: job.clients_total = clients_total
+        update_log_display(f"Modo progresivo: {len(client_names)} cliente(s) programados uno a uno (menos descripciones primero); "
+                           f"el estado de cada cliente se publica al completar sus filas.", level="INFO")
+        for client_name in reused_only_clients:
+            # Clientes sin filas nuevas: todo viene del almacén de filas, se publican de inmediato.
+            clients_done += 1
+            publish_client_progress(job, client_name, [], row_columns, client_reused_events, event_sink is None, clients_done, clients_total)
+
     processed_rows_count = 0
     batches_with_critical_issues = 0
-    total_batches_global = (total_rows + batch_size - 1) // batch_size
-
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    status_text.text(f"Iniciando {total_rows} filas en {total_batches_global} lotes...")
-    update_log_display(f"Total filas: {total_rows} ({total_batches_global} lotes de ~{batch_size})", level="INFO")
+    batches_resumed = 0
+    total_batches_global = (total_work_items + batch_size - 1) // batch_size
+
+    completed_batches = {}
+    if checkpoint_path:
+        if resume:
+            completed_batches = load_checkpoint(checkpoint_path)
+            update_log_display(f"Checkpoint '{checkpoint_path}': {len(completed_batches)} lote(s) completados previamente.", level="INFO")
+        elif os.path.exists(checkpoint_path):
+            try:
+                os.remove(checkpoint_path)
+                update_log_display(f"Checkpoint previo '{checkpoint_path}' descartado (sin reanudar).", level="INFO")
+            except OSError as e:
+                update_log_display(f"No se pudo descartar checkpoint previo '{checkpoint_path}': {e}", level="WARNING")
 
-    log_placeholder_key_base = "log_area_runtime_process_data"
-    log_placeholder = st.empty()
-    log_placeholder.text_area("Log de Procesamiento (Batch):", value=st.session_state.log_string, height=300, disabled=True, key=f"{log_placeholder_key_base}_initial")
+    report_progress(0.0, f"Iniciando {total_rows} filas ({total_work_items} descripciones únicas) en {total_batches_global} lotes...")
+    update_log_display(f"Total filas: {total_rows}. Descripciones únicas: {total_work_items} ({total_batches_global} lotes de ~{batch_size})", level="INFO")
 
     start_process_time = time.time()
 
-    for i in range(0, total_rows, batch_size):
-        batch_start_time = time.time()
+    # Los lotes pendientes se envían en paralelo (una ranura por clave usable del pool); el pool reparte
+    # cada llamada a la clave con más presupuesto RPM/TPM. Los resultados se consumen en orden de lote.
+    if renormalize: max_parallel_batches = 1
+    else:
+        max_parallel_batches = max(1, key_pool.usable_key_count() * key_pool.max_in_flight_per_key)
+        update_log_display(f"Extracción paralela: hasta {max_parallel_batches} lote(s) simultáneos con {key_pool.usable_key_count()} API Key(s).", level="INFO")
+    extraction_executor = ThreadPoolExecutor(max_workers=max_parallel_batches, thread_name_prefix="gemini-lote")
+    batch_futures = {}
+    for i in range(0, total_work_items, batch_size):
         current_batch_index = i // batch_size
-        batch_number = current_batch_index + 1
-
-        log_placeholder.text_area("Log de Procesamiento (Batch):", value=st.session_state.log_string, height=300, disabled=True, key=f"{log_placeholder_key_base}_{batch_number}")
-
-        batch_df = df_filtered.iloc[i:min(i + batch_size, total_rows)]
-        descriptions_batch = batch_df[desc_col].fillna('').astype(str).tolist()
-
-        if not descriptions_batch:
-             update_log_display(f"[Lote {batch_number}/{total_batches_global}] Omitiendo lote vacío.", level="WARNING")
-             continue
-
-        update_log_display(f"\n[Lote {batch_number}/{total_batches_global}] Procesando {len(descriptions_batch)} desc. (Índices DF: {batch_df.index[0]}-{batch_df.index[-1]}).", level="INFO")
-
-        batch_results = extract_events_with_gemini(genai_client, descriptions_batch, current_batch_index)
+        row_end = min(i + batch_size, total_work_items)
+        if checkpoint_record_matches(completed_batches.get(current_batch_index), i, row_end, work_descriptions[i:row_end]): continue
+        descriptions_batch = work_descriptions[i:row_end]
+        update_log_display(f"\n[Lote {current_batch_index + 1}/{total_batches_global}] Encolando {len(descriptions_batch)} desc. únicas (posiciones {i}-{row_end - 1}).", level="INFO")
+        if renormalize:
+            batch_futures[current_batch_index] = extraction_executor.submit(run_in_job_context, job, replay_raw_responses, descriptions_batch, current_batch_index, raw_store,
+                                                                            model_tiers=model_tiers, replay_stats=replay_stats)
+            continue
+        batch_futures[current_batch_index] = extraction_executor.submit(run_in_job_context, job, extract_events_with_label_reuse, key_pool, descriptions_batch, current_batch_index,
+                                                                label_index=label_index, reuse_threshold=label_reuse_threshold, parse_stats=parse_stats,
+                                                                retry_stats=retry_stats, defer_retryable=BATCH_MAX_DEFERRALS > 0, model_tiers=model_tiers, tier_stats=tier_stats)
+
+    # Cola de consumo: (lote, aplazamientos). Un lote con error reintentable de API vuelve al final y se sigue con el resto.
+    pending_batches = collections.deque((i // batch_size, 0) for i in range(0, total_work_items, batch_size))
+    batches_done = 0
+    try:
+        while pending_batches:
+            batch_start_time = time.time()
+            current_batch_index, batch_deferrals = pending_batches.popleft()
+            i = current_batch_index * batch_size
+            batch_number = current_batch_index + 1
+
+            if job is not None and job.cancel_requested:
+                update_log_display(f"Cancelación solicitada. Deteniendo antes del lote {batch_number}/{total_batches_global}.", level="WARNING")
+                break
+
+            row_end = min(i + batch_size, total_work_items)
+            descriptions_batch = work_descriptions[i:row_end]
+            batch_row_count = sum(len(template_members[t]) for t in range(i, row_end))
+
+            if not descriptions_batch:
+                 update_log_display(f"[Lote {batch_number}/{total_batches_global}] Omitiendo lote vacío.", level="WARNING")
+                 continue
+
+            checkpoint_record = completed_batches.get(current_batch_index)
+            if current_batch_index not in batch_futures:
+                update_log_display(f"\n[Lote {batch_number}/{total_batches_global}] Reanudado desde checkpoint ({len(descriptions_batch)} desc.). Sin llamada a la API.", level="INFO")
+                batch_results = checkpoint_record["results"]
+                batches_resumed += 1
+            else:
+                try:
+                    batch_results, batch_reused = batch_futures[current_batch_index].result()
+                except BatchDeferred as deferred:
+                    retry_wait = retry_backoff_delay(deferred.category, batch_deferrals, deferred.retry_after)
+                    is_last_deferral = batch_deferrals + 1 >= BATCH_MAX_DEFERRALS
+                    record_retry_event(retry_stats, "aplazados")
+                    record_retry_event(retry_stats, deferred.category)
+                    update_log_display(f"[Lote {batch_number}] Error {deferred.category} ({deferred.error.__class__.__name__}). Aplazado al final de la cola; reintento en ~{retry_wait:.1f}s"
+                                       f"{' (pista del servidor)' if deferred.retry_after else ''}, aplazamiento {batch_deferrals + 1}/{BATCH_MAX_DEFERRALS}.", level="WARNING")
+                    batch_futures[current_batch_index] = extraction_executor.submit(run_in_job_context, job, run_deferred_batch, time.time() + retry_wait, extract_events_with_label_reuse,
+                                                                                    key_pool, descriptions_batch, current_batch_index, label_index=label_index, reuse_threshold=label_reuse_threshold,
+                                                                                    parse_stats=parse_stats, retry_stats=retry_stats, defer_retryable=not is_last_deferral,
+                                                                                    model_tiers=model_tiers, tier_stats=tier_stats)
+                    pending_batches.append((current_batch_index, batch_deferrals + 1))
+                    continue
+                descriptions_reused += batch_reused
+                checkpoint_record = None
 
-        if batch_results is None or len(batch_results) != len(batch_df):
-            update_log_display(f"[Lote {batch_number}] CRITICAL ERROR: batch_results longitud {len(batch_results) if batch_results else 'None'} != esperada {len(batch_df)}. Omitiendo.", level="CRITICAL")
-            batches_with_critical_issues += 1
-        else:
-            update_log_display(f"[Lote {batch_number}] Mapeando resultados...", level="DEBUG")
-            is_batch_fully_dummied = all(not res.get("eventos_detectados") for res in batch_results)
-            if len(batch_df) > 0 and is_batch_fully_dummied:
-                 update_log_display(f"[Lote {batch_number}] INFO: Lote completo ({len(batch_df)} desc.) resultó en eventos vacíos (posible fallo API/bloqueo).", level="INFO")
-                 batches_with_critical_issues +=1
-
-            for original_df_idx, (_, row) in enumerate(batch_df.iterrows()):
-                result_for_row = batch_results[original_df_idx]
-
-                if result_for_row and "eventos_detectados" in result_for_row:
-                    if not result_for_row["eventos_detectados"]:
-                         update_log_display(f"[Lote {batch_number} Fila {original_df_idx+1} (DF Idx {row.name})] No eventos. Desc: \"{str(row[desc_col])[:30]}...\"", level="DEBUG")
-                    for event_idx, event in enumerate(result_for_row["eventos_detectados"]):
-                        all_extracted_events.append({
-                            "IMEI": row[imei_col], "Fecha": row[date_col], "Cliente": row[client_col],
-                            "Componente": event["componente"], "Accion": event["accion"],
-                            "Accesorio_ID": event.get("accesorio_id"), "Descripcion_Original": row[desc_col]
-                        })
+            if batch_results is None or len(batch_results) != len(descriptions_batch):
+                update_log_display(f"[Lote {batch_number}] CRITICAL ERROR: batch_results longitud {len(batch_results) if batch_results else 'None'} != esperada {len(descriptions_batch)}. Omitiendo.", level="CRITICAL")
+                batches_with_critical_issues += 1
+            else:
+                update_log_display(f"[Lote {batch_number}] Mapeando resultados a {batch_row_count} filas...", level="DEBUG")
+                is_batch_fully_dummied = all(not res.get("eventos_detectados") for res in batch_results)
+                if len(descriptions_batch) > 0 and is_batch_fully_dummied:
+                     update_log_display(f"[Lote {batch_number}] INFO: Lote completo ({len(descriptions_batch)} desc.) resultó en eventos vacíos (posible fallo API/bloqueo).", level="INFO")
+                     batches_with_critical_issues +=1
                 else:
-                    update_log_display(f"[Lote {batch_number} Fila {original_df_idx+1} (DF Idx {row.name})] WARN: Falta 'eventos_detectados'. Desc: \"{str(row[desc_col])[:30]}...\"", level="WARNING")
-            update_log_display(f"[Lote {batch_number}] Mapeo completado. {len(batch_df)} filas procesadas.", level="INFO")
-
-        processed_rows_count += len(batch_df)
-        progress = min(1.0, processed_rows_count / total_rows) if total_rows > 0 else 0.0
-        progress_bar.progress(progress)
-
-        batch_end_time = time.time()
-        elapsed_batch = batch_end_time - batch_start_time
-        total_elapsed = batch_end_time - start_process_time
-        avg_time_per_row = total_elapsed / processed_rows_count if processed_rows_count > 0 else 0
-        remaining_batches = total_batches_global - batch_number
-        if avg_time_per_row > 0 and remaining_batches > 0 :
-            avg_batch_time = total_elapsed / batch_number if batch_number > 0 else elapsed_batch
-            remaining_time = remaining_batches * avg_batch_time
-        elif elapsed_batch > 0 and remaining_batches > 0:
-            remaining_time = remaining_batches * elapsed_batch
-        else:
-            remaining_time = 0
-
-
-        status_text.text(f"Procesando: {processed_rows_count}/{total_rows}. Lote {batch_number}/{total_batches_global} ({elapsed_batch:.1f}s). Rest: ~{remaining_time:.0f}s")
-        update_log_display(f"Stats Lote {batch_number}: T Lote: {elapsed_batch:.2f}s. T Total: {total_elapsed:.2f}s. T Prom/Fila: {avg_time_per_row:.3f}s", level="DEBUG")
-
-        if batch_number < total_batches_global and batch_size > 10 : time.sleep(0.2)
+                    # Sin respuesta guardada (re-normalización) la fila no cuenta como analizada: conserva sus eventos previos.
+                    for t in range(i, row_end):
+                        if not batch_results[t - i].get("sin_respuesta"): completed_row_positions.extend(template_members[t])
+                    if checkpoint_record is None: append_checkpoint(checkpoint_path, current_batch_index, i, row_end, batch_results, descriptions_batch)
+
+                batch_chunk = build_event_chunk(batch_results, [template_members[t] for t in range(i, row_end)], row_id_values)
+                if renormalize:
+                    missing_positions = [pos for t in range(i, row_end) if batch_results[t - i].get("sin_respuesta") for pos in template_members[t]]
+                    fallback_chunk = build_fallback_event_chunk(missing_positions, row_keys, fallback_events)
+                    if fallback_chunk is not None and len(fallback_chunk["row_pos"]):
+                        batch_chunk = {"row_pos": np.concatenate([batch_chunk["row_pos"], fallback_chunk["row_pos"]]),
+                                       **{col: list(batch_chunk[col]) + fallback_chunk[col] for col in ("Componente", "Accion", "Accesorio_ID")}}
+                        replay_stats["eventos_almacen"] += len(fallback_chunk["row_pos"])
+                for batch_pos, result_for_template in enumerate(batch_results):
+                    if not (result_for_template and "eventos_detectados" in result_for_template):
+                        update_log_display(f"[Lote {batch_number} Desc {batch_pos+1}] WARN: Falta 'eventos_detectados'. Desc: \"{descriptions_batch[batch_pos][:30]}...\"", level="WARNING")
+                    elif not result_for_template["eventos_detectados"]:
+                        update_log_display(f"[Lote {batch_number} Desc {batch_pos+1}] No eventos. Desc: \"{descriptions_batch[batch_pos][:30]}...\"", level="DEBUG")
+                if client_pending is not None and len(batch_chunk["row_pos"]):
+                    chunk_clients = row_client_codes[batch_chunk["row_pos"]]
+                    for client_code in np.unique(chunk_clients):
+                        sel = np.flatnonzero(chunk_clients == client_code)
+                        client_event_chunks[client_code].append({"row_pos": batch_chunk["row_pos"][sel],
+                                                                 **{col: np.asarray(batch_chunk[col], dtype=object)[sel] for col in ("Componente", "Accion", "Accesorio_ID")}})
+                if len(batch_chunk["row_pos"]):
+                    # Con volcado a disco el lote se escribe y se descarta; si no, queda en los búferes en memoria.
+                    if event_sink is not None: event_sink.append(materialize_event_chunks([batch_chunk], row_columns, row_keys=row_keys, include_row_pos=True))
+                    else: event_chunks.append(batch_chunk)
+                    total_events += len(batch_chunk["row_pos"])
+                update_log_display(f"[Lote {batch_number}] Mapeo completado. {batch_row_count} filas procesadas.", level="INFO")
+                if job is not None:
+                    # Con volcado a disco solo se publica el conteo: los eventos ya están en el archivo y la memoria se mantiene plana.
+                    if event_sink is not None: job.publish_partial_events(None, event_count=len(batch_chunk["row_pos"]))
+                    else: job.publish_partial_events(materialize_event_chunks([batch_chunk], row_columns, sort_rows=False))
+
+            if client_pending is not None:
+                for t in range(i, row_end):
+                    for client_code in template_clients[t]:
+                        client_pending[client_code] -= 1
+                        if client_pending[client_code] == 0:
+                            clients_done += 1
+                            publish_client_progress(job, client_names[client_code], client_event_chunks.pop(client_code, []), row_columns,
+                                                    client_reused_events, event_sink is None, clients_done, clients_total)
+
+            processed_rows_count += batch_row_count
+            batches_done += 1
+            progress = min(1.0, processed_rows_count / total_rows) if total_rows > 0 else 0.0
+
+            batch_end_time = time.time()
+            elapsed_batch = batch_end_time - batch_start_time
+            total_elapsed = batch_end_time - start_process_time
+            avg_time_per_row = total_elapsed / processed_rows_count if processed_rows_count > 0 else 0
+            remaining_batches = len(pending_batches)
+            if avg_time_per_row > 0 and remaining_batches > 0 :
+                avg_batch_time = total_elapsed / batches_done
+                remaining_time = remaining_batches * avg_batch_time
+            elif elapsed_batch > 0 and remaining_batches > 0:
+                remaining_time = remaining_batches * elapsed_batch
+            else:
+                remaining_time = 0
+
+
+            report_progress(progress, f"Procesando: {processed_rows_count}/{total_rows}. Lote {batch_number}/{total_batches_global} ({elapsed_batch:.1f}s). Rest: ~{remaining_time:.0f}s")
+            update_log_display(f"Stats Lote {batch_number}: T Lote: {elapsed_batch:.2f}s. T Total: {total_elapsed:.2f}s. T Prom/Fila: {avg_time_per_row:.3f}s", level="DEBUG")
+    finally:
+        # Cancela lotes aún no iniciados (cancelación o error); los que ya están en vuelo terminan solos.
+        extraction_executor.shutdown(wait=False, cancel_futures=True)
+
+    for row_info in (key_pool.status_rows() if key_pool else []):
+        update_log_display(f"API Key {row_info['API Key']}: {row_info['Estado']}. Llamadas: {row_info['Llamadas']}, Errores: {row_info['Errores']}, Tokens: {row_info['Tokens totales']}.", level="INFO")
+    if set(retry_stats) - {"lotes_compartidos"}:
+        update_log_display(f"Reintentos: {retry_stats['rate_limit']} por límite de cuota (429), {retry_stats['transient']} transitorios (timeout/5xx), {retry_stats['parse']} por respuesta inválida, "
+                           f"{retry_stats['key']} por clave inválida. Lotes aplazados: {retry_stats['aplazados']}. Cortacircuitos abierto {retry_stats['aperturas_cortacircuitos']} vez/veces "
+                           f"(despacho pausado {retry_stats['espera_cortacircuitos_s']:.0f}s en total).", level="INFO")
+    if renormalize:
+        update_log_display(f"Re-normalización: {replay_stats['reproducidas']} desc. re-derivadas de respuestas guardadas, {replay_stats['sin_respuesta']} sin respuesta guardada "
+                           f"(sus filas toman los {replay_stats['eventos_almacen']} evento(s) que tenían en el almacén de filas y no se marcan como re-analizadas).",
+                           level="INFO" if not replay_stats['sin_respuesta'] else "WARNING")
+    if retry_stats['lotes_compartidos']:
+        update_log_display(f"Coalescencia: {retry_stats['lotes_compartidos']} lote(s) resueltos con la llamada en curso de otra sesión/trabajo (sin consumir cuota).", level="INFO")
+    for tier_idx, model_name in enumerate(model_tiers):
+        usage = tier_stats.get(model_name)
+        if not usage or not usage['descripciones']: continue
+        calls = usage['llamadas'] or 1
+        update_log_display(f"Nivel {tier_idx + 1} ({model_name}): {usage['descripciones']} desc. en {usage['llamadas']} llamada(s) ({usage['errores']} con error), latencia media {usage['segundos'] / calls:.2f}s, "
+                           f"tokens {usage['tokens_entrada']} entrada / {usage['tokens_salida']} salida. "
+                           + (f"Escaladas: {usage['escaladas']} ({usage['escaladas'] / usage['descripciones']:.0%})." if tier_idx < len(model_tiers) - 1
+                              else f"Dudosas sin más niveles: {usage['dudosas_final']}."), level="INFO")
+    parsed_total = sum(parse_stats.values())
+    if parsed_total:
+        update_log_display(f"Parseo de respuestas (con response_schema, {'orjson' if orjson is not None else 'json'}): "
+                           f"{parse_stats['directo']} directas, {parse_stats['reparado']} reparadas ({parse_stats['reparado'] / parsed_total:.0%}), {parse_stats['fallido']} fallidas.", level="INFO")
 
     end_process_time = time.time()
     total_duration = end_process_time - start_process_time
     update_log_display(f"\n--- Fin del Procesamiento IA ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---", level="INFO")
     update_log_display(f"Duración total IA: {total_duration:.2f} segundos.", level="INFO")
 
-    completion_message = f"Procesamiento IA completado. {len(all_extracted_events)} eventos extraídos de {total_rows} filas ({processed_rows_count} procesadas)."
+    completion_message = f"Procesamiento IA completado. {total_events} eventos extraídos de {total_rows} filas ({processed_rows_count} procesadas)."
+    if batches_resumed > 0:
+        completion_message += f" {batches_resumed}/{total_batches_global} lote(s) reanudados desde checkpoint."
+    if descriptions_reused > 0:
+        completion_message += f" {descriptions_reused}/{total_work_items} descripción(es) resueltas con etiquetas guardadas (sin API)."
     if batches_with_critical_issues > 0:
         completion_message += f" {batches_with_critical_issues}/{total_batches_global} lote(s) tuvieron problemas críticos y/o resultaron en datos vacíos forzados."
-        st.warning(f"{batches_with_critical_issues}/{total_batches_global} lote(s) con problemas. Resultados podrían ser placeholders. Revise log.")
-    elif total_rows > 0:
-        st.success("Todos los lotes procesados por IA.")
+        notify_user(f"{batches_with_critical_issues}/{total_batches_global} lote(s) con problemas. Resultados podrían ser placeholders. Revise log.")
+    elif total_rows > 0 and processed_rows_count == total_rows:
+        notify_user("Todos los lotes procesados por IA.", level="success")
+    if processed_rows_count < total_rows:
+        completion_message += f" Procesamiento interrumpido: {total_rows - processed_rows_count} fila(s) sin procesar."
 
-    status_text.text(completion_message)
+    report_progress(min(1.0, processed_rows_count / total_rows), completion_message)
     update_log_display(completion_message, level="INFO")
-    st.session_state.processing_complete = True
-
-    log_placeholder.text_area("Log de Procesamiento (Batch):", value=st.session_state.log_string, height=300, disabled=True, key=f"{log_placeholder_key_base}_final")
 
-    if not all_extracted_events:
+    # Claves de fila (p.ej. hash de contenido) de las filas efectivamente analizadas, para el almacén de filas.
+    completed_row_keys = [row_keys[pos] for pos in completed_row_positions] if row_keys is not None else []
+    if not total_events:
         final_msg = completion_message
         if total_rows > 0 and batches_with_critical_issues == total_batches_global: final_msg += " Todos los lotes fallaron críticamente."
         elif total_rows > 0: final_msg += " No se extrajeron eventos válidos."
         update_log_display(final_msg, level="WARNING")
-        return pd.DataFrame(columns=event_cols), final_msg
-
-    events_df = pd.DataFrame(all_extracted_events, columns=event_cols)
+        empty_events_df = pd.DataFrame(columns=event_cols + (["Row_Hash"] if row_keys is not None else []))
+        empty_events_df.attrs["completed_row_keys"] = completed_row_keys
+        return empty_events_df, final_msg
+
+    if event_sink is not None:
+        # Los eventos ya están en disco: se devuelve un marco vacío que apunta al archivo.
+        spilled_df = pd.DataFrame(columns=event_cols + (["Row_Hash"] if row_keys is not None else []))
+        spilled_df.attrs.update({"completed_row_keys": completed_row_keys, "events_path": event_sink.path})
+        update_log_display(f"Exiting process_data. {total_events} events spilled to '{event_sink.path}'.", level="DEBUG")
+        return spilled_df, completion_message
+
+    events_df = materialize_event_chunks(event_chunks, row_columns, row_keys=row_keys)
     try: events_df['Fecha'] = pd.to_datetime(events_df['Fecha'])
     except Exception as e: update_log_display(f"Error convirtiendo 'Fecha' final a datetime: {e}. Data: {events_df['Fecha'].head()}", level="ERROR")
 
     if 'Cliente' in events_df.columns: events_df['Cliente'] = events_df['Cliente'].fillna('').astype(str)
     if 'Accesorio_ID' in events_df.columns: events_df['Accesorio_ID'] = events_df['Accesorio_ID'].fillna('').astype(str)
 
+    events_df.attrs["completed_row_keys"] = completed_row_keys
     update_log_display(f"Exiting process_data. Extracted {len(events_df)} events.", level="DEBUG")
     return events_df, completion_message
 
+# --- IMEI canónico (clave entera por equipo) ---
+IMEI_LENGTH = 15
+IMEI_INVALID_KEY_BIT = np.uint64(1 << 63) # IMEIs válidos < 10^15: el bit alto distingue las claves de IMEIs inválidos (hash del texto)
+IMEI_LUHN_DOUBLED = np.arange(IMEI_LENGTH) % 2 == 1 # Luhn: cada segundo dígito desde la derecha = posiciones impares en 15 dígitos
+IMEI_POWERS = np.uint64(10) ** np.arange(IMEI_LENGTH - 1, -1, -1, dtype=np.uint64)
+
+def imei_digit_matrix(text):
+    # Vía rápida: textos de exactamente 15 dígitos ASCII -> (máscara, matriz de dígitos uint8), sin expresiones regulares.
+    # Con ancho fijo de 16 caracteres un texto más largo deja el carácter 16 no nulo (numpy trunca el resto).
+    codes = np.asarray(text, dtype=f"U{IMEI_LENGTH + 1}").view(np.uint32).reshape(-1, IMEI_LENGTH + 1)
+    digits = codes[:, :IMEI_LENGTH] - ord('0') # uint32: los caracteres anteriores a '0' dan valores enormes, no negativos
+    is_candidate = (digits <= 9).all(axis=1) & (codes[:, IMEI_LENGTH] == 0)
+    return is_candidate, digits[is_candidate].astype(np.uint8)
+
+def clean_imei_text(text):
+    # Vía lenta (solo textos que no son ya 15 dígitos): espacios/guiones, apóstrofo de Excel, '.0' de float y notación científica,
+    # que solo es recuperable si la mantisa conserva los 15 dígitos. -> (texto limpio, máscara de notación científica con pérdida)
+    text = text.str.strip().str.lstrip("'").str.replace(r'[\s\-]', '', regex=True).str.replace(r'(?<=\d)\.0+$', '', regex=True)
+    sci = text.str.extract(r'^(\d)(?:\.(\d+))?[eE]\+?(\d+)$')
+    sci_digits = (sci[0] + sci[1].fillna('')).where(sci[0].notna())
+    sci_exact = sci_digits.notna() & (sci_digits.str.len() == pd.to_numeric(sci[2], errors='coerce') + 1)
+    return text.where(~sci_exact, sci_digits), (sci_digits.notna() & ~sci_exact).to_numpy(dtype=bool)
+
+def canonicalize_imeis(values):
+    # Texto -> IMEI canónico de 15 dígitos con dígito de Luhn y clave uint64, vectorizado.
+    # Acepta lo que deja pandas al leer el CSV: '3.59632100000001e+14', '359632100000001.0', ' 3596 3210-0000001 '.
+    # -> DataFrame (mismo índice): IMEI (canónico, o el texto limpio si es inválido), IMEI_Key (0 si inválido), IMEI_Valido, Motivo.
+    raw = pd.Series(values, dtype=object)
+    text = raw.where(raw.notna(), '').astype(str).to_numpy(dtype=object)
+    is_candidate, digits = imei_digit_matrix(text)
+    sci_lossy = np.zeros(len(text), dtype=bool)
+    slow = np.flatnonzero(~is_candidate)
+    if len(slow):
+        cleaned, sci_lossy[slow] = clean_imei_text(pd.Series(text[slow], dtype=object))
+        text[slow] = cleaned.to_numpy(dtype=object)
+        is_candidate, digits = imei_digit_matrix(text)
+
+    keys = np.zeros(len(text), dtype=np.uint64)
+    luhn_ok = np.zeros(len(text), dtype=bool)
+    if len(digits):
+        doubled = np.where(IMEI_LUHN_DOUBLED, digits * 2, digits)
+        luhn_ok[is_candidate] = (np.where(doubled > 9, doubled - 9, doubled).sum(axis=1) % 10) == 0
+        keys[is_candidate] = digits.astype(np.uint64) @ IMEI_POWERS
+    is_valid = is_candidate & luhn_ok
+    keys[~is_valid] = 0
+
+    reason = np.where(is_candidate & ~luhn_ok, "dígito verificador (Luhn)", None).astype(object)
+    malformed = np.flatnonzero(~is_candidate)
+    if len(malformed):
+        malformed_text = pd.Series(text[malformed], dtype=object)
+        reason[malformed] = np.select([malformed_text.eq('').to_numpy(), sci_lossy[malformed], ~malformed_text.str.fullmatch(r'\d+').to_numpy(dtype=bool)],
+                                      ["vacío", "notación científica (dígitos perdidos)", "caracteres no numéricos"], default="longitud distinta de 15")
+    return pd.DataFrame({"IMEI": text, "IMEI_Key": keys, "IMEI_Valido": is_valid, "Motivo": reason}, index=raw.index)
+
+def imei_device_keys(imeis):
+    return device_keys_from_canonical(canonicalize_imeis(imeis))
+
+def device_keys_from_canonical(canonical):
+    # Clave entera de equipo para agrupar/unir: el IMEI como uint64 si es válido; si no, hash estable del texto con el bit alto.
+    keys = canonical["IMEI_Key"].to_numpy().copy()
+    invalid = ~canonical["IMEI_Valido"].to_numpy()
+    if invalid.any(): keys[invalid] = pd.util.hash_array(canonical["IMEI"].to_numpy(dtype=object)[invalid]) | IMEI_INVALID_KEY_BIT
+    return keys
+
+def frame_device_keys(df, imei_col="IMEI"):
+    # La columna IMEI_Key viene de la ingesta (filas, eventos y volcado a disco); solo se recalcula si falta o perdió
+    # su tipo (resultados guardados antes de existir, eventos del almacén de filas).
+    if "IMEI_Key" in df.columns and df["IMEI_Key"].dtype == np.uint64: return df["IMEI_Key"].to_numpy()
+    return imei_device_keys(df[imei_col])
+
+def format_imei_keys(keys, fallback_imeis):
+    # Clave -> texto: los válidos vuelven a 15 dígitos (con ceros a la izquierda); los inválidos conservan su texto.
+    keys = np.asarray(keys, dtype=np.uint64)
+    is_valid = keys < IMEI_INVALID_KEY_BIT
+    return np.where(is_valid, np.char.zfill(keys.astype(str), IMEI_LENGTH).astype(object), np.asarray(fallback_imeis, dtype=object))
+
+def build_imei_report(df, imei_col, client_col=None, date_col=None):
+    # Filas cuyo IMEI no pasa la validación, con el motivo; se analizan igual, con el texto limpio como identificador.
+    report_cols = ["Fila", "Cliente", "Fecha", "IMEI_Original", "IMEI_Limpio", "Motivo"]
+    if df is None or df.empty or not imei_col or imei_col not in df.columns: return pd.DataFrame(columns=report_cols)
+    canonical = canonicalize_imeis(df[imei_col])
+    invalid = ~canonical["IMEI_Valido"].to_numpy()
+    report = pd.DataFrame({"Fila": df.index.to_numpy()[invalid],
+                           "Cliente": df[client_col].to_numpy()[invalid] if client_col in df.columns else None,
+                           "Fecha": df[date_col].to_numpy()[invalid] if date_col in df.columns else None,
+                           "IMEI_Original": df[imei_col].astype(str).to_numpy()[invalid],
+                           "IMEI_Limpio": canonical["IMEI"].to_numpy()[invalid], "Motivo": canonical["Motivo"].to_numpy()[invalid]})
+    return report[report_cols]
+
 def calculate_current_state(events_df):
+    # Acepta el DataFrame de eventos o la ruta de un archivo volcado a disco; se reduce fragmento a fragmento
+    # conservando solo el último evento que cambia el estado por (Cliente, IMEI, Componente) y la fecha máxima por equipo.
+    # El equipo se agrupa por su clave entera (IMEI canónico): '3.59632100000001e+14' y '359632100000001' son el mismo.
     update_log_display("Entering calculate_current_state.", level="DEBUG")
     state_cols = ["Cliente", "IMEI", "Componentes_Instalados_Fin_Periodo", "Ultima_Fecha_Evento"]
     client_col_standard = "Cliente"
+    group_cols = [client_col_standard, "_Dispositivo"]
 
-    if events_df is None or events_df.empty:
+    if events_df is None or (isinstance(events_df, pd.DataFrame) and events_df.empty):
         update_log_display("events_df vacío/None en calculate_current_state. Retornando vacío.", level="WARNING")
         return pd.DataFrame(columns=state_cols)
 
     required_cols = ["IMEI", "Fecha", client_col_standard, "Componente", "Accion"]
-    missing = [col for col in required_cols if col not in events_df.columns]
+    available_cols = events_df.columns.tolist() if isinstance(events_df, pd.DataFrame) else pq.read_schema(events_df).names
+    missing = [col for col in required_cols if col not in available_cols]
     if missing:
-         st.error(f"Faltan cols en events_df para estado: {', '.join(missing)}")
-         update_log_display(f"Faltan cols en events_df: {', '.join(missing)}. Presentes: {events_df.columns.tolist()}", level="ERROR")
+         notify_user(f"Faltan cols en events_df para estado: {', '.join(missing)}", level="error")
+         update_log_display(f"Faltan cols en events_df: {', '.join(missing)}. Presentes: {available_cols}", level="ERROR")
          return pd.DataFrame(columns=state_cols)
 
-    if not pd.api.types.is_datetime64_any_dtype(events_df['Fecha']):
-        update_log_display("'Fecha' no es datetime. Convirtiendo...", level="DEBUG")
-        try: events_df['Fecha'] = pd.to_datetime(events_df['Fecha'], errors='coerce')
-        except Exception as e:
-             st.error(f"Error fatal convirtiendo 'Fecha' a datetime: {e}")
-             update_log_display(f"CRITICAL: Error convirtiendo 'Fecha': {e}. Trace: {traceback.format_exc()}", level="CRITICAL")
-             return pd.DataFrame(columns=state_cols)
-
-    df_copy = events_df.copy()
-    for col in ['IMEI', client_col_standard, 'Componente', 'Accion']:
-        df_copy[col] = df_copy[col].astype(str).fillna('')
-
-    df_sorted = df_copy.dropna(subset=['Fecha'])
-    for col in ['IMEI', client_col_standard, 'Componente', 'Accion']:
-        df_sorted = df_sorted[df_sorted[col] != '']
-
-    df_sorted = df_sorted.sort_values(by=[client_col_standard, "IMEI", "Fecha"])
-
-    if df_sorted.empty:
+    last_event_date = None # (Cliente, clave de equipo) -> fecha máxima e IMEI de texto (para claves inválidas)
+    last_changes = None # (Cliente, IMEI, Componente) -> último evento Instalacion/Reemplazo/Desinstalacion
+    events_seen = 0
+    for chunk in iter_event_chunks(events_df, required_cols + ["IMEI_Key", "Fila_Pos"]):
+        chunk = chunk.copy()
+        # Orden de desempate para eventos con la misma fecha: posición de la fila de origen y luego orden de aparición.
+        chunk["_Seq"] = np.arange(events_seen, events_seen + len(chunk)); events_seen += len(chunk)
+        if "Fila_Pos" not in chunk.columns: chunk["Fila_Pos"] = chunk["_Seq"]
+        if not pd.api.types.is_datetime64_any_dtype(chunk['Fecha']):
+            update_log_display("'Fecha' no es datetime. Convirtiendo...", level="DEBUG")
+            try: chunk['Fecha'] = pd.to_datetime(chunk['Fecha'], errors='coerce')
+            except Exception as e:
+                 notify_user(f"Error fatal convirtiendo 'Fecha' a datetime: {e}", level="error")
+                 update_log_display(f"CRITICAL: Error convirtiendo 'Fecha': {e}. Trace: {traceback.format_exc()}", level="CRITICAL")
+                 return pd.DataFrame(columns=state_cols)
+        for col in ['IMEI', client_col_standard, 'Componente', 'Accion']:
+            chunk[col] = chunk[col].astype(str)
+        chunk = chunk.dropna(subset=['Fecha'])
+        chunk = chunk[(chunk[['IMEI', client_col_standard, 'Componente', 'Accion']] != '').all(axis=1)]
+        if chunk.empty: continue
+        chunk["_Dispositivo"] = frame_device_keys(chunk)
+
+        chunk_dates = chunk.groupby(group_cols).agg(Fecha=("Fecha", "max"), IMEI=("IMEI", "first"))
+        last_event_date = chunk_dates if last_event_date is None else pd.concat([last_event_date, chunk_dates]).groupby(level=[0, 1]).agg({"Fecha": "max", "IMEI": "first"})
+        chunk_changes = chunk[chunk["Accion"].isin(list(ACCIONES_ESTADO_INSTALADO))][group_cols + ["Componente", "Accion", "Fecha", "Fila_Pos", "_Seq"]]
+        if last_changes is not None: chunk_changes = pd.concat([last_changes, chunk_changes], ignore_index=True)
+        last_changes = chunk_changes.sort_values(["Fecha", "Fila_Pos", "_Seq"], kind="mergesort").drop_duplicates(group_cols + ["Componente"], keep="last")
+
+    if last_event_date is None:
         update_log_display("events_df_sorted vacío post-limpieza. No se puede calcular estado.", level="WARNING")
         return pd.DataFrame(columns=state_cols)
 
-    current_state = {}
-    last_event_date = {}
+    installed = last_changes[last_changes["Accion"].map(ACCIONES_ESTADO_INSTALADO).astype(bool)]
+    installed_by_device = installed.sort_values("Componente").groupby(group_cols)["Componente"].agg(", ".join)
+    state_df = last_event_date.rename(columns={"Fecha": "Ultima_Fecha_Evento"})
+    state_df["Componentes_Instalados_Fin_Periodo"] = installed_by_device.reindex(state_df.index).fillna("Ninguno")
+    state_df = state_df.reset_index()
+    state_df["IMEI"] = format_imei_keys(state_df["_Dispositivo"].to_numpy(), state_df["IMEI"].to_numpy())
+    state_df = state_df[state_cols]
 
-    for group_key, group in df_sorted.groupby([client_col_standard, "IMEI"], sort=False):
-        cliente, imei = group_key
-        installed_components = set()
-        max_date_for_group = group['Fecha'].max()
+    if state_df.empty:
+        update_log_display("state_list vacía. No hay estados finales.", level="INFO")
+        return pd.DataFrame(columns=state_cols)
 
-        for _, row in group.iterrows():
-            component = row["Componente"]
-            action = row["Accion"]
-            if action == "Instalacion": installed_components.add(component)
-            elif action == "Desinstalacion": installed_components.discard(component)
-            elif action == "Reemplazo": installed_components.add(component)
+    try: state_df['Ultima_Fecha_Evento'] = pd.to_datetime(state_df['Ultima_Fecha_Evento'], errors='coerce').dt.strftime('%Y-%m-%d')
+    except Exception as e: update_log_display(f"Error formateando Ultima_Fecha_Evento: {e}", level="WARNING")
 
-        current_state[group_key] = sorted(list(installed_components))
-        last_event_date[group_key] = max_date_for_group
+    update_log_display(f"Exiting calculate_current_state. Generated {len(state_df)} state records.", level="DEBUG")
+    return state_df
 
-    state_list = [{"Cliente": k[0], "IMEI": k[1],
-                   "Componentes_Instalados_Fin_Periodo": ", ".join(c) if c else "Ninguno",
-                   "Ultima_Fecha_Evento": last_event_date.get(k)}
-                  for k, c in current_state.items()]
+# --- Índice de línea de tiempo (estado de la flota a cualquier fecha sin re-analizar) ---
+ACCIONES_ESTADO_INSTALADO = {"Instalacion": True, "Reemplazo": True, "Desinstalacion": False}
+
+def build_component_timeline(events_df):
+    # Intervalos [Desde, Hasta) en que cada (Cliente, IMEI, Componente) estuvo instalado; Hasta=NaT si sigue instalado.
+    # Misma semántica que calculate_current_state: Instalacion/Reemplazo instalan, Desinstalacion retira, el resto es neutro.
+    # El equipo se agrupa por su clave entera (_Dispositivo); IMEI queda como texto canónico de esa clave para mostrar.
+    interval_cols = ["Cliente", "_Dispositivo", "IMEI", "Componente", "Desde", "Hasta"]
+    empty_index = {"intervals": pd.DataFrame(columns=interval_cols), "device_events": pd.DataFrame(columns=["Cliente", "_Dispositivo", "IMEI", "Fecha"])}
+    if events_df is None or events_df.empty or not all(c in events_df.columns for c in ["IMEI", "Fecha", "Cliente", "Componente", "Accion"]):
+        return empty_index
+
+    df = events_df[["Cliente", "IMEI", "Componente", "Accion", "Fecha"]].copy()
+    df["_Dispositivo"] = frame_device_keys(events_df)
+    df["Fecha"] = pd.to_datetime(df["Fecha"], errors='coerce')
+    for col in ["Cliente", "IMEI", "Componente", "Accion"]:
+        df[col] = df[col].astype(str).fillna('')
+    df = df[df["Fecha"].notna() & (df["Cliente"] != '') & (df["IMEI"] != '') & (df["Componente"] != '') & (df["Accion"] != '')]
+    if df.empty:
+        return empty_index
+    df["IMEI"] = format_imei_keys(df["_Dispositivo"].to_numpy(), df["IMEI"].to_numpy())
+
+    device_events = df[["Cliente", "_Dispositivo", "IMEI", "Fecha"]].sort_values(["Cliente", "_Dispositivo", "Fecha"], kind='mergesort').reset_index(drop=True)
+
+    changes = df[df["Accion"].isin(list(ACCIONES_ESTADO_INSTALADO))].sort_values(["Cliente", "_Dispositivo", "Componente", "Fecha"], kind='mergesort')
+    if changes.empty:
+        return {"intervals": pd.DataFrame(columns=interval_cols), "device_events": device_events}
+
+    key_cols = ["Cliente", "_Dispositivo", "Componente"]
+    installed = changes["Accion"].map(ACCIONES_ESTADO_INSTALADO).astype(bool)
+    was_installed = installed.groupby([changes[c] for c in key_cols], sort=False).shift(1, fill_value=False).astype(bool)
+    starts_mask = installed & ~was_installed
+    ends_mask = ~installed & was_installed
+    interval_id = starts_mask.astype(int).groupby([changes[c] for c in key_cols], sort=False).cumsum()
+
+    starts = changes.loc[starts_mask, key_cols + ["IMEI", "Fecha"]].assign(_interval=interval_id[starts_mask]).rename(columns={"Fecha": "Desde"})
+    ends = changes.loc[ends_mask, key_cols + ["Fecha"]].assign(_interval=interval_id[ends_mask]).rename(columns={"Fecha": "Hasta"})
+    intervals = starts.merge(ends, on=key_cols + ["_interval"], how="left").drop(columns="_interval")
+    return {"intervals": intervals[interval_cols].reset_index(drop=True), "device_events": device_events}
+
+def fleet_state_as_of(timeline_index, as_of_date):
+    # Estado de toda la flota al cierre de 'as_of_date' en una sola pasada vectorizada sobre el índice.
+    state_cols = ["Cliente", "IMEI", "Componentes_Instalados_A_Fecha", "Ultima_Fecha_Evento"]
+    device_events = timeline_index["device_events"]
+    if device_events.empty:
+        return pd.DataFrame(columns=state_cols)
+    cutoff = pd.Timestamp(as_of_date).normalize() + pd.Timedelta(days=1)
 
-    if not state_list:
-        update_log_display("state_list vacía. No hay estados finales.", level="INFO")
+    devices = device_events[device_events["Fecha"] < cutoff].groupby(["Cliente", "_Dispositivo"], sort=False).agg(Ultima_Fecha_Evento=("Fecha", "max"), IMEI=("IMEI", "first")).reset_index()
+    devices = devices.sort_values(["Cliente", "IMEI"], kind='mergesort')
+    if devices.empty:
         return pd.DataFrame(columns=state_cols)
 
-    state_df = pd.DataFrame(state_list)
-    if 'Ultima_Fecha_Evento' in state_df.columns and not state_df['Ultima_Fecha_Evento'].empty:
-        try: state_df['Ultima_Fecha_Evento'] = pd.to_datetime(state_df['Ultima_Fecha_Evento'], errors='coerce').dt.strftime('%Y-%m-%d')
-        except Exception as e: update_log_display(f"Error formateando Ultima_Fecha_Evento: {e}", level="WARNING")
+    intervals = timeline_index["intervals"]
+    active = intervals[(intervals["Desde"] < cutoff) & (intervals["Hasta"].isna() | (intervals["Hasta"] >= cutoff))]
+    active = active[["Cliente", "_Dispositivo", "Componente"]].drop_duplicates().sort_values(["Cliente", "_Dispositivo", "Componente"])
+    installed = active.groupby(["Cliente", "_Dispositivo"], sort=False)["Componente"].agg(", ".join).rename("Componentes_Instalados_A_Fecha").reset_index()
+
+    state_df = devices.merge(installed, on=["Cliente", "_Dispositivo"], how="left")
+    state_df["Componentes_Instalados_A_Fecha"] = state_df["Componentes_Instalados_A_Fecha"].fillna("Ninguno")
+    state_df["Ultima_Fecha_Evento"] = state_df["Ultima_Fecha_Evento"].dt.strftime('%Y-%m-%d')
+    return state_df[state_cols]
+
+# --- Auditoría de consistencia de la flota (secuencias imposibles en el historial de eventos) ---
+AUDIT_GPS_COMPONENT = "GPS"
+FLEET_AUDIT_DISPLAY_ROWS = 5000 # filas de anomalías en pantalla; la descarga lleva todas
+AUDIT_ANOMALIAS = {
+    "desinstalacion_sin_instalacion": "Desinstalación sin instalación previa",
+    "doble_instalacion_gps": "Doble instalación de GPS sin retiro",
+    "componente_con_gps_retirado": "Componente instalado con GPS retirado",
+}
 
-    update_log_display(f"Exiting calculate_current_state. Generated {len(state_df)} state records.", level="DEBUG")
-    return state_df
+def sorted_group_starts(group_keys):
+    # Claves ya ordenadas -> índice del primer elemento del grupo de cada posición.
+    is_start = np.r_[True, group_keys[1:] != group_keys[:-1]] if len(group_keys) else np.zeros(0, dtype=bool)
+    return np.maximum.accumulate(np.where(is_start, np.arange(len(group_keys)), 0))
+
+def audit_fleet_consistency(events_df):
+    # Una pasada vectorizada sobre el historial ordenado por equipo y fecha. Por (Cliente, IMEI, Componente): estado tras el
+    # cambio anterior (shift) e instalaciones previas (cumsum); por equipo: estado vigente del GPS (ffill). Todo sobre códigos enteros.
+    anomaly_cols = ["Cliente", "IMEI", "Fecha", "Componente", "Accion", "Anomalia", "Evento_Previo", "Fecha_Previa", "Descripcion_Original"]
+    empty_audit = {"anomalies": pd.DataFrame(columns=anomaly_cols), "counts": pd.DataFrame(columns=["Cliente", *AUDIT_ANOMALIAS.values(), "Total"]), "events_audited": 0}
+    if events_df is None or events_df.empty or not all(c in events_df.columns for c in ["IMEI", "Fecha", "Cliente", "Componente", "Accion"]):
+        return empty_audit
+
+    events = events_df.reset_index(drop=True)
+    dates = pd.to_datetime(events["Fecha"], errors='coerce').to_numpy(dtype='datetime64[ns]')
+    client_codes, client_names = pd.factorize(events["Cliente"].astype(str))
+    component_codes, component_names = pd.factorize(events["Componente"].astype(str))
+    action_codes, action_names = pd.factorize(events["Accion"].astype(str))
+    imeis = events["IMEI"].astype(str)
+    keep = ~np.isnat(dates) & (imeis.to_numpy() != '') & (client_names.to_numpy() != '')[client_codes] \
+           & (component_names.to_numpy() != '')[component_codes] & (action_names.to_numpy() != '')[action_codes]
+    positions = np.flatnonzero(keep)
+    if not len(positions):
+        return empty_audit
+
+    # Orden del historial: equipo, fecha y posición original (los eventos de una misma fila conservan su orden).
+    device_codes = pd.factorize(frame_device_keys(events)[positions])[0].astype(np.int64)
+    device_group = client_codes[positions].astype(np.int64) * (device_codes.max() + 1) + device_codes
+    order = np.lexsort((positions, dates[positions], device_group))
+    positions, device_group, dates = positions[order], device_group[order], dates[positions][order]
+    component_codes, action_codes = component_codes[positions], action_codes[positions]
+    action_state = np.array([ACCIONES_ESTADO_INSTALADO.get(a, -1) for a in action_names], dtype=np.int8)[action_codes] # 1 instala, 0 retira, -1 neutra
+    is_change = action_state >= 0
+    gps_code = component_names.get_loc(AUDIT_GPS_COMPONENT) if AUDIT_GPS_COMPONENT in component_names else -1
+    is_gps = component_codes == gps_code
+    install_codes = [action_names.get_loc(a) for a in ("Instalacion", "Reemplazo") if a in action_names]
+    is_install_action = action_codes == (action_names.get_loc("Instalacion") if "Instalacion" in action_names else -1)
+
+    # Por (Cliente, IMEI, Componente): orden estable por componente dentro del orden cronológico del equipo.
+    change_idx = np.flatnonzero(is_change)
+    change_keys = device_group[change_idx] * len(component_names) + component_codes[change_idx]
+    by_component = np.argsort(change_keys, kind='stable')
+    change_idx, change_keys = change_idx[by_component], change_keys[by_component]
+    installed = action_state[change_idx] == 1
+    group_start = sorted_group_starts(change_keys)
+    first_in_group = group_start == np.arange(len(change_idx))
+    was_installed = np.r_[False, installed[:-1]] & ~first_in_group # shift(1) dentro del grupo
+    installs_cumsum = np.cumsum(installed)
+    prior_installs = installs_cumsum - installed - (installs_cumsum - installed)[group_start] # cumsum dentro del grupo, excluyendo el evento
+    previous_idx = np.where(first_in_group, -1, np.r_[-1, change_idx[:-1]])
+    uninstall_without_install = ~installed & (prior_installs == 0)
+    double_gps_install = is_install_action[change_idx] & was_installed & is_gps[change_idx]
+
+    # Por equipo: último cambio del GPS en vigor en cada evento (ffill del marcador dentro del grupo del equipo).
+    gps_change = is_change & is_gps
+    last_gps_idx = np.maximum.accumulate(np.where(gps_change, np.arange(len(positions)), -1))
+    last_gps_idx = np.where(last_gps_idx >= sorted_group_starts(device_group), last_gps_idx, -1)
+    gps_removed = (last_gps_idx >= 0) & (action_state[np.maximum(last_gps_idx, 0)] == 0)
+    component_with_gps_removed = np.flatnonzero(~is_gps & np.isin(action_codes, install_codes) & gps_removed)
+
+    columns = [c for c in ["Cliente", "IMEI", "Fecha", "Componente", "Accion", "Descripcion_Original"] if c in events.columns]
+    frames = []
+    for anomaly, event_idx, prev_idx in [
+        ("desinstalacion_sin_instalacion", change_idx[uninstall_without_install], previous_idx[uninstall_without_install]),
+        ("doble_instalacion_gps", change_idx[double_gps_install], previous_idx[double_gps_install]),
+        ("componente_con_gps_retirado", component_with_gps_removed, last_gps_idx[component_with_gps_removed]),
+    ]:
+        if not len(event_idx): continue
+        has_prev = prev_idx >= 0
+        prev_pairs, prev_pair_codes = np.unique(np.stack([component_codes[prev_idx], action_codes[prev_idx]], axis=1), axis=0, return_inverse=True)
+        prev_labels = np.array([f"{component_names[c]} {action_names[a]}" for c, a in prev_pairs], dtype=object)
+        prev_event = np.where(has_prev, prev_labels[prev_pair_codes.reshape(-1)], "—")
+        frames.append(events.iloc[positions[event_idx]][columns].assign(Anomalia=AUDIT_ANOMALIAS[anomaly], Evento_Previo=prev_event,
+                                                                        Fecha_Previa=np.where(has_prev, dates[prev_idx], np.datetime64('NaT'))))
+    if not frames:
+        return {**empty_audit, "events_audited": len(positions)}
+
+    anomalies = pd.concat(frames, ignore_index=True).reindex(columns=anomaly_cols)
+    anomalies["Fecha"] = pd.to_datetime(anomalies["Fecha"], errors='coerce')
+    anomalies = anomalies.sort_values(["Cliente", "IMEI", "Fecha"], kind="mergesort").reset_index(drop=True)
+    counts = pd.crosstab(anomalies["Cliente"], anomalies["Anomalia"]).reindex(columns=list(AUDIT_ANOMALIAS.values()), fill_value=0)
+    counts["Total"] = counts.sum(axis=1)
+    counts = counts.sort_values("Total", ascending=False, kind="mergesort").reset_index()
+    counts.columns.name = None
+    return {"anomalies": anomalies, "counts": counts, "events_audited": len(positions)}
+
+# --- Índice invertido de identificadores de accesorios (Accesorio_ID) ---
+def normalize_accessory_tokens(tokens):
+    # Normaliza tokens de ID (Series de str) a: tipo, clave canónica, tag TDBLE, MAC canónica (AA:BB:..) y número.
+    tokens = tokens.astype(str).str.strip().str.lstrip('#/').str.upper()
+    tdble = tokens.str.extract(r'^(TDBLE[_\-]?\d+)(?:\s*/\s*(.+))?$')
+    tdble_tag = tdble[0].str.replace('-', '_', regex=False).str.replace(r'^TDBLE(?=\d)', 'TDBLE_', regex=True)
+    mac_source = tdble[1].where(tdble[0].notna(), tokens)
+    mac_compact = mac_source.fillna('').str.replace(r'[:\-\.\s]', '', regex=True)
+    is_mac = mac_compact.str.fullmatch(r'[0-9A-F]{12}') & mac_compact.str.contains(r'[A-F]', regex=True)
+    mac = mac_compact.where(is_mac).str.replace(r'(..)(?!$)', r'\1:', regex=True)
+    is_digits = tokens.str.fullmatch(r'\d+')
+    number = tokens.where(is_digits).str.lstrip('0').replace('', '0')
+
+    id_type = pd.Series(np.select(
+        [tdble_tag.notna().to_numpy(), is_mac.to_numpy(), (is_digits & (tokens.str.len() == 15)).to_numpy(), is_digits.to_numpy()],
+        ["TDBLE", "MAC", "IMEI", "NUMERICO"], default="SERIAL"), index=tokens.index)
+    # Clave canónica: la MAC identifica al sensor físico aunque su tag TDBLE se capture distinto.
+    id_key = mac.astype(object)
+    for fallback in (tdble_tag, number, tokens):
+        id_key = id_key.where(id_key.notna(), fallback.astype(object))
+    return pd.DataFrame({"ID_Tipo": id_type, "ID_Clave": id_key, "TDBLE_Tag": tdble_tag, "MAC": mac, "Numero": number})
+
+def normalize_accessory_query(query):
+    parsed = normalize_accessory_tokens(pd.Series([query]))
+    return parsed["ID_Clave"].iloc[0]
+
+def build_accessory_index(events_df):
+    id_cols = ["Evento_Pos", "IMEI", "Cliente", "Fecha", "Componente", "Accion", "ID_Original", "ID_Tipo", "ID_Clave", "TDBLE_Tag", "MAC", "Numero"]
+    empty_index = {"ids": pd.DataFrame(columns=id_cols), "lookup": {}, "sorted_keys": [], "conflicts": pd.DataFrame()}
+    if events_df is None or events_df.empty or "Accesorio_ID" not in events_df.columns:
+        return empty_index
+
+    raw_ids = events_df["Accesorio_ID"].fillna('').astype(str).reset_index(drop=True)
+    exploded = raw_ids[raw_ids.str.strip() != ''].str.replace(r'(TDBLE[_\-]?\d+)\s*/\s*', r'\1/', regex=True, case=False) \
+                                                 .str.split(r'[,;\s]+', regex=True).explode()
+    exploded = exploded[exploded.notna() & (exploded.str.strip().str.lstrip('#/') != '')]
+    if exploded.empty:
+        return empty_index
+
+    parsed = normalize_accessory_tokens(exploded)
+    context = events_df[["IMEI", "Cliente", "Fecha", "Componente", "Accion"]].reset_index(drop=True).iloc[exploded.index.to_numpy()].reset_index(drop=True)
+    ids = pd.concat([pd.DataFrame({"Evento_Pos": exploded.index.to_numpy()}), context,
+                     pd.DataFrame({"ID_Original": exploded.str.strip().to_numpy()}), parsed.reset_index(drop=True)], axis=1)
+    ids["_Dispositivo"] = frame_device_keys(events_df)[exploded.index.to_numpy()]
+    ids["IMEI"] = format_imei_keys(ids["_Dispositivo"].to_numpy(), ids["IMEI"].astype(str).to_numpy())
+    ids["Fecha"] = pd.to_datetime(ids["Fecha"], errors='coerce')
+
+    # Índice invertido: cualquier forma de búsqueda (clave, tag TDBLE, MAC, número) -> posiciones en 'ids'.
+    key_frames = [ids["ID_Clave"], ids["TDBLE_Tag"], ids["MAC"], ids["MAC"].str.replace(':', '', regex=False), ids["Numero"]]
+    keys_long = pd.concat([k.dropna().rename("key").reset_index() for k in key_frames]).drop_duplicates()
+    key_positions = keys_long["index"].to_numpy()
+    lookup = {key: key_positions[rows] for key, rows in keys_long.groupby("key").indices.items()}
+
+    # Conflictos: IDs cuyo último evento de estado los deja instalados en más de un IMEI.
+    changes = ids[ids["Accion"].isin(list(ACCIONES_ESTADO_INSTALADO))].sort_values("Fecha", kind='mergesort')
+    last_state = changes.drop_duplicates(subset=["ID_Clave", "Cliente", "_Dispositivo"], keep="last")
+    installed_now = last_state[last_state["Accion"].map(ACCIONES_ESTADO_INSTALADO).astype(bool)]
+    device_counts = installed_now.groupby("ID_Clave")["_Dispositivo"].transform("nunique")
+    conflicts = installed_now[device_counts > 1].sort_values(["ID_Clave", "Fecha"])[["ID_Clave", "ID_Tipo", "Componente", "Cliente", "IMEI", "Fecha", "Accion", "ID_Original"]]
+
+    return {"ids": ids[id_cols], "lookup": lookup, "sorted_keys": sorted(lookup), "conflicts": conflicts.reset_index(drop=True)}
+
+def search_accessory_index(accessory_index, query, max_prefix_keys=50):
+    # Búsqueda exacta por clave normalizada; si no hay coincidencia, por prefijo (bisect sobre claves ordenadas).
+    if not query or not str(query).strip() or not accessory_index["lookup"]:
+        return accessory_index["ids"].iloc[0:0]
+    lookup, sorted_keys = accessory_index["lookup"], accessory_index["sorted_keys"]
+    candidates = [normalize_accessory_query(query), str(query).strip().upper().lstrip('#/')]
+    positions = next((lookup[k] for k in candidates if k in lookup), None)
+    if positions is None:
+        prefix = candidates[1]
+        start = bisect.bisect_left(sorted_keys, prefix)
+        matched_keys = []
+        for key in sorted_keys[start:start + max_prefix_keys]:
+            if not key.startswith(prefix): break
+            matched_keys.append(key)
+        positions = np.unique(np.concatenate([lookup[k] for k in matched_keys])) if matched_keys else np.array([], dtype=int)
+    return accessory_index["ids"].iloc[positions].sort_values("Fecha")
+
+# --- Índice de filtros (cliente y rango de fechas → posiciones de fila, sin recorrer el DataFrame) ---
+def build_filter_index(df, date_col, client_col):
+    dates = pd.to_datetime(df[date_col], errors='coerce').to_numpy(dtype='datetime64[ns]')
+    valid_positions = np.flatnonzero(~np.isnat(dates))
+    date_order = np.argsort(dates[valid_positions], kind='stable')
+    # Mismo criterio que el filtro anterior: astype(str).str.strip() (NaN queda como 'nan').
+    client_codes, client_names = pd.factorize(df[client_col].astype(str).str.strip(), sort=True)
+    client_positions = {client_names[code]: positions for code, positions in pd.Series(client_codes).groupby(client_codes).indices.items()}
+    return {
+        "n_rows": len(df),
+        "sorted_dates": dates[valid_positions][date_order],
+        "sorted_positions": valid_positions[date_order],
+        "client_names": client_names.tolist(),
+        "client_positions": client_positions,
+    }
+
+def resolve_filter_positions(filter_index, clients=None, start_dt=None, end_dt=None):
+    # Corte por fecha con searchsorted sobre el arreglo ordenado; el cliente se resuelve con sus listas de posiciones.
+    sorted_dates = filter_index["sorted_dates"]
+    lo = np.searchsorted(sorted_dates, np.datetime64(start_dt, 'ns'), side='left') if start_dt is not None else 0
+    hi = np.searchsorted(sorted_dates, np.datetime64(end_dt, 'ns'), side='right') if end_dt is not None else len(sorted_dates)
+    positions = filter_index["sorted_positions"][lo:hi]
+    if clients:
+        client_mask = np.zeros(filter_index["n_rows"], dtype=bool)
+        for client in clients:
+            client_rows = filter_index["client_positions"].get(client)
+            if client_rows is not None: client_mask[client_rows] = True
+        positions = positions[client_mask[positions]]
+    return np.sort(positions)
+
+# --- Índice de vistas de detalle (historial por IMEI y navegador de servicios) ---
+def build_results_view_index(events_df, source_df, imei_col=None, desc_col=None, date_col=None, client_col=None):
+    # Se construye una vez por resultado: elegir un IMEI o abrir un grupo de servicios es una búsqueda en diccionario.
+    view_index = {"imei_positions": {}, "imei_options": [], "service_events": {}, "service_groups": [], "service_device_keys": []}
+    if events_df is not None and not events_df.empty and "IMEI" in events_df.columns:
+        events = events_df.reset_index(drop=True)
+        event_dates = pd.to_datetime(events["Fecha"], errors='coerce') if "Fecha" in events.columns else pd.Series(pd.NaT, index=events.index)
+        by_date = np.argsort(event_dates.to_numpy(), kind='stable')
+        imeis_by_date = events["IMEI"].iloc[by_date].dropna().astype(str)
+        # Posiciones por clave entera de equipo; las opciones del selector son el IMEI canónico de cada clave.
+        device_keys = pd.Series(frame_device_keys(events)[imeis_by_date.index.to_numpy()], index=imeis_by_date.index)
+        view_index["imei_positions"] = {key: device_keys.index.to_numpy()[rows] for key, rows in device_keys.groupby(device_keys).indices.items()}
+        first_imeis = imeis_by_date.groupby(device_keys.to_numpy()).first()
+        view_index["imei_options"] = sorted(format_imei_keys(first_imeis.index.to_numpy(), first_imeis.to_numpy()).tolist())
+        if "Descripcion_Original" in events.columns:
+            # Fila original <-> eventos por (clave de equipo, descripción, fecha).
+            dated = events[event_dates.notna()]
+            match_keys = pd.Series(list(zip(frame_device_keys(events)[dated.index.to_numpy()].tolist(), dated["Descripcion_Original"].astype(str), event_dates[dated.index])), index=dated.index, dtype=object)
+            view_index["service_events"] = {key: dated.index.to_numpy()[rows] for key, rows in match_keys.groupby(match_keys).indices.items()}
+    if source_df is not None and not source_df.empty and all(c and c in source_df.columns for c in (imei_col, desc_col, date_col, client_col)):
+        group_keys = pd.DataFrame({"Fecha_Solo_Display": pd.to_datetime(source_df[date_col], errors='coerce').dt.date.to_numpy(), "Cliente": source_df[client_col].to_numpy()})
+        order = group_keys.sort_values(by=["Fecha_Solo_Display", "Cliente"]).index.to_numpy()
+        group_rows = group_keys.iloc[order].reset_index(drop=True).groupby(["Fecha_Solo_Display", "Cliente"], sort=False, dropna=False).indices
+        view_index["service_groups"] = [(key, order[rows]) for key, rows in sorted(group_rows.items(), key=lambda item: item[1][0])]
+        view_index["service_device_keys"] = frame_device_keys(source_df, imei_col).tolist()
+    return view_index
+
+# --- Export/Import columnar de resultados (Parquet) ---
+def to_columnar_frame(df, date_cols=(), categorical_cols=()):
+    # Fechas como timestamp y columnas repetitivas como diccionario (categorical) en vez de texto suelto.
+    out = df.copy()
+    for col in date_cols:
+        if col in out.columns: out[col] = pd.to_datetime(out[col], errors='coerce')
+    for col in categorical_cols:
+        if col in out.columns: out[col] = out[col].astype(str).astype("category")
+    for col in out.columns:
+        # Columnas object con tipos mezclados (int/str) no son representables en Arrow: se pasan a texto.
+        if out[col].dtype == object: out[col] = out[col].map(lambda v: v if v is None or (isinstance(v, float) and pd.isna(v)) else str(v)).astype("string")
+    return out.reset_index(drop=True)
+
+def results_to_parquet_bytes(df, meta=None, date_cols=(), categorical_cols=()):
+    table = pa.Table.from_pandas(to_columnar_frame(df, date_cols, categorical_cols), preserve_index=False)
+    if meta is not None:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), RESULTS_META_KEY: json.dumps(meta, default=str).encode('utf-8')})
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer, compression="zstd")
+    return buffer.getvalue().to_pybytes()
+
+def build_results_frames(events_df, current_state_df, source_df, meta):
+    source_date_cols = [meta['date_col']] if meta.get('date_col') else []
+    source_cat_cols = [meta['client_col']] if meta.get('client_col') else []
+    return {
+        "events_df": (events_df, ["Fecha"], ["Cliente", "Componente", "Accion"]),
+        "current_state_df": (current_state_df, ["Ultima_Fecha_Evento"], ["Cliente"]),
+        "df_for_gemini_analysis": (source_df, source_date_cols, source_cat_cols),
+    }
+
+def save_results_parquet(events_df, current_state_df, source_df, meta, run_id, results_dir=RESULTS_DIR):
+    run_dir = os.path.join(results_dir, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+    meta = {**meta, "run_id": run_id, "saved_at": datetime.datetime.now().isoformat(timespec='seconds')}
+    for key, (df, date_cols, cat_cols) in build_results_frames(events_df, current_state_df, source_df, meta).items():
+        if df is None: df = pd.DataFrame()
+        tmp_path = os.path.join(run_dir, RESULTS_FILES[key] + ".tmp")
+        with open(tmp_path, 'wb') as f: f.write(results_to_parquet_bytes(df, meta, date_cols, cat_cols))
+        os.replace(tmp_path, os.path.join(run_dir, RESULTS_FILES[key]))
+    return run_dir
+
+def read_results_meta(run_dir):
+    schema_meta = pq.read_schema(os.path.join(run_dir, RESULTS_FILES["events_df"])).metadata or {}
+    return json.loads(schema_meta[RESULTS_META_KEY]) if RESULTS_META_KEY in schema_meta else {}
+
+def list_saved_results(results_dir=RESULTS_DIR):
+    saved = []
+    if not os.path.isdir(results_dir): return saved
+    for name in os.listdir(results_dir):
+        run_dir = os.path.join(results_dir, name)
+        if not all(os.path.exists(os.path.join(run_dir, f)) for f in RESULTS_FILES.values()): continue
+        try: saved.append((run_dir, read_results_meta(run_dir)))
+        except Exception as e: update_log_display(f"Resultado guardado '{run_dir}' ilegible: {e}", level="WARNING")
+    return sorted(saved, key=lambda item: item[1].get("saved_at", ""), reverse=True)
+
+def resolve_results_dir(path, results_dir=RESULTS_DIR):
+    # Solo se abren carpetas dentro de RESULTS_DIR: una ruta libre permitiría leer cualquier archivo del servidor.
+    base = os.path.realpath(results_dir)
+    run_dir = os.path.realpath(os.path.join(base, path))
+    if run_dir == base or os.path.commonpath([base, run_dir]) != base:
+        raise ValueError(f"'{path}' no es una carpeta dentro de '{results_dir}/'.")
+    return run_dir
+
+def load_results_parquet(run_dir):
+    # memory_map evita copiar el archivo a un buffer intermedio; las categorías vuelven a texto
+    # porque el resto del flujo (groupby, filtros, índices) trabaja sobre columnas object.
+    loaded = {}
+    for key, file_name in RESULTS_FILES.items():
+        df = pq.read_table(os.path.join(run_dir, file_name), memory_map=True).to_pandas()
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(df[col].dtype): df[col] = df[col].astype(object).where(df[col].notna(), None)
+        loaded[key] = df
+    if 'Ultima_Fecha_Evento' in loaded["current_state_df"].columns:
+        loaded["current_state_df"]['Ultima_Fecha_Evento'] = loaded["current_state_df"]['Ultima_Fecha_Evento'].dt.strftime('%Y-%m-%d')
+    loaded["meta"] = read_results_meta(run_dir)
+    return loaded
+
+# --- Almacén de filas con hash de contenido estable ---
+def canonical_service_rows(df, imei_col, date_col, client_col, desc_col):
+    # Forma canónica de una fila de servicio: la misma visita exportada dos veces produce los mismos valores.
+    return pd.DataFrame({
+        "IMEI": canonicalize_imeis(df[imei_col])["IMEI"],
+        "Fecha": pd.to_datetime(df[date_col], errors='coerce').dt.strftime('%Y-%m-%d %H:%M:%S').fillna(''),
+        "Cliente": df[client_col].fillna('').astype(str).str.strip(),
+        "Descripcion": df[desc_col].fillna('').astype(str).str.strip().str.replace(r'\s+', ' ', regex=True),
+    }, index=df.index)
+
+def compute_row_hashes(df, imei_col, date_col, client_col, desc_col):
+    # hash_pandas_object usa una clave fija: el hash es estable entre procesos y exportaciones.
+    canonical = canonical_service_rows(df, imei_col, date_col, client_col, desc_col)
+    return pd.util.hash_pandas_object(canonical, index=False).map('{:016x}'.format)
+
+def load_row_store(store_dir=ROW_STORE_DIR):
+    store = {"filas": pd.DataFrame(columns=ROW_STORE_COLS), "eventos": pd.DataFrame(columns=["Row_Hash", "IMEI", "Fecha", "Cliente", "Componente", "Accion", "Accesorio_ID", "Descripcion_Original"])}
+    for key in store:
+        path = os.path.join(store_dir, f"{key}.parquet")
+        if os.path.exists(path): store[key] = pq.read_table(path, memory_map=True).to_pandas()
+    return store
+
+def save_row_store(store, store_dir=ROW_STORE_DIR):
+    os.makedirs(store_dir, exist_ok=True)
+    for key, df in store.items():
+        tmp_path = os.path.join(store_dir, f"{key}.parquet.tmp")
+        pq.write_table(pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False), tmp_path, compression="zstd")
+        os.replace(tmp_path, os.path.join(store_dir, f"{key}.parquet"))
+
+def analyzed_row_hashes(store):
+    filas = store["filas"]
+    return set(filas.loc[filas["Analizada_En"].notna(), "Row_Hash"])
+
+def upsert_row_store(store, canonical_rows, row_hashes, origen, analyzed_hashes=(), events_df=None):
+    # Agrega filas no vistas, marca como analizadas las indicadas y reemplaza sus eventos guardados.
+    now = pd.Timestamp.now().floor('s')
+    filas = store["filas"]
+    incoming = canonical_rows.assign(Row_Hash=row_hashes.to_numpy(), Origen=origen, Visto_En=now, Analizada_En=pd.NaT).drop_duplicates("Row_Hash")
+    new_rows = incoming[~incoming["Row_Hash"].isin(filas["Row_Hash"])]
+    if not new_rows.empty: filas = pd.concat([filas, new_rows[ROW_STORE_COLS]], ignore_index=True) if not filas.empty else new_rows[ROW_STORE_COLS].reset_index(drop=True)
+    analyzed_hashes = set(analyzed_hashes)
+    if analyzed_hashes:
+        filas["Analizada_En"] = pd.to_datetime(filas["Analizada_En"]).mask(filas["Row_Hash"].isin(analyzed_hashes), now)
+        if events_df is not None:
+            kept_events = store["eventos"][~store["eventos"]["Row_Hash"].isin(analyzed_hashes)]
+            new_events = events_df[events_df["Row_Hash"].isin(analyzed_hashes)]
+            store["eventos"] = pd.concat([kept_events, new_events[kept_events.columns]], ignore_index=True) if not kept_events.empty else new_events[kept_events.columns].reset_index(drop=True)
+    store["filas"] = filas
+    return len(new_rows)
+
+@st.cache_resource(max_entries=4)
+def get_analyzed_row_hashes(store_dir, store_mtime):
+    # Se recarga solo cuando cambia el archivo del almacén (mtime en la clave de caché).
+    return frozenset(analyzed_row_hashes(load_row_store(store_dir)))
+
+def row_store_mtime(store_dir=ROW_STORE_DIR):
+    path = os.path.join(store_dir, "filas.parquet")
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+class NotionRateLimited(Exception):
+    # 429 de Notion. Toda capa HTTP la lanza con la espera sugerida (Retry-After, segundos) y NotionClient reintenta.
+    def __init__(self, retry_after=None):
+        super().__init__(f"Notion: límite de peticiones (429){f', reintentar en {retry_after}s' if retry_after is not None else ''}")
+        self.retry_after = retry_after
+
+def notion_http_post(url, headers, payload, timeout=60):
+    # Capa HTTP por defecto (stdlib). NotionClient acepta cualquier callable con esta firma.
+    request = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'), headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        if e.code != 429: raise
+        retry_after = e.headers.get("Retry-After") if e.headers else None
+        raise NotionRateLimited(float(retry_after) if retry_after else None) from e
+
+class FakeNotionDatabase:
+    # Capa HTTP en memoria con la firma de notion_http_post, para probar la sincronización sin red ni token:
+    # filtra por last_edited_time, ordena, pagina con next_cursor y, como la API, no devuelve páginas en la papelera.
+    # rate_limited_calls simula respuestas 429 en las primeras llamadas.
+    def __init__(self, database_id, rate_limited_calls=0, retry_after=0):
+        self.database_id = database_id
+        self.pages = {}
+        self.rate_limited_calls = rate_limited_calls
+        self.retry_after = retry_after
+        self.calls = 0
+
+    def add_page(self, page_id, values, last_edited_time):
+        self.pages[page_id] = {"object": "page", "id": page_id, "last_edited_time": last_edited_time, "archived": False, "in_trash": False,
+                               "properties": {name: {"type": "rich_text", "rich_text": [{"plain_text": str(value)}]} for name, value in values.items()}}
+
+    def trash_page(self, page_id, last_edited_time):
+        self.pages[page_id].update({"archived": True, "in_trash": True, "last_edited_time": last_edited_time})
+
+    def __call__(self, url, headers, payload, timeout=60):
+        self.calls += 1
+        if self.rate_limited_calls > 0:
+            self.rate_limited_calls -= 1
+            raise NotionRateLimited(self.retry_after)
+        if not url.endswith(f"/databases/{self.database_id}/query"): raise ValueError(f"FakeNotionDatabase: ruta no soportada '{url}'.")
+        on_or_after = ((payload.get("filter") or {}).get("last_edited_time") or {}).get("on_or_after")
+        pages = sorted((page for page in self.pages.values() if not page["in_trash"] and (not on_or_after or page["last_edited_time"] >= on_or_after)),
+                       key=lambda page: page["last_edited_time"])
+        start, page_size = int(payload.get("start_cursor") or 0), payload.get("page_size", 100)
+        has_more = start + page_size < len(pages)
+        return {"object": "list", "results": copy.deepcopy(pages[start:start + page_size]), "has_more": has_more, "next_cursor": str(start + page_size) if has_more else None}
+
+class NotionClient:
+    def __init__(self, token, http_post=None, base_url=NOTION_API_URL, max_rate_limit_retries=5):
+        self.token = token
+        self.http_post = http_post or notion_http_post
+        self.base_url = base_url.rstrip('/')
+        self.max_rate_limit_retries = max_rate_limit_retries
+
+    def _post(self, path, payload):
+        headers = {"Authorization": f"Bearer {self.token}", "Notion-Version": NOTION_API_VERSION, "Content-Type": "application/json"}
+        for attempt in range(self.max_rate_limit_retries + 1):
+            try:
+                return self.http_post(f"{self.base_url}{path}", headers, payload)
+            except NotionRateLimited as e:
+                if attempt == self.max_rate_limit_retries: raise
+                time.sleep(e.retry_after if e.retry_after is not None else 1)
+
+    def query_database(self, database_id, filter=None, sorts=None, page_size=100):
+        # Itera todas las páginas del resultado siguiendo next_cursor.
+        payload = {"page_size": page_size}
+        if filter: payload["filter"] = filter
+        if sorts: payload["sorts"] = sorts
+        while True:
+            response = self._post(f"/databases/{database_id}/query", payload)
+            yield from response.get("results", [])
+            if not response.get("has_more") or not response.get("next_cursor"): break
+            payload = {**payload, "start_cursor": response["next_cursor"]}
+
+def notion_property_text(prop):
+    # Valor de una propiedad de página Notion como texto plano (fechas como 'YYYY-MM-DD HH:MM:SS' sin zona horaria).
+    if not prop: return ""
+    prop_type = prop.get("type")
+    value = prop.get(prop_type)
+    if value is None: return ""
+    if prop_type in ("title", "rich_text"): return "".join(part.get("plain_text", "") for part in value)
+    if prop_type == "number": return str(int(value)) if float(value).is_integer() else str(value)
+    if prop_type in ("select", "status"): return value.get("name", "")
+    if prop_type == "multi_select": return ", ".join(option.get("name", "") for option in value)
+    if prop_type == "date":
+        start = pd.Timestamp(value.get("start")) if value.get("start") else None
+        return start.tz_localize(None).strftime('%Y-%m-%d %H:%M:%S') if start is not None and start.tz is not None else (start.strftime('%Y-%m-%d %H:%M:%S') if start is not None else "")
+    if prop_type in ("created_time", "last_edited_time"): return pd.Timestamp(value).tz_localize(None).strftime('%Y-%m-%d %H:%M:%S')
+    if prop_type == "formula": return notion_property_text({"type": value.get("type"), value.get("type"): value.get(value.get("type"))})
+    if prop_type == "rollup" and value.get("type") == "array": return ", ".join(notion_property_text(item) for item in value.get("array", []))
+    if prop_type == "unique_id": return f"{value.get('prefix') or ''}{'-' if value.get('prefix') else ''}{value.get('number', '')}"
+    if prop_type == "relation": return ", ".join(item.get("id", "") for item in value)
+    if prop_type == "people": return ", ".join(person.get("name", "") or person.get("id", "") for person in value)
+    return str(value)
+
+def find_notion_property(properties, name):
+    if name in properties: return properties[name]
+    lowered = {key.lower().strip(): key for key in properties}
+    return properties.get(lowered.get(name.lower().strip()))
+
+def load_notion_sync_state(store_dir=ROW_STORE_DIR):
+    path = os.path.join(store_dir, NOTION_SYNC_STATE_FILE)
+    if not os.path.exists(path): return {}
+    with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+
+def save_notion_sync_state(state, store_dir=ROW_STORE_DIR):
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_path = os.path.join(store_dir, NOTION_SYNC_STATE_FILE + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(state, f, indent=2)
+    os.replace(tmp_path, os.path.join(store_dir, NOTION_SYNC_STATE_FILE))
+
+def sync_notion_to_row_store(notion_client, database_id, property_names=None, store_dir=ROW_STORE_DIR, full_resync=False):
+    # Trae solo páginas editadas desde la última marca (on_or_after: Notion redondea last_edited_time al minuto,
+    # las páginas del borde se repiten y el hash de contenido las deduplica).
+    # La consulta no devuelve páginas borradas (papelera): cada NOTION_FULL_RESYNC_HOURS se relee toda la base y las
+    # páginas conocidas que ya no aparecen se eliminan del almacén. Las páginas conocidas por base se guardan en el estado.
+    property_names = {**NOTION_PROPERTY_DEFAULTS, **(property_names or {})}
+    sync_state = load_notion_sync_state(store_dir)
+    last_full_resync = sync_state.get("resync_completo", {}).get(database_id)
+    full_resync = full_resync or not last_full_resync or \
+                  (datetime.datetime.now() - datetime.datetime.fromisoformat(last_full_resync)).total_seconds() >= NOTION_FULL_RESYNC_HOURS * 3600
+    watermark = None if full_resync else sync_state.get(database_id)
+    query_filter = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": watermark}} if watermark else None
+    known_pages = set(sync_state.get("paginas", {}).get(database_id, []))
+    records, removed_origins, new_watermark, pages_seen, seen_pages = [], set(), watermark, 0, set()
+    for page in notion_client.query_database(database_id, filter=query_filter, sorts=[{"timestamp": "last_edited_time", "direction": "ascending"}]):
+        pages_seen += 1
+        origin = f"notion:{page.get('id')}"
+        new_watermark = max(new_watermark or "", page.get("last_edited_time") or "")
+        if page.get("archived") or page.get("in_trash"):
+            removed_origins.add(origin); continue
+        seen_pages.add(page.get('id'))
+        properties = page.get("properties", {})
+        records.append({col: notion_property_text(find_notion_property(properties, prop_name)) for col, prop_name in property_names.items()} | {"Origen": origin})
+    deleted_pages = known_pages - seen_pages if full_resync else set()
+    removed_origins |= {f"notion:{page_id}" for page_id in deleted_pages}
+    known_pages = (seen_pages if full_resync else known_pages | seen_pages) - {origin.split(":", 1)[1] for origin in removed_origins}
+
+    notion_rows = pd.DataFrame(records, columns=list(NOTION_PROPERTY_DEFAULTS) + ["Origen"])
+    with get_row_store_lock():
+        row_store = load_row_store(store_dir)
+        row_hashes = compute_row_hashes(notion_rows, "IMEI", "Fecha", "Cliente", "Descripcion") if not notion_rows.empty else pd.Series(dtype=object)
+        # Una página editada reemplaza a su versión anterior (mismo Origen, otro hash); las archivadas se eliminan.
+        filas = row_store["filas"]
+        stale = filas["Origen"].isin(removed_origins | set(notion_rows["Origen"])) & ~filas["Row_Hash"].isin(set(row_hashes))
+        stale_hashes = set(filas.loc[stale, "Row_Hash"])
+        row_store["filas"] = filas[~stale].reset_index(drop=True)
+        row_store["eventos"] = row_store["eventos"][~row_store["eventos"]["Row_Hash"].isin(stale_hashes)].reset_index(drop=True)
+        new_rows = 0
+        if not notion_rows.empty:
+            new_rows = upsert_row_store(row_store, canonical_service_rows(notion_rows, "IMEI", "Fecha", "Cliente", "Descripcion"), row_hashes, notion_rows["Origen"].to_numpy())
+        save_row_store(row_store, store_dir)
+        sync_state = {**sync_state, "paginas": {**sync_state.get("paginas", {}), database_id: sorted(known_pages)}}
+        if new_watermark: sync_state[database_id] = new_watermark
+        if full_resync: sync_state["resync_completo"] = {**sync_state.get("resync_completo", {}), database_id: datetime.datetime.now().isoformat(timespec='seconds')}
+        save_notion_sync_state(sync_state, store_dir)
+    return {"paginas": pages_seen, "filas_nuevas": new_rows, "filas_reemplazadas": len(stale_hashes), "paginas_borradas": len(deleted_pages),
+            "resync_completo": full_resync, "marca_anterior": watermark, "marca_nueva": new_watermark}
+
+def row_store_as_source(store_dir=ROW_STORE_DIR):
+    # Filas del almacén (CSV + Notion) con columnas canónicas, para analizarlas como si fueran un CSV cargado.
+    filas = load_row_store(store_dir)["filas"]
+    source_df = filas[["IMEI", "Fecha", "Cliente", "Descripcion", "Origen"]].copy()
+    source_df["Fecha"] = pd.to_datetime(source_df["Fecha"].replace('', None), errors='coerce')
+    return source_df.reset_index(drop=True), hashlib.sha256("".join(sorted(filas["Row_Hash"])).encode('utf-8')).hexdigest()
+
+@st.cache_resource
+def get_row_store_lock():
+    # Un candado por proceso: los trabajos en segundo plano leen-modifican-escriben el almacén en disco.
+    return threading.Lock()
+
+# --- Background Analysis Jobs ---
+# El análisis corre en un hilo de trabajo fuera del script de Streamlit. El registro de trabajos vive a nivel
+# de proceso (st.cache_resource), así que sobrevive a reruns, recargas del navegador y websockets caídos.
+JOB_STATUS_QUEUED, JOB_STATUS_RUNNING, JOB_STATUS_DONE, JOB_STATUS_FAILED, JOB_STATUS_CANCELLED = \
+    "En cola", "Ejecutando", "Completado", "Error", "Cancelado"
+JOB_ACTIVE_STATUSES = (JOB_STATUS_QUEUED, JOB_STATUS_RUNNING)
+JOB_PARTIAL_EVENT_CHUNKS = 50 # el panel solo muestra la cola de resultados parciales
+PROGRESSIVE_RESULTS_REFRESH_SECONDS = 15 # cada cuánto se recargan en la vista de resultados los clientes ya finalizados
+JOB_MAX_FINISHED = int(os.environ.get("ANALISIS_MAX_FINISHED_JOBS", "20")) # trabajos terminados que se conservan (con sus DataFrames)
+JOB_FINISHED_TTL_SECONDS = int(os.environ.get("ANALISIS_FINISHED_JOB_TTL", str(6 * 3600)))
+
+class AnalysisJob:
+    def __init__(self, job_id, label, params, df_for_gemini_analysis, initial_log=""):
+        self.job_id = job_id
+        self.label = label
+        self.params = params
+        self.status = JOB_STATUS_QUEUED
+        self.progress = 0.0
+        self.status_message = "En cola..."
+        self.message = ""
+        self.log_string = initial_log
+        self.notices = []
+        self.partial_events = collections.deque(maxlen=JOB_PARTIAL_EVENT_CHUNKS) # últimos fragmentos (DataFrame) publicados lote a lote
+        self.partial_event_count = 0
+        self.client_results = {} # modo progresivo: cliente finalizado -> (eventos o None si se vuelcan a disco, estado)
+        self.clients_total = 0
+        self.client_results_version = 0
+        self._client_states_cache = (None, None) # (versión, estado concatenado) para el sondeo del panel
+        self.events_df = None
+        self.events_path = None # archivo de eventos volcado a disco (events_df es entonces solo una vista previa)
+        self.spill_path = None # archivo de volcado creado por el trabajo, aunque haya fallado (se borra al descartar el trabajo)
+        self.current_state_df = None
+        self.df_for_gemini_analysis = df_for_gemini_analysis
+        self.cancel_requested = False
+        self.created_at = datetime.datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def append_log(self, line):
+        with self._lock: self.log_string += line
+
+    def add_notice(self, message, level="warning"):
+        with self._lock: self.notices.append((level, message))
+
+    def update_progress(self, progress, status_message):
+        with self._lock:
+            if progress is not None: self.progress = progress
+            if status_message: self.status_message = status_message
+
+    def publish_partial_events(self, events_chunk, event_count=None):
+        with self._lock:
+            if events_chunk is not None: self.partial_events.append(events_chunk)
+            self.partial_event_count += len(events_chunk) if event_count is None else event_count
+
+    def get_partial_events_df(self):
+        with self._lock: chunks = [chunk for chunk in self.partial_events if not chunk.empty]
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=EVENT_COLUMNS)
+
+    def publish_client_result(self, client, events_df, state_df):
+        with self._lock:
+            self.client_results[client] = (events_df, state_df); self.client_results_version += 1
+
+    def release_client_events(self):
+        # Al terminar, los eventos completos viven en events_df: se sueltan las copias por cliente (el estado es pequeño).
+        with self._lock: self.client_results = {client: (None, state) for client, (_, state) in self.client_results.items()}
+
+    def get_client_states_df(self):
+        # Solo el estado de los clientes finalizados (lo que muestra el panel en cada sondeo); se concatena una vez por versión.
+        with self._lock:
+            version, cached = self._client_states_cache
+            if version == self.client_results_version: return cached
+            version, states = self.client_results_version, [state for _, state in self.client_results.values() if state is not None and not state.empty]
+        cached = pd.concat(states, ignore_index=True) if states else pd.DataFrame()
+        with self._lock: self._client_states_cache = (version, cached)
+        return cached
+
+    def get_client_results_df(self):
+        # -> (eventos, estado) de los clientes finalizados hasta ahora, en orden de finalización.
+        with self._lock: results = list(self.client_results.values())
+        event_frames = [events for events, _ in results if events is not None and not events.empty]
+        state_frames = [state for _, state in results if state is not None and not state.empty]
+        return (pd.concat(event_frames, ignore_index=True) if event_frames else pd.DataFrame(columns=EVENT_COLUMNS),
+                pd.concat(state_frames, ignore_index=True) if state_frames else pd.DataFrame())
+
+    @property
+    def is_active(self):
+        return self.status in JOB_ACTIVE_STATUSES
+
+class AnalysisJobRegistry:
+    def __init__(self, max_parallel_jobs=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_parallel_jobs, thread_name_prefix="analisis-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, label, target, params, df_for_gemini_analysis, initial_log=""):
+        job = AnalysisJob(uuid.uuid4().hex[:8], label, params, df_for_gemini_analysis, initial_log=initial_log)
+        with self._lock: self._jobs[job.job_id] = job
+        self._executor.submit(self._run, job, target)
+        return job
+
+    def _run(self, job, target):
+        if job.cancel_requested:
+            job.status, job.finished_at = JOB_STATUS_CANCELLED, datetime.datetime.now()
+            return
+        job.status, job.started_at = JOB_STATUS_RUNNING, datetime.datetime.now()
+        try:
+            target(job)
+            job.status = JOB_STATUS_CANCELLED if job.cancel_requested else JOB_STATUS_DONE
+        except Exception as e:
+            job.message = f"Error inesperado en trabajo de análisis: {e.__class__.__name__}: {e}"
+            job.append_log(f"{datetime.datetime.now().strftime('%H:%M:%S')} [CRITICAL] CRITICAL ERROR: {job.message}. Trace: {traceback.format_exc()}\n")
+            job.status = JOB_STATUS_FAILED
+        finally:
+            job.finished_at = datetime.datetime.now()
+
+    def get(self, job_id):
+        with self._lock: return self._jobs.get(job_id)
+
+    def list_jobs(self, job_ids=None):
+        # El registro es de todo el proceso: cada sesión ve solo los trabajos que envió (job_ids).
+        self.evict_finished()
+        with self._lock: jobs = [j for j in self._jobs.values() if job_ids is None or j.job_id in job_ids]
+        return sorted(jobs, key=lambda j: j.created_at, reverse=True)
+
+    def evict_finished(self):
+        # Los trabajos terminados retienen sus DataFrames: se descartan los que pasan del TTL o del máximo (los más viejos primero).
+        now = datetime.datetime.now()
+        with self._lock:
+            finished = sorted((j for j in self._jobs.values() if not j.is_active and j.finished_at), key=lambda j: j.finished_at, reverse=True)
+            evicted = [j for i, j in enumerate(finished) if i >= JOB_MAX_FINISHED or (now - j.finished_at).total_seconds() > JOB_FINISHED_TTL_SECONDS]
+            for job in evicted: del self._jobs[job.job_id]
+        for job in evicted:
+            # El volcado de eventos en EVENT_SPILL_DIR se borra con su trabajo (si no, se acumula en disco).
+            if job.spill_path and os.path.exists(job.spill_path):
+                try: os.remove(job.spill_path)
+                except OSError: pass
+        return evicted
+
+@st.cache_resource
+def get_job_registry():
+    return AnalysisJobRegistry(max_parallel_jobs=max(1, int(os.environ.get("ANALISIS_MAX_PARALLEL_JOBS", "1"))))
+
+def run_analysis_job(job):
+    # El registro se crea en el primer run del script; el contexto de log se fija aquí, en el namespace
+    # del run que envió el trabajo, que es el que usan process_data/update_log_display.
+    _job_context.job = job
+    # Las claves no quedan en job.params: el registro (y sus parámetros) vive en memoria mientras dure el proceso.
+    api_keys = job.params.pop('api_keys', [])
+    try:
+        _run_analysis_job_steps(job, api_keys)
+    finally:
+        job.release_client_events()
+        _job_context.job = None
+
+def _run_analysis_job_steps(job, api_keys):
+    p = job.params
+    df_cleaned = job.df_for_gemini_analysis
+    canonical_rows = canonical_service_rows(df_cleaned, p['imei_col'], p['date_col'], p['client_col'], p['desc_col'])
+    row_hashes = compute_row_hashes(df_cleaned, p['imei_col'], p['date_col'], p['client_col'], p['desc_col'])
+    with get_row_store_lock(): row_store = load_row_store()
+    stored_hashes = analyzed_row_hashes(row_store)
+    is_new_row = ~row_hashes.isin(stored_hashes)
+    df_to_analyze = df_cleaned[is_new_row.to_numpy()] if p.get('only_new_rows') else df_cleaned
+    reused_events = pd.DataFrame()
+    if p.get('only_new_rows'):
+        reused_hashes = set(row_hashes[~is_new_row])
+        reused_events = row_store["eventos"][row_store["eventos"]["Row_Hash"].isin(reused_hashes)]
+        reused_events = reused_events.assign(IMEI_Key=imei_device_keys(reused_events["IMEI"])) # el almacén no guarda la clave: una sola vez aquí
+        update_log_display(f"Almacén de filas: {int(is_new_row.sum())} fila(s) nuevas a analizar; {len(reused_hashes)} ya analizadas reutilizan {len(reused_events)} evento(s) guardados.", level="INFO")
+
+    event_sink = None
+    if p.get('spill_events'):
+        spill_path = os.path.join(EVENT_SPILL_DIR, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{job.job_id}.parquet")
+        job.spill_path = spill_path
+        event_sink = EventSpillSink(spill_path, row_positions=np.flatnonzero(is_new_row.to_numpy()) if p.get('only_new_rows') else None)
+        update_log_display(f"Volcado a disco activo: los eventos se escriben por lote en '{spill_path}'.", level="INFO")
+
+    update_log_display(f"Trabajo {job.job_id}: iniciando IA para {len(df_to_analyze)} filas...", level="INFO")
+    if df_to_analyze.empty:
+        events_res, proc_msg = pd.DataFrame(columns=list(reused_events.columns)), "No hay filas nuevas: todos los resultados provienen del almacén de filas."
+        events_res.attrs["completed_row_keys"] = []
+    else:
+        events_res, proc_msg = process_data(df_to_analyze, api_keys, p['imei_col'], p['desc_col'], p['date_col'], p['client_col'], p['batch_size'],
+                                            checkpoint_path=p['checkpoint_path'], resume=p['resume'], rpm_limit=p['rpm_limit'], tpm_limit=p['tpm_limit'],
+                                            template_clustering=p.get('template_clustering', True), label_reuse_threshold=p.get('label_reuse_threshold'),
+                                            row_keys=row_hashes[df_to_analyze.index].tolist(), event_sink=event_sink, model_tiers=p.get('model_tiers'),
+                                            renormalize=p.get('renormalize', False), progressive_clients=p.get('progressive_clients', False),
+                                            client_reused_events=reused_events if p.get('only_new_rows') else None,
+                                            fallback_events=row_store["eventos"] if p.get('renormalize') else None)
+    completed_row_keys = events_res.attrs.get("completed_row_keys", [])
+    for col in ["IMEI", "Descripcion_Original"]:
+        if col in events_res.columns: events_res[col] = events_res[col].astype(str) # mismo tipo que los eventos del almacén
+    if event_sink is not None and completed_row_keys:
+        # El almacén guarda sus eventos en memoria: con volcado a disco solo se registran las filas (se re-analizarán si se piden).
+        update_log_display(f"Volcado a disco: {len(completed_row_keys)} fila(s) analizadas no se marcan en el almacén de filas (sus eventos quedan solo en el archivo).", level="INFO")
+        completed_row_keys = []
+    try:
+        with get_row_store_lock():
+            row_store = load_row_store()
+            n_new_rows = upsert_row_store(row_store, canonical_rows, row_hashes, p.get('meta', {}).get('file_name') or "CSV", completed_row_keys, events_res)
+            save_row_store(row_store)
+        update_log_display(f"Almacén de filas actualizado: {n_new_rows} fila(s) nuevas registradas, {len(completed_row_keys)} marcadas como analizadas ({len(row_store['filas'])} en total).", level="INFO")
+    except Exception as e: update_log_display(f"No se pudo actualizar el almacén de filas '{ROW_STORE_DIR}': {e}", level="WARNING")
+
+    if event_sink is not None:
+        if not reused_events.empty:
+            reused_positions = pd.Series(np.arange(len(row_hashes)), index=row_hashes.to_numpy())
+            reused_positions = reused_positions[~reused_positions.index.duplicated()]
+            event_sink.append(reused_events.assign(Fila_Pos=reused_positions.reindex(reused_events["Row_Hash"]).to_numpy()), remap_positions=False)
+            proc_msg += f" {len(reused_events)} evento(s) reutilizados del almacén de filas."
+        event_sink.close()
+        job.events_path = event_sink.path
+        job.events_df = read_spilled_events(event_sink.path, limit=EVENT_SPILL_PREVIEW_ROWS)
+        job.message = proc_msg
+        update_log_display(f"Resultado process_data: {proc_msg}", level="INFO")
+        if event_sink.count:
+            update_log_display(f"Calculando estado final por fragmentos desde '{event_sink.path}' ({event_sink.count} eventos)...", level="INFO")
+            job.current_state_df = calculate_current_state(event_sink.path)
+            notify_user(f"Estado final calculado. {len(job.current_state_df)} registros.", level="success"); update_log_display(f"Estado final: {len(job.current_state_df)} registros.", level="INFO")
+        else:
+            notify_user("No eventos extraídos, no se calcula estado final."); update_log_display("WARN: No eventos, no estado final.", level="WARNING")
+            job.current_state_df = pd.DataFrame()
+        update_log_display(f"Eventos completos en '{event_sink.path}' (no se duplican en '{RESULTS_DIR}/').", level="INFO")
+        update_log_display(f"--- FIN ANÁLISIS ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---", level="INFO")
+        return
+
+    if not reused_events.empty:
+        # Orden original de filas: los eventos reutilizados y los nuevos se intercalan por posición de la fila.
+        row_position = pd.Series(np.arange(len(row_hashes)), index=row_hashes.to_numpy())
+        row_position = row_position[~row_position.index.duplicated()]
+        events_res = pd.concat([events_res, reused_events[events_res.columns]], ignore_index=True) if not events_res.empty else reused_events.reset_index(drop=True)
+        events_res = events_res.iloc[np.argsort(row_position.reindex(events_res["Row_Hash"]).to_numpy(), kind="stable")].reset_index(drop=True)
+        events_res['Fecha'] = pd.to_datetime(events_res['Fecha'], errors='coerce')
+        proc_msg += f" {len(reused_events)} evento(s) reutilizados del almacén de filas."
+    if "Row_Hash" in events_res.columns: events_res = events_res.drop(columns=["Row_Hash"])
+    job.events_df = events_res
+    job.message = proc_msg
+    update_log_display(f"Resultado process_data: {proc_msg}", level="INFO")
+
+    if events_res is not None and not events_res.empty:
+        update_log_display("Calculando estado final...", level="INFO")
+        current_state_res = calculate_current_state(events_res)
+        job.current_state_df = current_state_res
+        n_state = len(current_state_res)
+        if n_state > 0: notify_user(f"Estado final calculado. {n_state} registros.", level="success"); update_log_display(f"Estado final: {n_state} registros.", level="INFO")
+        else: notify_user("No se determinó estado final.", level="info"); update_log_display("INFO: No estado final.", level="INFO")
+    else:
+        notify_user("No eventos extraídos, no se calcula estado final."); update_log_display("WARN: No eventos, no estado final.", level="WARNING")
+        job.current_state_df = pd.DataFrame()
+    if events_res is not None and not events_res.empty:
+        try:
+            run_id = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{job.job_id}"
+            run_dir = save_results_parquet(events_res, job.current_state_df, df_cleaned, {**p.get('meta', {}), 'label': job.label}, run_id)
+            update_log_display(f"Resultados guardados en '{run_dir}' (Parquet). Se pueden reabrir sin llamar a Gemini.", level="INFO")
+        except Exception as e: update_log_display(f"No se pudieron guardar resultados en Parquet: {e}", level="WARNING")
+    update_log_display(f"--- FIN ANÁLISIS ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---", level="INFO")
+
+def load_job_results_into_session(job, partial=False):
+    if partial:
+        # Modo progresivo: solo los clientes ya finalizados (su estado no cambiará al terminar el trabajo).
+        partial_version = job.client_results_version
+        st.session_state.events_df, st.session_state.current_state_df = job.get_client_results_df()
+        st.session_state.events_path = None
+        st.session_state.partial_results_version = partial_version
+        st.session_state.partial_results_loaded_at = time.time()
+    else:
+        st.session_state.events_df = job.events_df if job.events_df is not None else pd.DataFrame()
+        st.session_state.events_path = job.events_path
+        st.session_state.current_state_df = job.current_state_df if job.current_state_df is not None else pd.DataFrame()
+        st.session_state.partial_results_version = None
+    st.session_state.df_for_gemini_analysis = job.df_for_gemini_analysis if job.df_for_gemini_analysis is not None else pd.DataFrame()
+    st.session_state.log_string = job.log_string
+    st.session_state.results_meta = dict(job.params.get('meta', {}))
+    if partial: st.session_state.results_meta['clientes_parciales'] = (len(job.client_results), job.clients_total)
+    st.session_state.loaded_job_id = job.job_id
+    st.session_state.processing_complete = True
+    st.session_state.results_version += 1
+
+def load_saved_results_into_session(run_dir):
+    loaded = load_results_parquet(run_dir)
+    st.session_state.events_df = loaded["events_df"]
+    st.session_state.events_path = None
+    st.session_state.current_state_df = loaded["current_state_df"]
+    st.session_state.df_for_gemini_analysis = loaded["df_for_gemini_analysis"]
+    st.session_state.results_meta = loaded["meta"]
+    st.session_state.loaded_job_id = None
+    st.session_state.partial_results_version = None
+    st.session_state.processing_complete = True
+    st.session_state.results_version += 1
+    update_log_display(f"Resultados previos cargados desde '{run_dir}': {len(loaded['events_df'])} eventos, {len(loaded['current_state_df'])} estados.", level="INFO")
 
 # --- User Interface ---
 st.sidebar.header("🔑 Configuración API Gemini")
@@ -736,46 +2988,128 @@ if api_key_input != st.session_state.api_key :
     st.session_state.api_key = api_key_input
     update_log_display("API Key actualizada.", level="INFO")
 
-st.sidebar.header("📄 Carga de Archivo CSV")
-uploaded_file = st.sidebar.file_uploader("Selecciona tu archivo CSV", type="csv", key="csv_uploader_ui")
+with st.sidebar.expander("🔑 Pool de API Keys (extracción en paralelo)"):
+    api_keys_extra_input = st.text_area("API Keys adicionales (una por línea o separadas por coma)", value=st.session_state.api_keys_extra,
+                                        help="También se leen de la variable de entorno GEMINI_API_KEYS. Cada clave procesa lotes en paralelo según su presupuesto.",
+                                        key="api_keys_extra_input_ui")
+    if api_keys_extra_input != st.session_state.api_keys_extra:
+        st.session_state.api_keys_extra = api_keys_extra_input
+        update_log_display("Pool de API Keys actualizado.", level="INFO")
+    st.session_state.key_rpm_limit = st.number_input("Límite RPM por clave", min_value=1, max_value=10000, step=1,
+                                                     value=int(st.session_state.key_rpm_limit or GEMINI_KEY_RPM_DEFAULT), key="key_rpm_limit_ui")
+    st.session_state.key_tpm_limit = st.number_input("Límite TPM por clave", min_value=1000, max_value=100000000, step=1000,
+                                                     value=int(st.session_state.key_tpm_limit or GEMINI_KEY_TPM_DEFAULT), key="key_tpm_limit_ui")
+
+api_keys_current = parse_api_keys(st.session_state.api_key, st.session_state.api_keys_extra)
+if len(api_keys_current) > 1:
+    st.sidebar.caption(f"{len(api_keys_current)} API Keys en el pool.")
+    key_pool_rows = get_gemini_key_pool(tuple(api_keys_current), st.session_state.key_rpm_limit, st.session_state.key_tpm_limit, GEMINI_MAX_IN_FLIGHT_PER_KEY).status_rows()
+    if any(r["Llamadas"] or r["Estado"] != "Activa" for r in key_pool_rows):
+        with st.sidebar.expander("📶 Estado del pool de claves"):
+            st.dataframe(pd.DataFrame(key_pool_rows), hide_index=True, use_container_width=True)
+
+st.sidebar.header("📄 Carga de Archivos CSV")
+uploaded_files = st.sidebar.file_uploader("Selecciona tus archivos CSV (una o varias exportaciones)", type="csv", accept_multiple_files=True, key="csv_uploader_ui",
+                                          help="Las exportaciones se fusionan; las filas repetidas entre exportaciones se cuentan una sola vez.")
+
+def read_uploaded_csv(uploaded_file):
+    try:
+        # Todo como texto: un IMEI numérico se leería como float ('3.596321e+14') y perdería dígitos.
+        uploaded_file.seek(0); df_read = pd.read_csv(uploaded_file, dtype=str)
+        update_log_display(f"CSV '{uploaded_file.name}' leído con UTF-8.", level="DEBUG")
+        return df_read, 'utf-8'
+    except UnicodeDecodeError:
+        update_log_display(f"Fallo UTF-8 en '{uploaded_file.name}', intentando latin1...", level="WARNING")
+        uploaded_file.seek(0); df_read = pd.read_csv(uploaded_file, encoding='latin1', dtype=str)
+        update_log_display(f"CSV '{uploaded_file.name}' leído con latin1.", level="DEBUG")
+        return df_read, 'latin1'
+
+def load_source_into_session(df_source, source_name, source_hash):
+    st.session_state.df_loaded = df_source
+    st.session_state.file_name = source_name
+    st.session_state.file_hash = source_hash
+    st.session_state.column_options = df_source.columns.tolist()
+    st.session_state.row_hashes = None
+    for k in ['min_date', 'max_date', 'start_date', 'end_date', 'events_df', 'events_path', 'current_state_df', 'df_for_gemini_analysis']:
+        st.session_state[k] = None if k not in ['events_df', 'current_state_df', 'df_for_gemini_analysis'] else pd.DataFrame()
+    st.session_state.selected_clients_list = ["-- TODOS --"]
+    st.session_state.processing_complete = False
+    st.session_state.results_version += 1
 
-if uploaded_file is not None and (st.session_state.df_loaded is None or uploaded_file.name != st.session_state.file_name):
-    update_log_display(f"Nuevo archivo '{uploaded_file.name}' detectado.", level="INFO")
+uploaded_names = sorted(f.name for f in uploaded_files) if uploaded_files else []
+uploaded_label = (uploaded_names[0] if len(uploaded_names) == 1 else f"{len(uploaded_names)} archivos: {', '.join(uploaded_names)}") if uploaded_names else None
+if uploaded_files and (st.session_state.df_loaded is None or uploaded_label != st.session_state.uploaded_label_loaded):
+    update_log_display(f"Nuevos archivos detectados: {', '.join(uploaded_names)}.", level="INFO")
     try:
-        df_attempt = None; encoding_used = None
-        try:
-            uploaded_file.seek(0); df_attempt = pd.read_csv(uploaded_file); encoding_used = 'utf-8'
-            update_log_display(f"CSV leído con UTF-8.", level="DEBUG")
-        except UnicodeDecodeError:
-            update_log_display("Fallo UTF-8, intentando latin1...", level="WARNING")
-            uploaded_file.seek(0); df_attempt = pd.read_csv(uploaded_file, encoding='latin1'); encoding_used = 'latin1'
-            update_log_display(f"CSV leído con latin1.", level="DEBUG")
-        except pd.errors.ParserError as pe:
-            st.error(f"Error de parseo CSV: {pe}. Verifique formato."); update_log_display(f"Error parseo CSV '{uploaded_file.name}': {pe}", level="ERROR")
-        except Exception as e:
-            st.error(f"Error crítico leyendo CSV: {e}"); update_log_display(f"Error crítico leyendo CSV '{uploaded_file.name}': {e}", level="CRITICAL")
-
-        if df_attempt is not None:
-            st.session_state.df_loaded = df_attempt
-            st.session_state.file_name = uploaded_file.name
-            st.session_state.column_options = df_attempt.columns.tolist()
-            st.sidebar.success(f"Archivo '{uploaded_file.name}' ({len(df_attempt)} filas) cargado (enc: '{encoding_used}').")
-            update_log_display(f"Archivo '{uploaded_file.name}' ({len(df_attempt)} filas) cargado. Enc: {encoding_used}.", level="INFO")
-            for k in ['min_date', 'max_date', 'start_date', 'end_date', 'events_df', 'current_state_df', 'df_for_gemini_analysis']:
-                st.session_state[k] = None if k not in ['events_df', 'current_state_df', 'df_for_gemini_analysis'] else pd.DataFrame()
-            st.session_state.selected_clients_list = ["-- TODOS --"]
-            st.session_state.processing_complete = False
+        frames, file_hashes, encodings_used = [], [], []
+        for uploaded_file in uploaded_files:
+            try:
+                df_read, encoding_used = read_uploaded_csv(uploaded_file)
+                frames.append(df_read); encodings_used.append(encoding_used)
+                file_hashes.append(hashlib.sha256(uploaded_file.getvalue()).hexdigest())
+                update_log_display(f"Archivo '{uploaded_file.name}': {len(df_read)} filas (enc: {encoding_used}).", level="INFO")
+            except pd.errors.ParserError as pe:
+                st.error(f"Error de parseo CSV en '{uploaded_file.name}': {pe}. Verifique formato."); update_log_display(f"Error parseo CSV '{uploaded_file.name}': {pe}", level="ERROR")
+            except Exception as e:
+                st.error(f"Error crítico leyendo '{uploaded_file.name}': {e}"); update_log_display(f"Error crítico leyendo CSV '{uploaded_file.name}': {e}", level="CRITICAL")
+
+        if frames:
+            # Cada exportación trae el historial completo: filas idénticas entre archivos se conservan una vez.
+            df_attempt = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+            rows_before_merge = len(df_attempt)
+            df_attempt = df_attempt.drop_duplicates().reset_index(drop=True)
+            load_source_into_session(df_attempt, uploaded_label, file_hashes[0] if len(file_hashes) == 1 else hashlib.sha256("".join(sorted(file_hashes)).encode('utf-8')).hexdigest())
+            st.session_state.uploaded_label_loaded = uploaded_label
+            st.sidebar.success(f"{len(frames)} archivo(s) cargados: {len(df_attempt)} filas únicas de {rows_before_merge} (enc: {', '.join(sorted(set(encodings_used)))}).")
+            update_log_display(f"Exportaciones fusionadas: {len(df_attempt)} filas únicas de {rows_before_merge} ({rows_before_merge - len(df_attempt)} duplicadas).", level="INFO")
             st.rerun()
     except Exception as e_load:
-        st.sidebar.error(f"Error procesando archivo: {e_load}"); update_log_display(f"Error general cargando '{uploaded_file.name if uploaded_file else 'N/A'}': {e_load}", level="ERROR")
+        st.sidebar.error(f"Error procesando archivos: {e_load}"); update_log_display(f"Error general cargando '{uploaded_label or 'N/A'}': {e_load}", level="ERROR")
         for k in ['df_loaded', 'file_name', 'column_options', 'min_date', 'max_date']: st.session_state[k] = None if k != 'column_options' else []
         st.rerun()
 
+with st.sidebar.expander("🔄 Sincronizar desde Notion"):
+    notion_token = st.text_input("Token de integración Notion", type="password", value=os.environ.get("NOTION_TOKEN", ""), key="notion_token_ui")
+    notion_database_id = st.text_input("ID de la base de datos", value=NOTION_DATABASE_ID_DEFAULT, key="notion_database_ui")
+    notion_prop_cols = st.columns(2)
+    notion_property_names = {col: notion_prop_cols[i % 2].text_input(f"Propiedad {col}:", value=prop_name, key=f"notion_prop_{col}_ui")
+                             for i, (col, prop_name) in enumerate(NOTION_PROPERTY_DEFAULTS.items())}
+    notion_watermark = load_notion_sync_state().get(notion_database_id)
+    st.caption(f"Última sincronización (last_edited_time): {notion_watermark}" if notion_watermark else "Sin sincronizaciones previas: la primera trae toda la base.")
+    notion_full_resync = st.checkbox("Resincronizar todo (ignorar marca)", key="notion_full_resync_ui",
+                                     help=f"Además se hace sola cada {NOTION_FULL_RESYNC_HOURS:g} h: es la única forma de detectar páginas borradas en Notion.")
+    if st.button("🔄 Sincronizar", disabled=not (notion_token and notion_database_id), key="notion_sync_btn"):
+        try:
+            with st.spinner("Consultando Notion..."):
+                sync_summary = sync_notion_to_row_store(NotionClient(notion_token), notion_database_id, notion_property_names, full_resync=notion_full_resync)
+            st.success(f"{sync_summary['paginas']} página(s) leídas{' (resincronización completa)' if sync_summary['resync_completo'] else ''}: {sync_summary['filas_nuevas']} fila(s) nuevas, "
+                       f"{sync_summary['filas_reemplazadas']} reemplazadas o eliminadas ({sync_summary['paginas_borradas']} página(s) borradas en Notion).")
+            update_log_display(f"Sincronización Notion {notion_database_id}: {sync_summary}", level="INFO")
+        except Exception as e: st.error(f"Error sincronizando Notion: {e}"); update_log_display(f"Error sincronizando Notion: {e}. Trace: {traceback.format_exc()}", level="ERROR")
+    if st.button("📥 Usar almacén de filas como fuente", disabled=row_store_mtime() is None, key="row_store_source_btn",
+                 help="Carga todas las filas del almacén (CSV + Notion) con columnas IMEI, Fecha, Cliente, Descripcion."):
+        try:
+            store_source_df, store_source_hash = row_store_as_source()
+            load_source_into_session(store_source_df, "Almacén de filas (CSV + Notion)", store_source_hash)
+            update_log_display(f"Fuente: almacén de filas ({len(store_source_df)} filas).", level="INFO")
+            st.rerun()
+        except Exception as e: st.error(f"Error cargando el almacén de filas: {e}"); update_log_display(f"Error cargando almacén de filas: {e}", level="ERROR")
+
 df_loaded = st.session_state.df_loaded
 column_options = st.session_state.column_options
 min_date = st.session_state.min_date
 max_date = st.session_state.max_date
 
+with st.sidebar.expander("📂 Abrir Resultados Previos (sin IA)"):
+    saved_results = list_saved_results()
+    saved_labels = {run_dir: f"{meta.get('saved_at', '?')} | {meta.get('file_name') or 'N/A'} | {meta.get('start_date', '?')} a {meta.get('end_date', '?')}" for run_dir, meta in saved_results}
+    saved_choice = st.selectbox("Resultados guardados:", [""] + list(saved_labels), format_func=lambda d: saved_labels.get(d, "-- Seleccionar --"), key="saved_results_select_ui")
+    saved_path = st.text_input(f"...o nombre de una carpeta dentro de '{RESULTS_DIR}/':", key="saved_results_path_ui", help=f"Carpeta con {', '.join(RESULTS_FILES.values())}.")
+    open_dir = saved_path.strip() or saved_choice
+    if st.button("📂 Abrir", disabled=not open_dir, key="open_saved_results_btn"):
+        try: load_saved_results_into_session(resolve_results_dir(saved_path.strip()) if saved_path.strip() else saved_choice); st.rerun()
+        except Exception as e: st.error(f"No se pudieron abrir los resultados: {e}"); update_log_display(f"Error abriendo resultados '{open_dir}': {e}", level="ERROR")
+
 st.sidebar.header("📊 Configuración de Columnas")
 current_selections_for_find = {
     'imei': st.session_state.get('imei_col', None),
@@ -911,8 +3245,12 @@ selected_clients_to_filter = []
 
 if df_loaded is not None and client_col and client_col != "N/A" and client_col in df_loaded.columns:
     try:
-        client_options_raw = df_loaded[client_col].astype(str).fillna('').unique()
-        client_options_list = sorted([c.strip() for c in client_options_raw if c.strip()])
+        filter_index_key = (st.session_state.file_hash, date_col, client_col, len(df_loaded))
+        if st.session_state.filter_index is None or st.session_state.filter_index_key != filter_index_key:
+            st.session_state.filter_index = build_filter_index(df_loaded, date_col, client_col) if date_col and date_col != "N/A" and date_col in df_loaded.columns \
+                else build_filter_index(df_loaded.assign(__sin_fecha__=pd.NaT), "__sin_fecha__", client_col)
+            st.session_state.filter_index_key = filter_index_key
+        client_options_list = [c for c in st.session_state.filter_index["client_names"] if c]
 
         if client_options_list:
             options_ms = ["-- TODOS --"] + client_options_list
@@ -952,27 +3290,107 @@ batch_size_ui = st.sidebar.slider("Tamaño del Lote (desc/llamada API):", min_va
                                   help=f"Menor=más lento pero estable. Recomendado: {default_values['batch_size']}.",
                                   disabled=df_loaded is None, key="batch_size_slider_ui")
 st.session_state.batch_size = batch_size_ui
-
-analyze_disabled = not (
-    st.session_state.api_key and df_loaded is not None and
+st.session_state.model_tiers = st.sidebar.text_input(
+    "Cascada de modelos (barato → potente):", value=st.session_state.model_tiers,
+    help="Modelos Gemini separados por comas. Cada lote va primero al primero; solo las descripciones con estructura inválida, longitud incorrecta "
+         "o componente 'Desconocido' se reenvían al siguiente. Un solo modelo = sin escalado. La latencia, tokens y tasa de escalado por nivel quedan en el log.",
+    key="model_tiers_input_ui")
+model_tiers_current = parse_model_tiers(st.session_state.model_tiers)
+st.session_state.template_clustering = st.sidebar.checkbox(
+    "Agrupar descripciones por plantilla", value=st.session_state.template_clustering,
+    help="Sustituye IMEIs, MACs, tags TDBLE y números de serie por marcadores; las descripciones que solo difieren en IDs se envían a Gemini una sola vez.",
+    key="template_clustering_checkbox_ui")
+st.session_state.label_reuse_enabled = st.sidebar.checkbox(
+    "Reutilizar etiquetas de descripciones similares", value=st.session_state.label_reuse_enabled,
+    help="Descripciones casi iguales a otras ya analizadas (typos, orden de palabras) toman los eventos guardados sin llamar a Gemini.",
+    key="label_reuse_checkbox_ui")
+if st.session_state.label_reuse_enabled:
+    st.session_state.label_reuse_threshold = st.sidebar.slider(
+        "Similitud mínima para reutilizar:", min_value=0.60, max_value=1.0, value=float(st.session_state.label_reuse_threshold), step=0.01,
+        help="Similitud de Jaccard estimada (MinHash de 3-gramas de caracteres). 1.0 = solo descripciones idénticas tras normalizar.",
+        key="label_reuse_threshold_slider_ui")
+
+st.session_state.spill_events = st.sidebar.checkbox(
+    "Volcar eventos a disco (memoria acotada)", value=st.session_state.spill_events,
+    help=f"Para historiales muy grandes: cada lote se escribe a un Parquet en '{EVENT_SPILL_DIR}/' y el estado final se calcula por fragmentos. "
+         "Los resultados muestran una vista previa de los eventos; el detalle por IMEI se lee del archivo.",
+    key="spill_events_checkbox_ui")
+st.session_state.progressive_clients = st.sidebar.checkbox(
+    "Resultados progresivos por cliente", value=st.session_state.progressive_clients,
+    help="Procesa un cliente tras otro (los más pequeños primero) y publica el estado de cada cliente en cuanto termina, "
+         "sin esperar al resto del análisis.",
+    key="progressive_clients_checkbox_ui")
+
+stored_row_count = 0
+cols_ready = df_loaded is not None and all(c and c != "N/A" and c in df_loaded.columns for c in [imei_col, desc_col, date_col, client_col])
+if cols_ready:
+    try:
+        row_hashes_key = (st.session_state.file_hash, imei_col, date_col, client_col, desc_col)
+        if st.session_state.row_hashes is None or st.session_state.row_hashes_key != row_hashes_key:
+            st.session_state.row_hashes = compute_row_hashes(df_loaded, imei_col, date_col, client_col, desc_col)
+            st.session_state.row_hashes_key = row_hashes_key
+        stored_hashes = get_analyzed_row_hashes(ROW_STORE_DIR, row_store_mtime())
+        stored_row_count = len(stored_hashes)
+        new_rows_count = int((~st.session_state.row_hashes.isin(stored_hashes)).sum())
+        st.sidebar.caption(f"Almacén de filas: {new_rows_count} fila(s) nuevas de {len(df_loaded)} ({len(df_loaded) - new_rows_count} ya analizadas).")
+    except Exception as e_hash:
+        st.sidebar.warning(f"No se pudo comparar con el almacén de filas: {e_hash}"); update_log_display(f"Error calculando hashes de filas: {e_hash}", level="WARNING")
+st.session_state.only_new_rows = st.sidebar.checkbox(
+    "Analizar solo filas nuevas", value=st.session_state.only_new_rows, disabled=stored_row_count == 0,
+    help="Las filas ya analizadas en exportaciones anteriores (mismo IMEI, fecha, cliente y descripción) reutilizan sus eventos guardados.",
+    key="only_new_rows_checkbox_ui")
+
+checkpoint_path_current = checkpoint_path_renormalize = None
+if df_loaded is not None and st.session_state.get('file_hash'):
+    # Contenido de entrada + ajustes que cambian los resultados (no el tamaño del almacén de filas: cada análisis lo cambia y
+    # "Reanudar" dejaría de encontrar su checkpoint). Si las filas a analizar cambian, cada lote se valida por su contenido.
+    checkpoint_filters = {"clientes": sorted(selected_clients_to_filter), "start_date": start_date, "end_date": end_date}
+    checkpoint_settings = {"imei_col": imei_col, "desc_col": desc_col, "date_col": date_col, "client_col": client_col, "batch_size": st.session_state.batch_size,
+                           "template_clustering": st.session_state.template_clustering, "model_tiers": list(model_tiers_current),
+                           "label_reuse_threshold": st.session_state.label_reuse_threshold if st.session_state.label_reuse_enabled else None,
+                           "progressive_clients": st.session_state.progressive_clients, "only_new_rows": st.session_state.only_new_rows}
+    checkpoint_path_current = get_checkpoint_path(build_checkpoint_key(st.session_state.file_hash, checkpoint_filters, {**checkpoint_settings, "renormalize": False}))
+    checkpoint_path_renormalize = get_checkpoint_path(build_checkpoint_key(st.session_state.file_hash, checkpoint_filters, {**checkpoint_settings, "renormalize": True}))
+
+checkpoint_exists = bool(checkpoint_path_current and os.path.exists(checkpoint_path_current))
+renormalize_checkpoint_exists = bool(checkpoint_path_current and os.path.exists(checkpoint_path_renormalize))
+st.session_state.resume_analysis = st.sidebar.checkbox(
+    "Reanudar (omitir lotes ya completados)", value=st.session_state.resume_analysis,
+    help="Usa el checkpoint en disco de un análisis previo con el mismo archivo, filtros y ajustes para no repetir lotes ya procesados.",
+    disabled=not (checkpoint_exists or renormalize_checkpoint_exists), key="resume_checkbox_ui")
+if checkpoint_exists:
+    st.sidebar.caption(f"Checkpoint encontrado: {len(load_checkpoint(checkpoint_path_current))} lote(s) completados.")
+if renormalize_checkpoint_exists:
+    st.sidebar.caption(f"Checkpoint de re-normalización encontrado: {len(load_checkpoint(checkpoint_path_renormalize))} lote(s) completados.")
+
+inputs_ready = bool(
+    df_loaded is not None and
     imei_col and imei_col != "N/A" and desc_col and desc_col != "N/A" and
     date_col and date_col != "N/A" and client_col and client_col != "N/A" and
     valid_date_range and start_date is not None and end_date is not None
 )
-
-if st.sidebar.button("🚀 Analizar Historial", disabled=analyze_disabled, type="primary", key="analyze_button_ui"):
-    st.session_state.processing_complete = False
-    st.session_state.events_df = pd.DataFrame(); st.session_state.current_state_df = pd.DataFrame()
-    st.session_state.df_for_gemini_analysis = pd.DataFrame()
-    st.session_state.log_string = "Iniciando análisis...\n"
-
-    api_key_use = st.session_state.api_key
+analyze_disabled = not (api_keys_current and inputs_ready)
+
+analyze_clicked = st.sidebar.button("🚀 Analizar Historial", disabled=analyze_disabled, type="primary", key="analyze_button_ui",
+                                    help="Encola el análisis como trabajo en segundo plano. Puede seguir navegando resultados previos mientras corre.")
+renormalize_clicked = st.sidebar.button("♻️ Re-normalizar (sin IA)", disabled=not inputs_ready, key="renormalize_button_ui",
+                                        help=f"Reconstruye eventos y estado con las mismas filas y filtros, pasando las respuestas crudas guardadas en '{RAW_RESPONSE_STORE_PATH}' "
+                                             "por las reglas actuales (MAPEO_COMPONENTES, palabras clave de acciones). No consume tokens; las filas sin respuesta guardada conservan sus eventos del almacén de filas.")
+if analyze_clicked or renormalize_clicked:
+    # Los resultados que se están viendo no se borran: el análisis corre como trabajo en segundo plano.
+    st.session_state.log_string += "Iniciando análisis...\n"
+    log_start_offset = len(st.session_state.log_string) - len("Iniciando análisis...\n")
+
+    api_keys_use = list(api_keys_current)
     imei_col_use, desc_col_use, date_col_use, client_col_use = imei_col, desc_col, date_col, client_col
     start_date_use, end_date_use = start_date, end_date
     batch_size_use = st.session_state.batch_size
+    # La re-normalización no filtra filas nuevas (se re-derivan todas) y usa su propio checkpoint: sus lotes no son intercambiables con los de la IA.
+    checkpoint_path_use = checkpoint_path_renormalize if renormalize_clicked else checkpoint_path_current
+    resume_use = (renormalize_checkpoint_exists if renormalize_clicked else checkpoint_exists) and st.session_state.resume_analysis
 
     errors = []
-    if not api_key_use: errors.append("API Key no ingresada.")
+    if not api_keys_use and not renormalize_clicked: errors.append("API Key no ingresada.")
     if df_loaded is None: errors.append("Archivo CSV no cargado.")
     if not all([imei_col_use, desc_col_use, date_col_use, client_col_use]) or \
        any(c == "N/A" for c in [imei_col_use, desc_col_use, date_col_use, client_col_use]):
@@ -988,43 +3406,37 @@ if st.sidebar.button("🚀 Analizar Historial", disabled=analyze_disabled, type=
 
     st.info(f"Iniciando análisis con lote = {batch_size_use}...")
     ts_now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    update_log_display(f"\n--- INICIO ANÁLISIS ({ts_now}) ---", level="INFO")
+    update_log_display(f"\n--- INICIO {'RE-NORMALIZACIÓN (sin IA)' if renormalize_clicked else 'ANÁLISIS'} ({ts_now}) ---", level="INFO")
     update_log_display(f"Archivo: {st.session_state.get('file_name', 'N/A')}", level="INFO")
     update_log_display(f"Rango Fechas: {start_date_use} a {end_date_use}", level="INFO")
     update_log_display(f"Columnas: IMEI='{imei_col_use}', Cliente='{client_col_use}', Desc='{desc_col_use}', Fecha='{date_col_use}'", level="INFO")
     update_log_display(f"Clientes Filtro: {', '.join(selected_clients_to_filter) if selected_clients_to_filter else 'TODOS'}", level="INFO")
     update_log_display(f"Tamaño Lote: {batch_size_use}", level="INFO")
+    update_log_display(f"Checkpoint: {checkpoint_path_use or 'N/A'} (Reanudar: {'Sí' if resume_use else 'No'})", level="INFO")
 
     try:
-        df_proc = df_loaded.copy()
+        filter_index = st.session_state.filter_index
+        if filter_index is None or st.session_state.filter_index_key[1:3] != (date_col_use, client_col_use):
+            filter_index = build_filter_index(df_loaded, date_col_use, client_col_use)
+        start_dt = datetime.datetime.combine(start_date_use, datetime.time.min)
+        end_dt = datetime.datetime.combine(end_date_use, datetime.time.max)
+        update_log_display(f"Filtrando: {len(selected_clients_to_filter) or 'todos los'} cliente(s), fechas {start_dt.date()} a {end_dt.date()} (índice de filtros).", level="DEBUG")
 
         if selected_clients_to_filter:
-            update_log_display(f"Filtrando por {len(selected_clients_to_filter)} cliente(s): {', '.join(selected_clients_to_filter)}", level="DEBUG")
-            df_proc = df_proc[df_proc[client_col_use].astype(str).str.strip().isin(selected_clients_to_filter)]
-            update_log_display(f"Filas post-cliente: {len(df_proc)}", level="INFO")
-            if df_proc.empty:
+            client_rows = sum(len(filter_index["client_positions"].get(c, ())) for c in selected_clients_to_filter)
+            update_log_display(f"Filas post-cliente: {client_rows}", level="INFO")
+            if client_rows == 0:
                  st.warning("No datos para clientes seleccionados."); update_log_display("WARN: No datos para clientes.", level="WARNING")
-                 st.session_state.processing_complete = True; st.session_state.events_df = pd.DataFrame(); st.session_state.current_state_df = pd.DataFrame()
-                 st.session_state.df_for_gemini_analysis = pd.DataFrame()
                  st.stop()
 
-        if not pd.api.types.is_datetime64_any_dtype(df_proc[date_col_use]):
-             update_log_display(f"WARN: '{date_col_use}' no es datetime en df_proc. Re-convirtiendo...", level="WARNING")
-             try:
-                 df_proc[date_col_use] = pd.to_datetime(df_proc[date_col_use], errors='coerce')
-                 if df_proc[date_col_use].isnull().all():
-                     st.error(f"Error: No se pudieron convertir fechas en '{date_col_use}' para el filtrado. Deteniendo."); update_log_display(f"CRIT: Fallo re-conversión '{date_col_use}' para filtro.", level="CRITICAL")
-                     st.stop()
-             except Exception as e_conv:
-                 st.error(f"Error convirtiendo '{date_col_use}' para filtro: {e_conv}. Deteniendo."); update_log_display(f"CRIT: Error conv. '{date_col_use}' filtro: {e_conv}", level="CRITICAL")
-                 st.stop()
+        if len(filter_index["sorted_dates"]) == 0:
+            st.error(f"Error: No se pudieron convertir fechas en '{date_col_use}' para el filtrado. Deteniendo."); update_log_display(f"CRIT: Sin fechas válidas en '{date_col_use}' para filtro.", level="CRITICAL")
+            st.stop()
 
-        start_dt = datetime.datetime.combine(start_date_use, datetime.time.min)
-        end_dt = datetime.datetime.combine(end_date_use, datetime.time.max)
-        update_log_display(f"Filtrando fechas: {start_dt.date()} a {end_dt.date()}.", level="DEBUG")
-
-        date_series_filt = pd.to_datetime(df_proc[date_col_use], errors='coerce')
-        df_proc = df_proc[(date_series_filt.notna()) & (date_series_filt >= start_dt) & (date_series_filt <= end_dt)].copy()
+        filtered_positions = resolve_filter_positions(filter_index, selected_clients_to_filter, start_dt, end_dt)
+        df_proc = df_loaded.iloc[filtered_positions]
+        if not pd.api.types.is_datetime64_any_dtype(df_proc[date_col_use]):
+            df_proc = df_proc.assign(**{date_col_use: pd.to_datetime(df_proc[date_col_use], errors='coerce')})
         update_log_display(f"Filas post-fecha: {len(df_proc)}", level="INFO")
 
         count_pre_na = len(df_proc)
@@ -1037,43 +3449,126 @@ if st.sidebar.button("🚀 Analizar Historial", disabled=analyze_disabled, type=
         rows_dropped = count_pre_na - len(df_cleaned)
         if rows_dropped > 0:
             st.warning(f"Se ignoraron {rows_dropped} filas con vacíos en cols. clave post-filtros."); update_log_display(f"WARN: {rows_dropped} filas ignoradas (vacíos).", level="WARNING")
+        # IMEI canónico desde la ingesta: eventos, estado y detalle comparan el mismo texto de 15 dígitos.
+        imei_canonical = canonicalize_imeis(df_cleaned[imei_col_use])
+        df_cleaned = df_cleaned.assign(**{imei_col_use: imei_canonical["IMEI"], "IMEI_Key": device_keys_from_canonical(imei_canonical)})
+        imeis_invalid = int((~imei_canonical["IMEI_Valido"]).sum())
+        if imeis_invalid:
+            st.warning(f"{imeis_invalid} fila(s) con IMEI inválido (se analizan igual; detalle en el reporte de IMEIs de los resultados).")
+            update_log_display(f"IMEIs inválidos: {imeis_invalid} fila(s) ({imei_canonical.loc[~imei_canonical['IMEI_Valido'], 'Motivo'].value_counts().to_dict()}).", level="WARNING")
         update_log_display(f"Filas válidas finales para IA: {len(df_cleaned)}", level="INFO")
 
-        st.session_state.df_for_gemini_analysis = df_cleaned.copy() # GUARDAR df_cleaned
-
         if df_cleaned.empty:
             st.warning("No datos válidos para IA post-filtros/limpieza."); update_log_display("WARN: No datos para IA.", level="WARNING")
-            st.session_state.processing_complete = True; st.session_state.events_df = pd.DataFrame(); st.session_state.current_state_df = pd.DataFrame()
         else:
-            st.info(f"Iniciando IA para {len(df_cleaned)} filas..."); update_log_display(f"Iniciando IA para {len(df_cleaned)} filas...", level="INFO")
-
-            events_res, proc_msg = process_data(df_cleaned, api_key_use, imei_col_use, desc_col_use, date_col_use, client_col_use, batch_size_use)
-            st.session_state.events_df = events_res
-            update_log_display(f"Resultado process_data: {proc_msg}", level="INFO")
-
-            if events_res is not None and not events_res.empty:
-                st.info("Calculando estado final..."); update_log_display("Calculando estado final...", level="INFO")
-                current_state_res = calculate_current_state(events_res)
-                st.session_state.current_state_df = current_state_res
-
-                n_state = len(current_state_res)
-                if n_state > 0: st.success(f"Estado final calculado. {n_state} registros."); update_log_display(f"Estado final: {n_state} registros.", level="INFO")
-                else: st.info("No se determinó estado final."); update_log_display("INFO: No estado final.", level="INFO")
-            else:
-                 st.warning("No eventos extraídos, no se calcula estado final."); update_log_display("WARN: No eventos, no estado final.", level="WARNING")
-                 st.session_state.current_state_df = pd.DataFrame()
-
-        update_log_display(f"--- FIN ANÁLISIS ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---", level="INFO")
-        st.session_state.processing_complete = True
+            update_log_display(f"Encolando trabajo de IA para {len(df_cleaned)} filas...", level="INFO")
+            job_params = {
+                'api_keys': api_keys_use, 'rpm_limit': st.session_state.key_rpm_limit, 'tpm_limit': st.session_state.key_tpm_limit, 'imei_col': imei_col_use, 'desc_col': desc_col_use, 'date_col': date_col_use, 'client_col': client_col_use,
+                'batch_size': batch_size_use, 'checkpoint_path': checkpoint_path_use, 'resume': resume_use, 'template_clustering': st.session_state.template_clustering,
+                'label_reuse_threshold': st.session_state.label_reuse_threshold if st.session_state.label_reuse_enabled else None,
+                'only_new_rows': st.session_state.only_new_rows and stored_row_count > 0 and not renormalize_clicked, 'renormalize': renormalize_clicked, 'spill_events': st.session_state.spill_events, 'model_tiers': model_tiers_current,
+                'progressive_clients': st.session_state.progressive_clients,
+                'meta': {'file_name': st.session_state.get('file_name'), 'start_date': start_date_use, 'end_date': end_date_use,
+                         'selected_clients_list': list(st.session_state.get('selected_clients_list', ["-- TODOS --"])),
+                         'imei_col': imei_col_use, 'desc_col': desc_col_use, 'date_col': date_col_use, 'client_col': client_col_use}
+            }
+            clients_label = ', '.join(selected_clients_to_filter) if selected_clients_to_filter else 'TODOS'
+            job_label = f"{'♻️ ' if renormalize_clicked else ''}{st.session_state.get('file_name', 'N/A')} | {start_date_use} a {end_date_use} | {clients_label[:40]} | {len(df_cleaned)} filas"
+            registry = get_job_registry()
+            job = registry.submit(job_label, run_analysis_job, job_params, df_cleaned.copy(), # GUARDAR df_cleaned
+                                  initial_log=st.session_state.log_string[log_start_offset:])
+            st.session_state.job_ids = st.session_state.job_ids + [job.job_id]
+            st.query_params["trabajos"] = ",".join(st.session_state.job_ids)
+            st.session_state.active_job_id = job.job_id
+            st.session_state.auto_load_job_id = job.job_id
+            st.toast(f"Trabajo {job.job_id} encolado ({len(df_cleaned)} filas).")
+            update_log_display(f"Trabajo {job.job_id} encolado.", level="INFO")
         st.rerun()
 
     except Exception as e_main:
         err_msg = f"Error inesperado en flujo principal: {e_main.__class__.__name__}: {e_main}"
         update_log_display(f"CRITICAL ERROR: {err_msg}. Trace: {traceback.format_exc()}", level="CRITICAL")
         st.error(err_msg); st.exception(e_main)
-        st.session_state.events_df = pd.DataFrame(); st.session_state.current_state_df = pd.DataFrame()
-        st.session_state.df_for_gemini_analysis = pd.DataFrame()
-        st.session_state.processing_complete = True
+
+# --- Trabajos de Análisis en Segundo Plano ---
+jobs_snapshot = get_job_registry().list_jobs(st.session_state.job_ids)
+if len(jobs_snapshot) < len(st.session_state.job_ids):
+    # Trabajos descartados del registro (TTL / máximo): se olvidan también en la sesión y en la URL.
+    st.session_state.job_ids = [j.job_id for j in reversed(jobs_snapshot)]
+    st.query_params["trabajos"] = ",".join(st.session_state.job_ids)
+any_job_active = any(j.is_active for j in jobs_snapshot)
+
+@st.experimental_fragment(run_every=2 if any_job_active else None)
+def render_jobs_panel():
+    # Fragmento con sondeo periódico: solo esta región se re-ejecuta mientras haya trabajos activos.
+    jobs = get_job_registry().list_jobs(st.session_state.job_ids)
+    if not jobs: return
+    st.markdown("---"); st.header("🧵 Trabajos de Análisis")
+    jobs_table = pd.DataFrame([{
+        "ID": j.job_id, "Trabajo": j.label, "Estado": j.status, "Progreso": f"{j.progress:.0%}",
+        "Eventos (parciales)": j.partial_event_count, "Creado": j.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        "Duración (s)": round(((j.finished_at or datetime.datetime.now()) - j.started_at).total_seconds(), 1) if j.started_at else None
+    } for j in jobs])
+    st.dataframe(jobs_table, hide_index=True, use_container_width=True, height=min(max(100, len(jobs_table)*35 + 38), 300))
+
+    job_ids_available = [j.job_id for j in jobs]
+    jobs_by_id = {j.job_id: j for j in jobs}
+    default_job_id = st.session_state.active_job_id if st.session_state.active_job_id in job_ids_available else job_ids_available[0]
+    sel_job_id = st.selectbox("Trabajo a monitorear:", job_ids_available, index=job_ids_available.index(default_job_id),
+                              format_func=lambda jid: f"{jid} - {jobs_by_id[jid].label} [{jobs_by_id[jid].status}]",
+                              key=f"job_monitor_select_ui_{default_job_id}")
+    if sel_job_id != st.session_state.active_job_id:
+        st.session_state.active_job_id = sel_job_id
+    job = jobs_by_id.get(sel_job_id)
+    if job is None: return
+
+    # Al terminar el trabajo monitoreado se cargan sus resultados automáticamente (rerun completo de la app).
+    if not job.is_active and st.session_state.auto_load_job_id == job.job_id:
+        st.session_state.auto_load_job_id = None
+        load_job_results_into_session(job)
+        st.rerun()
+    # Siguiendo resultados progresivos: se recargan los clientes finalizados, como mucho cada PROGRESSIVE_RESULTS_REFRESH_SECONDS.
+    if st.session_state.follow_partial_job_id == job.job_id:
+        if not job.is_active:
+            st.session_state.follow_partial_job_id = None
+            load_job_results_into_session(job); st.rerun()
+        elif (job.client_results_version != st.session_state.partial_results_version
+              and time.time() - st.session_state.partial_results_loaded_at >= PROGRESSIVE_RESULTS_REFRESH_SECONDS):
+            load_job_results_into_session(job, partial=True); st.rerun()
+
+    st.progress(min(1.0, max(0.0, job.progress)), text=f"[{job.status}] {job.status_message}")
+    for level, notice in list(job.notices)[-5:]:
+        getattr(st, level, st.warning)(notice)
+    if job.message: st.caption(job.message)
+
+    job_btn1, job_btn2, _ = st.columns([1, 1, 4])
+    with job_btn1:
+        if st.button("📂 Ver resultados", key=f"job_load_btn_{job.job_id}", disabled=job.is_active):
+            load_job_results_into_session(job); st.rerun()
+    with job_btn2:
+        if st.button("⛔ Cancelar", key=f"job_cancel_btn_{job.job_id}", disabled=not job.is_active):
+            job.cancel_requested = True
+            st.toast(f"Cancelación solicitada para el trabajo {job.job_id}.")
+
+    if job.is_active and job.params.get('progressive_clients') and job.clients_total:
+        st.caption(f"Clientes finalizados: {len(job.client_results)}/{job.clients_total}.")
+        if job.client_results:
+            clients_state_df = job.get_client_states_df()
+            if not clients_state_df.empty: st.dataframe(clients_state_df, use_container_width=True, height=min(max(100, len(clients_state_df)*35 + 38), 300))
+            if st.button("📂 Ver clientes finalizados", key=f"job_partial_load_btn_{job.job_id}",
+                         help="Carga en los resultados los clientes ya terminados y los actualiza mientras el trabajo sigue."):
+                st.session_state.follow_partial_job_id = job.job_id
+                load_job_results_into_session(job, partial=True); st.rerun()
+    if job.is_active:
+        partial_df = job.get_partial_events_df()
+        st.caption(f"Resultados parciales: {job.partial_event_count} eventos extraídos hasta ahora"
+                   + (" (volcados a disco; no se muestran aquí)." if job.params.get('spill_events') else f" (se muestran los últimos {min(len(partial_df), 200)})."))
+        if not partial_df.empty:
+            st.dataframe(partial_df.tail(200), use_container_width=True, height=300, column_config={"IMEI_Key": None})
+    with st.expander("Log del trabajo"):
+        st.code("".join(job.log_string.splitlines(True)[-200:]) or "(vacío)", language=None)
+
+render_jobs_panel()
 
 # --- Visualización de Resultados ---
 events_df_disp = st.session_state.get('events_df', pd.DataFrame())
@@ -1081,11 +3576,160 @@ current_state_df_disp = st.session_state.get('current_state_df', pd.DataFrame())
 analysis_done = st.session_state.get('processing_complete', False)
 df_cleaned_for_display = st.session_state.get('df_for_gemini_analysis', pd.DataFrame())
 
+results_meta = st.session_state.get('results_meta') or {}
+# Con volcado a disco, events_df es solo una vista previa; el archivo completo se lee por fragmentos.
+events_path_disp = st.session_state.get('events_path') if st.session_state.get('events_path') and os.path.exists(st.session_state.events_path) else None
+
+# Regiones aisladas: interactuar con ellas re-ejecuta solo el fragmento, no toda la app.
+view_cols = tuple(results_meta.get(k, st.session_state.get(k, None)) for k in ('imei_col', 'desc_col', 'date_col', 'client_col'))
+
+def get_results_view_index(events_df, source_df, view_cols):
+    view_index_version = (st.session_state.results_version, view_cols)
+    if st.session_state.results_view_index is None or st.session_state.results_view_index_version != view_index_version:
+        view_index = build_results_view_index(events_df, source_df, *view_cols)
+        if events_path_disp:
+            view_index["imei_positions"] = {}
+            view_index["imei_options"] = sorted(set().union(*(chunk["IMEI"].dropna().astype(str).unique() for chunk in iter_event_chunks(events_path_disp, ["IMEI"]))))
+        st.session_state.results_view_index = view_index
+        st.session_state.results_view_index_version = view_index_version
+    return st.session_state.results_view_index
+
+def get_export_bytes(export_key, build_bytes):
+    # Las descargas se serializan una sola vez por versión de resultados y se reutilizan en cada rerun, mientras
+    # el total guardado en la sesión no pase de EXPORT_CACHE_MAX_BYTES (cada sesión tendría su propia copia).
+    if st.session_state.export_cache_version != st.session_state.results_version:
+        st.session_state.export_cache = {}
+        st.session_state.export_cache_version = st.session_state.results_version
+    if export_key in st.session_state.export_cache:
+        return st.session_state.export_cache[export_key]
+    export_bytes = build_bytes()
+    if sum(len(cached) for cached in st.session_state.export_cache.values()) + len(export_bytes) <= EXPORT_CACHE_MAX_BYTES:
+        st.session_state.export_cache[export_key] = export_bytes
+    return export_bytes
+
+def reset_log_export():
+    # Tras descargar el log se suelta su copia: no se vuelve a codificar en cada rerun mientras el log crece.
+    st.session_state.log_export_requested = False
+    st.session_state.log_export_bytes = None
+
+@st.experimental_fragment
+def render_imei_detail(events_df, source_df, view_cols):
+    try:
+        view_index = get_results_view_index(events_df, source_df, view_cols)
+    except Exception as e:
+        st.warning(f"Error obteniendo IMEIs para detalle: {e}"); return
+    imei_opts_tab1 = view_index["imei_options"]
+    if imei_opts_tab1:
+         sel_imei_detail_tab1 = st.selectbox("Selecciona IMEI para ver su historial detallado:", options=[""] + imei_opts_tab1, key="imei_detail_sel_ui_tab1", help="IMEI para ver su historial de eventos extraídos.")
+         if sel_imei_detail_tab1:
+             if events_path_disp: hist_imei_df = read_spilled_events(events_path_disp, imei=sel_imei_detail_tab1).sort_values(by="Fecha", kind="mergesort")
+             else: hist_imei_df = events_df.iloc[view_index["imei_positions"][imei_device_keys([sel_imei_detail_tab1])[0]]].copy()
+             if 'Fecha' in hist_imei_df.columns and pd.api.types.is_datetime64_any_dtype(hist_imei_df['Fecha']):
+                 try: hist_imei_df['Fecha'] = hist_imei_df['Fecha'].dt.strftime('%Y-%m-%d %H:%M:%S')
+                 except Exception as e: update_log_display(f"Error formateando fecha detalle IMEI tab1: {e}", level="WARNING")
+
+             disp_cols = ['Fecha', 'Cliente', 'Componente', 'Accion', 'Accesorio_ID', 'Descripcion_Original']
+             existing_cols = [c for c in disp_cols if c in hist_imei_df.columns]
+             st.dataframe(hist_imei_df[existing_cols], use_container_width=True, height=min(max(150, len(hist_imei_df)*35 + 38), 400))
+    elif not events_df.empty: st.info("No IMEIs encontrados en los eventos extraídos para mostrar detalle.")
+
+@st.experimental_fragment
+def render_service_browser(events_df, source_df, imei_col_s, desc_col_s, date_col_s, client_col_s):
+    col_btn1_fus, col_btn2_fus, _ = st.columns([1, 1, 5])
+    def set_expand_all_fusion(value):
+        st.session_state.expand_all_details_fusion = value
+
+    with col_btn1_fus:
+        st.button("➕ Expandir Todo", key="btn_expand_fusion_tab2", on_click=set_expand_all_fusion, args=(True,))
+    with col_btn2_fus:
+        st.button("➖ Contraer Todo", key="btn_collapse_fusion_tab2", on_click=set_expand_all_fusion, args=(False,))
+
+    try:
+        view_index = get_results_view_index(events_df, source_df, (imei_col_s, desc_col_s, date_col_s, client_col_s))
+        service_dates = pd.to_datetime(source_df[date_col_s], errors='coerce')
+
+        if not view_index["service_groups"]:
+            st.info("No hay servicios agrupados para mostrar en esta sección con los filtros actuales.")
+
+        for (date_val, client_name_val), group_positions in view_index["service_groups"]:
+            group = source_df.iloc[group_positions]
+            if group.empty: continue
+
+            client_display_name = str(client_name_val)
+            date_str = date_val.strftime('%Y-%m-%d') if pd.notna(date_val) and isinstance(date_val, datetime.date) else "Fecha Desconocida"
+            expander_label = f"🗓️ {date_str} - 👤 {client_display_name} ({len(group)} registros)"
+
+            with st.expander(expander_label, expanded=st.session_state.expand_all_details_fusion):
+                for service_pos, (service_original_idx, service_row) in zip(group_positions, group.iterrows()):
+                    try:
+                        imei_val = service_row[imei_col_s]
+                        desc_val = service_row[desc_col_s]
+                        fecha_completa_val = service_dates.iloc[service_pos]
+                        cliente_val = service_row[client_col_s]
+                    except KeyError as ke:
+                         st.error(f"Error: Falta la columna '{ke}' en los datos originales para el índice {service_original_idx}. Saltando este servicio.")
+                         continue # Saltar al siguiente servicio si faltan datos clave
+
+
+                    st.markdown(f"**Servicio Original (Índice CSV Original: {service_original_idx})**")
+
+                    col_info, col_ia = st.columns(2)
+                    with col_info:
+                        st.markdown(f"  - **IMEI:** `{imei_val}`")
+                        st.markdown(f"  - **Fecha Servicio:** `{fecha_completa_val.strftime('%Y-%m-%d %H:%M:%S') if pd.notna(fecha_completa_val) else 'N/A'}`")
+                        st.markdown(f"  - **Cliente:** `{cliente_val}`")
+                        st.markdown(f"  - **Descripción Original:**")
+                        st.markdown(f"    > {desc_val}")
+
+                    with col_ia:
+                        st.markdown("**Análisis IA:**")
+                        # Emparejamiento por (clave de equipo, descripción, fecha) resuelto con el índice de la vista.
+                        event_positions = view_index["service_events"].get((view_index["service_device_keys"][service_pos], str(desc_val), fecha_completa_val), ()) if pd.notna(fecha_completa_val) else ()
+                        if len(event_positions):
+                            for _, evento_ia in events_df.iloc[event_positions].iterrows():
+                                accesorio_id_display = f"(ID: `{evento_ia['Accesorio_ID']}`)" if pd.notna(evento_ia['Accesorio_ID']) and str(evento_ia['Accesorio_ID']).strip() else ""
+                                st.markdown(f"  - **{evento_ia['Componente']}**: {evento_ia['Accion']} {accesorio_id_display}")
+                        else:
+                            st.markdown("  *No se detectaron componentes específicos por IA o el mapeo no coincidió.*")
+                    st.markdown("---")
+    except Exception as e_group_display_tab2:
+        st.error(f"Error al generar la vista detallada de servicios: {e_group_display_tab2}")
+        update_log_display(f"ERROR en vista detallada fusionada (TAB2): {e_group_display_tab2}\n{traceback.format_exc()}", "ERROR")
+
+@st.experimental_fragment
+def render_log_viewer():
+    log_disp_content = st.session_state.get('log_string', "Log vacío.\n")
+    st.button("🔄 Actualizar Log", key="log_refresh_btn", help="Refresca solo esta sección.")
+    st.text_area("Log:", value=log_disp_content, height=400, disabled=True, key="log_display_main_ui")
+
+    if log_disp_content and log_disp_content.strip() and log_disp_content.strip() != default_values['log_string'].strip():
+        log_s_d = st.session_state.get('start_date', "Ini")
+        log_e_d = st.session_state.get('end_date', "Fin")
+        log_clients_fname_list = st.session_state.get('selected_clients_list', ["-- TODOS --"])
+        log_client_fn = "TODOS"
+        if isinstance(log_clients_fname_list, list) and log_clients_fname_list != ["-- TODOS --"]:
+             log_client_fn = "_".join(map(str, log_clients_fname_list)).replace(" ", "").replace("/", "-")[:30]
+        # El log se codifica solo cuando se pide la descarga (y de nuevo solo si creció desde entonces).
+        if not st.session_state.log_export_requested:
+            if st.button("🐞 Preparar Log para Descarga", key='prep_log_main_btn'):
+                st.session_state.log_export_requested = True
+        if st.session_state.log_export_requested:
+            try:
+                 # Se codifica una vez al pedirlo; el log que siga creciendo se incluye en la próxima descarga.
+                 if st.session_state.log_export_bytes is None: st.session_state.log_export_bytes = log_disp_content.encode('utf-8')
+                 st.download_button("🐞 Descargar Log Completo", st.session_state.log_export_bytes, f"log_analisis_gps_{log_client_fn}_{log_s_d}_a_{log_e_d}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt", "text/plain",
+                                    key='dl_log_main_btn', on_click=reset_log_export)
+            except Exception as e: st.error(f"Error preparando log para descarga: {e}")
+
 if analysis_done:
     st.markdown("---"); st.header("📊 Resultados del Análisis")
-    s_date_disp = st.session_state.get('start_date', "N/A")
-    e_date_disp = st.session_state.get('end_date', "N/A")
-    sel_clients_fname_list = st.session_state.get('selected_clients_list', ["-- TODOS --"])
+    if results_meta.get('file_name'): st.caption(f"Archivo analizado: {results_meta['file_name']}")
+    if st.session_state.partial_results_version is not None and results_meta.get('clientes_parciales'):
+        st.info(f"Resultados parciales: {results_meta['clientes_parciales'][0]}/{results_meta['clientes_parciales'][1]} clientes finalizados. "
+                "Se actualizan solos mientras el trabajo sigue en curso.")
+    s_date_disp = results_meta.get('start_date', st.session_state.get('start_date', "N/A"))
+    e_date_disp = results_meta.get('end_date', st.session_state.get('end_date', "N/A"))
+    sel_clients_fname_list = results_meta.get('selected_clients_list', st.session_state.get('selected_clients_list', ["-- TODOS --"]))
 
     client_fname = "TODOS"
     if isinstance(sel_clients_fname_list, list) and sel_clients_fname_list != ["-- TODOS --"]:
@@ -1103,7 +3747,9 @@ if analysis_done:
             if 'Fecha' in events_df_fmt.columns and pd.api.types.is_datetime64_any_dtype(events_df_fmt['Fecha']):
                 try: events_df_fmt['Fecha'] = events_df_fmt['Fecha'].dt.strftime('%Y-%m-%d %H:%M:%S')
                 except Exception as e: update_log_display(f"Error formateando fecha display eventos: {e}", level="WARNING")
-            st.dataframe(events_df_fmt, use_container_width=True, height=min(max(200, len(events_df_fmt)*35 + 38), 600))
+            st.dataframe(events_df_fmt, use_container_width=True, height=min(max(200, len(events_df_fmt)*35 + 38), 600), column_config={"IMEI_Key": None}) # clave interna de equipo
+            if events_path_disp:
+                st.caption(f"Vista previa: {len(events_df_disp)} de {spilled_event_count(events_path_disp)} eventos. El historial completo está en '{events_path_disp}' (estado final y detalle por IMEI se calculan desde ese archivo).")
 
             if current_state_df_disp is not None and not current_state_df_disp.empty:
                  st.subheader(f"📈 Estado Actual Componentes ({e_date_disp})")
@@ -1111,38 +3757,117 @@ if analysis_done:
             elif current_state_df_disp is not None:
                  st.subheader(f"📈 Estado Actual Componentes ({e_date_disp})"); st.info("No se generaron datos consolidados de estado final.")
 
+            if events_path_disp:
+                st.info("Estado a una fecha y búsqueda de accesorios no están disponibles con eventos volcados a disco: requieren el historial completo en memoria.")
+            else:
+                st.subheader("🕰️ Estado de Componentes a una Fecha")
+                try:
+                    # El índice se construye una vez por resultado; mover el slider no vuelve a llamar a la API.
+                    if st.session_state.timeline_index is None or st.session_state.timeline_index_version != st.session_state.results_version:
+                        st.session_state.timeline_index = build_component_timeline(events_df_disp)
+                        st.session_state.timeline_index_version = st.session_state.results_version
+                    timeline_index = st.session_state.timeline_index
+                    timeline_dates = timeline_index["device_events"]["Fecha"]
+                    if not timeline_dates.empty:
+                        tl_min_date, tl_max_date = timeline_dates.min().date(), timeline_dates.max().date()
+                        as_of_date = tl_max_date
+                        if tl_min_date < tl_max_date:
+                            as_of_date = st.slider("Fecha de consulta:", min_value=tl_min_date, max_value=tl_max_date, value=tl_max_date, format="YYYY-MM-DD",
+                                                   key="as_of_date_slider_ui",
+                                                   help="Reconstruye qué tenía instalado cada IMEI al cierre de la fecha elegida, a partir de los eventos ya extraídos.")
+                        state_as_of_df = fleet_state_as_of(timeline_index, as_of_date)
+                        st.caption(f"{len(state_as_of_df)} dispositivos con eventos hasta {as_of_date}.")
+                        st.dataframe(state_as_of_df, use_container_width=True, height=min(max(200, len(state_as_of_df)*35 + 38), 600))
+                    else: st.info("No hay eventos con fecha válida para construir la línea de tiempo.")
+                except Exception as e: st.warning(f"Error calculando estado a una fecha: {e}"); update_log_display(f"Error en estado a fecha: {e}. Trace: {traceback.format_exc()}", level="ERROR")
+
+                st.subheader("🔎 Búsqueda de Accesorios por ID")
+                try:
+                    if st.session_state.accessory_index is None or st.session_state.accessory_index_version != st.session_state.results_version:
+                        st.session_state.accessory_index = build_accessory_index(events_df_disp)
+                        st.session_state.accessory_index_version = st.session_state.results_version
+                    accessory_index = st.session_state.accessory_index
+                    accessory_query = st.text_input("Serie, MAC, tag TDBLE o número de accesorio:", key="accessory_search_ui",
+                                                    placeholder="p.ej. C2313007631, DD:2B:C1:75:2F:FA, TDBLE_308529, 868",
+                                                    help="Acepta MAC con o sin separadores y prefijos (búsqueda por prefijo si no hay coincidencia exacta).")
+                    st.caption(f"{len(accessory_index['ids'])} IDs normalizados en {len(accessory_index['lookup'])} claves de búsqueda.")
+                    if accessory_query:
+                        accessory_hits = search_accessory_index(accessory_index, accessory_query)
+                        if accessory_hits.empty: st.info(f"Sin coincidencias para '{accessory_query}'.")
+                        else: st.dataframe(accessory_hits.drop(columns=["Evento_Pos"]), use_container_width=True, hide_index=True, height=min(max(150, len(accessory_hits)*35 + 38), 400))
+                    accessory_conflicts = accessory_index["conflicts"]
+                    if not accessory_conflicts.empty:
+                        with st.expander(f"⚠️ {accessory_conflicts['ID_Clave'].nunique()} accesorio(s) instalados actualmente en más de un IMEI"):
+                            st.dataframe(accessory_conflicts, use_container_width=True, hide_index=True)
+                except Exception as e: st.warning(f"Error en índice de accesorios: {e}"); update_log_display(f"Error en índice de accesorios: {e}. Trace: {traceback.format_exc()}", level="ERROR")
+
+                st.subheader("🧪 Auditoría de Consistencia de la Flota")
+                try:
+                    if st.session_state.fleet_audit is None or st.session_state.fleet_audit_version != st.session_state.results_version:
+                        st.session_state.fleet_audit = audit_fleet_consistency(events_df_disp)
+                        st.session_state.fleet_audit_version = st.session_state.results_version
+                    fleet_audit = st.session_state.fleet_audit
+                    audit_anomalies, audit_counts = fleet_audit["anomalies"], fleet_audit["counts"]
+                    if audit_anomalies.empty:
+                        st.success(f"Sin secuencias imposibles en {fleet_audit['events_audited']} eventos auditados.")
+                    else:
+                        st.caption(f"{len(audit_anomalies)} anomalía(s) en {fleet_audit['events_audited']} eventos auditados: "
+                                   + ", ".join(f"{label}: {int(audit_counts[label].sum())}" for label in AUDIT_ANOMALIAS.values()) + ".")
+                        st.dataframe(audit_counts, use_container_width=True, hide_index=True, height=min(max(100, len(audit_counts)*35 + 38), 300))
+                        audit_filter = st.selectbox("Tipo de anomalía:", ["Todas", *AUDIT_ANOMALIAS.values()], key="fleet_audit_filter_ui")
+                        audit_view = audit_anomalies if audit_filter == "Todas" else audit_anomalies[audit_anomalies["Anomalia"] == audit_filter]
+                        st.dataframe(audit_view.head(FLEET_AUDIT_DISPLAY_ROWS), use_container_width=True, hide_index=True, height=min(max(150, len(audit_view)*35 + 38), 400))
+                        if len(audit_view) > FLEET_AUDIT_DISPLAY_ROWS: st.caption(f"Mostrando {FLEET_AUDIT_DISPLAY_ROWS} de {len(audit_view)}; la descarga incluye todas.")
+                        st.download_button("📥 Descargar Anomalías", get_export_bytes('auditoria_csv', lambda: audit_anomalies.to_csv(index=False).encode('utf-8')),
+                                           f'auditoria_flota_{client_fname}_{s_date_disp}_a_{e_date_disp}.csv', 'text/csv', key='dl_fleet_audit_csv')
+                except Exception as e: st.warning(f"Error en auditoría de consistencia: {e}"); update_log_display(f"Error en auditoría de consistencia: {e}. Trace: {traceback.format_exc()}", level="ERROR")
+
+            try:
+                if st.session_state.imei_report is None or st.session_state.imei_report_version != st.session_state.results_version:
+                    st.session_state.imei_report = build_imei_report(df_cleaned_for_display, view_cols[0], client_col=view_cols[3], date_col=view_cols[2])
+                    st.session_state.imei_report_version = st.session_state.results_version
+                imei_report = st.session_state.imei_report
+                if not imei_report.empty:
+                    with st.expander(f"⚠️ Reporte de IMEIs inválidos: {len(imei_report)} fila(s), {imei_report['IMEI_Limpio'].nunique()} IMEI(s) distintos"):
+                        st.caption("Estas filas se analizaron con el texto limpio del IMEI como identificador. " + ", ".join(f"{motivo}: {n}" for motivo, n in imei_report["Motivo"].value_counts().items()) + ".")
+                        st.dataframe(imei_report, use_container_width=True, hide_index=True, height=min(max(150, len(imei_report)*35 + 38), 400))
+                        st.download_button("📥 Descargar reporte de IMEIs", get_export_bytes('imei_report_csv', lambda: imei_report.to_csv(index=False).encode('utf-8')),
+                                           f'imeis_invalidos_{client_fname}_{s_date_disp}_a_{e_date_disp}.csv', 'text/csv', key='dl_imei_report_csv')
+            except Exception as e: st.warning(f"Error generando reporte de IMEIs: {e}"); update_log_display(f"Error en reporte de IMEIs: {e}. Trace: {traceback.format_exc()}", level="ERROR")
+
             dl_col1, dl_col2 = st.columns(2)
             with dl_col1:
                 if current_state_df_disp is not None and not current_state_df_disp.empty:
                      try:
-                          csv_state = current_state_df_disp.to_csv(index=False).encode('utf-8')
+                          csv_state = get_export_bytes('estado_csv', lambda: current_state_df_disp.to_csv(index=False).encode('utf-8'))
                           st.download_button(f"📥 Descargar Estado Final", csv_state, f'estado_final_{client_fname}_{s_date_disp}_a_{e_date_disp}.csv', 'text/csv', key='dl_state_csv')
                      except Exception as e: st.error(f"Error generando CSV estado: {e}")
             with dl_col2:
                  try:
-                      csv_events = events_df_disp.to_csv(index=False).encode('utf-8')
-                      st.download_button(f"📥 Descargar Eventos IA", csv_events, f'eventos_extraidos_ia_{client_fname}_{s_date_disp}_a_{e_date_disp}.csv', 'text/csv', key='dl_events_csv')
+                      if events_path_disp:
+                          # El historial completo solo existe en disco: se ofrece el Parquet volcado tal cual.
+                          # No pasa por get_export_bytes: el archivo puede ser enorme y no debe quedar copiado en la sesión.
+                          with open(events_path_disp, 'rb') as spilled_file:
+                              st.download_button(f"📥 Descargar Eventos IA (Parquet completo)", spilled_file, f'eventos_extraidos_ia_{client_fname}_{s_date_disp}_a_{e_date_disp}.parquet', 'application/octet-stream', key='dl_events_spilled')
+                      else:
+                          csv_events = get_export_bytes('eventos_csv', lambda: events_df_disp.drop(columns=["IMEI_Key"], errors='ignore').to_csv(index=False).encode('utf-8'))
+                          st.download_button(f"📥 Descargar Eventos IA", csv_events, f'eventos_extraidos_ia_{client_fname}_{s_date_disp}_a_{e_date_disp}.csv', 'text/csv', key='dl_events_csv')
                  except Exception as e: st.error(f"Error generando CSV eventos: {e}")
+            with st.expander("📦 Exportar en Parquet (fechas y categorías tipadas; reabrible sin IA)"):
+                 try:
+                      export_frames = build_results_frames(events_df_disp, current_state_df_disp, df_cleaned_for_display, results_meta)
+                      pq_cols = st.columns(len(export_frames))
+                      for pq_col, (key, (df, date_cols, cat_cols)) in zip(pq_cols, export_frames.items()):
+                          with pq_col:
+                              if df is None or df.empty or (key == "events_df" and events_path_disp): continue
+                              parquet_bytes = get_export_bytes(f'{key}_parquet', lambda: results_to_parquet_bytes(df, results_meta, date_cols, cat_cols))
+                              st.download_button(f"📥 {RESULTS_FILES[key]}", parquet_bytes,
+                                                 f"{RESULTS_FILES[key].removesuffix('.parquet')}_{client_fname}_{s_date_disp}_a_{e_date_disp}.parquet", 'application/octet-stream', key=f'dl_{key}_parquet')
+                      st.caption(f"Los análisis completados también se guardan en '{RESULTS_DIR}/'. Para reabrir descargas, guárdelas en una carpeta dentro de '{RESULTS_DIR}/' como {', '.join(RESULTS_FILES.values())}.")
+                 except Exception as e: st.error(f"Error generando Parquet: {e}")
 
             st.subheader(f"⏳ Historial Detallado por IMEI ({s_date_disp} a {e_date_disp})")
-            imei_opts_tab1 = []
-            try:
-                 if 'IMEI' in events_df_disp.columns and not events_df_disp.empty:
-                      imei_opts_tab1 = sorted(events_df_disp['IMEI'].dropna().astype(str).unique().tolist())
-            except Exception as e: st.warning(f"Error obteniendo IMEIs para detalle: {e}")
-
-            if imei_opts_tab1:
-                 sel_imei_detail_tab1 = st.selectbox("Selecciona IMEI para ver su historial detallado:", options=[""] + imei_opts_tab1, key="imei_detail_sel_ui_tab1", help="IMEI para ver su historial de eventos extraídos.")
-                 if sel_imei_detail_tab1:
-                     hist_imei_df = events_df_disp[events_df_disp['IMEI'].astype(str) == sel_imei_detail_tab1].sort_values(by="Fecha").copy()
-                     if 'Fecha' in hist_imei_df.columns and pd.api.types.is_datetime64_any_dtype(hist_imei_df['Fecha']):
-                         try: hist_imei_df['Fecha'] = hist_imei_df['Fecha'].dt.strftime('%Y-%m-%d %H:%M:%S')
-                         except Exception as e: update_log_display(f"Error formateando fecha detalle IMEI tab1: {e}", level="WARNING")
-
-                     disp_cols = ['Fecha', 'Cliente', 'Componente', 'Accion', 'Accesorio_ID', 'Descripcion_Original']
-                     existing_cols = [c for c in disp_cols if c in hist_imei_df.columns]
-                     st.dataframe(hist_imei_df[existing_cols], use_container_width=True, height=min(max(150, len(hist_imei_df)*35 + 38), 400))
-            elif not events_df_disp.empty: st.info("No IMEIs encontrados en los eventos extraídos para mostrar detalle.")
+            render_imei_detail(events_df_disp, df_cleaned_for_display, view_cols)
 
         elif events_df_disp is not None:
             st.warning("No se extrajo ningún evento de IA para el rango y filtros seleccionados.")
@@ -1157,112 +3882,14 @@ if analysis_done:
         if df_cleaned_for_display is not None and not df_cleaned_for_display.empty and \
            events_df_disp is not None : # Necesitamos df_cleaned para mostrar originales, events_df puede estar vacío
 
-            imei_col_s = st.session_state.get('imei_col', None)
-            desc_col_s = st.session_state.get('desc_col', None)
-            date_col_s = st.session_state.get('date_col', None)
-            client_col_s = st.session_state.get('client_col', None)
+            imei_col_s, desc_col_s, date_col_s, client_col_s = view_cols
 
-            if not all([imei_col_s, desc_col_s, date_col_s, client_col_s]):
+            if events_path_disp:
+                st.info("El detalle por servicio no está disponible con eventos volcados a disco; use el historial por IMEI de la pestaña de resumen.")
+            elif not all([imei_col_s, desc_col_s, date_col_s, client_col_s]):
                 st.warning("Faltan selecciones de columnas para mostrar el detalle de servicios. Por favor, configure las columnas en la barra lateral y vuelva a analizar.")
             else:
-                col_btn1_fus, col_btn2_fus, _ = st.columns([1, 1, 5])
-                def set_expand_all_fusion(value):
-                    st.session_state.expand_all_details_fusion = value
-
-                with col_btn1_fus:
-                    st.button("➕ Expandir Todo", key="btn_expand_fusion_tab2", on_click=set_expand_all_fusion, args=(True,))
-                with col_btn2_fus:
-                    st.button("➖ Contraer Todo", key="btn_collapse_fusion_tab2", on_click=set_expand_all_fusion, args=(False,))
-
-                try:
-                    df_display_copy = df_cleaned_for_display.copy()
-                    if not pd.api.types.is_datetime64_any_dtype(df_display_copy[date_col_s]):
-                         df_display_copy[date_col_s] = pd.to_datetime(df_display_copy[date_col_s], errors='coerce')
-                    df_display_copy['Fecha_Solo_Display'] = df_display_copy[date_col_s].dt.date
-
-                    grouped_services = df_display_copy.sort_values(by=['Fecha_Solo_Display', client_col_s])\
-                                                 .groupby(['Fecha_Solo_Display', client_col_s], sort=False, dropna=False)
-
-                    num_groups = len(grouped_services)
-                    if num_groups == 0:
-                        st.info("No hay servicios agrupados para mostrar en esta sección con los filtros actuales.")
-
-                    for (date_val, client_name_val), group in grouped_services:
-                        if group.empty: continue
-
-                        client_display_name = str(client_name_val)
-                        date_str = date_val.strftime('%Y-%m-%d') if pd.notna(date_val) and isinstance(date_val, datetime.date) else "Fecha Desconocida"
-                        expander_label = f"🗓️ {date_str} - 👤 {client_display_name} ({len(group)} registros)"
-
-                        with st.expander(expander_label, expanded=st.session_state.expand_all_details_fusion):
-                            for service_original_idx, service_row in group.iterrows():
-                                # Asegurarse que las variables clave para este servicio existen
-                                try:
-                                    imei_val = service_row[imei_col_s]
-                                    desc_val = service_row[desc_col_s]
-                                    # Convertir fecha a datetime aquí para asegurar el tipo correcto
-                                    fecha_completa_val = pd.to_datetime(service_row[date_col_s])
-                                    cliente_val = service_row[client_col_s]
-                                except KeyError as ke:
-                                     st.error(f"Error: Falta la columna '{ke}' en los datos originales para el índice {service_original_idx}. Saltando este servicio.")
-                                     continue # Saltar al siguiente servicio si faltan datos clave
-
-
-                                st.markdown(f"**Servicio Original (Índice CSV Original: {service_original_idx})**")
-
-                                col_info, col_ia = st.columns(2)
-                                with col_info:
-                                    st.markdown(f"  - **IMEI:** `{imei_val}`")
-                                    st.markdown(f"  - **Fecha Servicio:** `{fecha_completa_val.strftime('%Y-%m-%d %H:%M:%S') if pd.notna(fecha_completa_val) else 'N/A'}`")
-                                    st.markdown(f"  - **Cliente:** `{cliente_val}`")
-                                    st.markdown(f"  - **Descripción Original:**")
-                                    st.markdown(f"    > {desc_val}")
-
-                                with col_ia:
-                                    st.markdown("**Análisis IA:**")
-                                    # CORRECCIÓN: Trabajar siempre con una copia fresca de events_df_disp y asegurar tipos DENTRO del bucle
-                                    eventos_del_servicio = pd.DataFrame() # Inicializar vacío
-                                    if isinstance(events_df_disp, pd.DataFrame) and not events_df_disp.empty:
-                                        try:
-                                            events_df_temp = events_df_disp.copy() # Copia para esta iteración
-
-                                            # Convertir fecha a datetime si es necesario en la copia
-                                            if 'Fecha' in events_df_temp.columns and not pd.api.types.is_datetime64_any_dtype(events_df_temp['Fecha']):
-                                                events_df_temp['Fecha'] = pd.to_datetime(events_df_temp['Fecha'], errors='coerce')
-
-                                            # Convertir columnas de matching a string en la copia
-                                            if 'IMEI' in events_df_temp.columns:
-                                                events_df_temp['IMEI'] = events_df_temp['IMEI'].astype(str)
-                                            if 'Descripcion_Original' in events_df_temp.columns:
-                                                 events_df_temp['Descripcion_Original'] = events_df_temp['Descripcion_Original'].astype(str)
-
-                                            # Proceder con el filtro solo si la fecha es válida
-                                            if pd.notna(fecha_completa_val) and 'Fecha' in events_df_temp.columns:
-                                                eventos_del_servicio = events_df_temp[
-                                                    (events_df_temp.get('IMEI', pd.Series(dtype=str)) == str(imei_val)) &
-                                                    (events_df_temp.get('Descripcion_Original', pd.Series(dtype=str)) == str(desc_val)) &
-                                                    (events_df_temp['Fecha'] == fecha_completa_val) # Comparación directa de datetime
-                                                ]
-                                            else:
-                                                # Si la fecha original no es válida, no podemos hacer match por fecha
-                                                update_log_display(f"WARN: Fecha inválida ({fecha_completa_val}) para servicio índice {service_original_idx}. No se puede mapear evento IA por fecha.", "WARNING")
-
-                                        except Exception as e_filter:
-                                            st.warning(f"Error al intentar mapear evento IA para servicio {service_original_idx}: {e_filter}")
-                                            update_log_display(f"ERROR mapeando evento IA para índice {service_original_idx}: {e_filter}", "ERROR")
-
-
-                                    # Mostrar resultados del filtro
-                                    if not eventos_del_servicio.empty:
-                                        for _, evento_ia in eventos_del_servicio.iterrows():
-                                            accesorio_id_display = f"(ID: `{evento_ia['Accesorio_ID']}`)" if pd.notna(evento_ia['Accesorio_ID']) and str(evento_ia['Accesorio_ID']).strip() else ""
-                                            st.markdown(f"  - **{evento_ia['Componente']}**: {evento_ia['Accion']} {accesorio_id_display}")
-                                    else:
-                                        st.markdown("  *No se detectaron componentes específicos por IA o el mapeo no coincidió.*")
-                                st.markdown("---")
-                except Exception as e_group_display_tab2:
-                    st.error(f"Error al generar la vista detallada de servicios: {e_group_display_tab2}")
-                    update_log_display(f"ERROR en vista detallada fusionada (TAB2): {e_group_display_tab2}\n{traceback.format_exc()}", "ERROR")
+                render_service_browser(events_df_disp, df_cleaned_for_display, imei_col_s, desc_col_s, date_col_s, client_col_s)
 
         elif analysis_done:
             st.info("No hay datos suficientes (originales filtrados o eventos IA) para mostrar el detalle de servicios analizados en esta pestaña.")
@@ -1272,19 +3899,7 @@ if analysis_done:
 
 st.markdown("---")
 st.subheader("📝 Log de Procesamiento Detallado")
-log_disp_content = st.session_state.get('log_string', "Log vacío.\n")
-st.text_area("Log:", value=log_disp_content, height=400, disabled=True, key="log_display_main_ui")
-
-if log_disp_content and log_disp_content.strip() and log_disp_content.strip() != default_values['log_string'].strip():
-    log_s_d = st.session_state.get('start_date', "Ini")
-    log_e_d = st.session_state.get('end_date', "Fin")
-    log_clients_fname_list = st.session_state.get('selected_clients_list', ["-- TODOS --"])
-    log_client_fn = "TODOS"
-    if isinstance(log_clients_fname_list, list) and log_clients_fname_list != ["-- TODOS --"]:
-         log_client_fn = "_".join(map(str, log_clients_fname_list)).replace(" ", "").replace("/", "-")[:30]
-    try:
-         log_b = log_disp_content.encode('utf-8')
-         st.download_button("🐞 Descargar Log Completo", log_b, f"log_analisis_gps_{log_client_fn}_{log_s_d}_a_{log_e_d}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt", "text/plain", key='dl_log_main_btn')
-    except Exception as e: st.error(f"Error preparando log para descarga: {e}")
-elif not st.session_state.get('df_loaded', None) and not analysis_done:
+render_log_viewer()
+
+if st.session_state.get('df_loaded') is None and not analysis_done:
     st.info("👋 ¡Bienvenido! Configura API Key, carga CSV, selecciona columnas y rango de fechas en la barra lateral para analizar.")